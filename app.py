@@ -1,169 +1,474 @@
 import os
-from fastapi import FastAPI, HTTPException, status, Depends
+from typing import List, Optional
+from fastapi import APIRouter, BackgroundTasks, FastAPI, HTTPException, status, Depends, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
-import uvicorn
-from models import Car
-from repository import CarRepository, UserRepository
-from schemas import CarCreate, CarUpdate
-from database import get_db, DBUser
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+import anyio.to_thread
+from models import (
+	BulkImportResult, Car, CarBatchResult, CarPage, CarPhoto, CarSearchResult, CarStats,
+	User, UserCreate, UserUpdate, UserLogin, Token, UserChangePassword, Principal,
+)
+from repository import CAR_COLUMN_NAMES, CarRepository, PhotoRepository, UserRepository, VersionConflict, sharded_cars
+from schemas import CarBatchDelete, CarBatchUpdate, CarCreate, CarUpdate
+from search import facet_cache, tokenize
+from stats import parse_percentiles
+from database import DB_MODE, get_db, get_read_db, read_session
+from response_cache import CARS_TABLE, car_response_cache, entity_etag, if_match_versions
+import fast_json
+from fast_json import rows_to_columns, rows_to_dicts
+from bulk import CAR_EXPORT_COLUMNS, EXPORT_BATCH_SIZE, format_csv, format_ndjson, import_cars, iter_lines
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 from datetime import timedelta
 
-
-from models import  User, UserCreate, UserUpdate, UserLogin, Token, UserChangePassword, UserRole
-from repository import UserRepository
-from auth import AuthService, get_current_user, require_admin, require_manager_or_admin, ACCESS_TOKEN_EXPIRE_MINUTES
+from hashing import password_hasher
+from metrics import MetricsMiddleware, registry, render_metrics
+from change_feed import car_changes
+from invalidation import invalidation_bus
+from bootstrap import seed_initial_data
+from migrations import ensure_schema
+from content_encoding import CompressionMiddleware, StaticAsset
+from replicas import ReadYourWritesMiddleware, prefers_primary
+from catalog import car_catalog
+from sharding import CAR_SHARD_DIRECTORY_TTL_SECONDS, CAR_SHARD_SETTLE_SECONDS, DealerMoving, car_shards
+from media import (
+	MEDIA_MAX_UPLOAD_BYTES, THUMBNAIL_PENDING, THUMBNAIL_READY, UploadRejected, blob_store, car_exists,
+	collect_orphaned_photos, create_photo, photo_response, release_blobs, schedule_thumbnail, thumbnail_pool,
+)
+from ratelimit import RateLimitMiddleware, client_ip, rate_limiter, retry_after_header
+from auth import token_cache, token_state_cache, AuthService, get_current_user, require_admin, require_manager_or_admin, ACCESS_TOKEN_EXPIRE_MINUTES
 
 app = FastAPI()
+# Синхронные эндпоинты, работающие с БД; асинхронные - в async_routes (DB_MODE=async)
+router = APIRouter()
 
+# Порядок: метрики (внешний) -> сжатие -> CORS -> ограничение частоты, чтобы ответы 429 учитывались и несли заголовки CORS
+app.add_middleware(ReadYourWritesMiddleware)
+app.add_middleware(RateLimitMiddleware)
 app.add_middleware(
 	CORSMiddleware,
 	allow_origins=["*"],
 	allow_methods=["*"],
 	allow_headers=["*"],
 )
+app.add_middleware(CompressionMiddleware)
+app.add_middleware(MetricsMiddleware)
+
+
+def _threadpool_metrics():
+	limiter = anyio.to_thread.current_default_thread_limiter()
+	return [({"state": "busy"}, limiter.borrowed_tokens), ({"state": "limit"}, limiter.total_tokens)]
+
+
+def _cache_metrics():
+	for name, cache in (("response", car_response_cache), ("token", token_cache), ("token_state", token_state_cache), ("search_facets", facet_cache)):
+		for key, value in cache.stats().items():
+			yield {"cache": name, "stat": key}, value
+
+
+registry.gauge("threadpool_workers", "Потоки пула AnyIO для синхронных эндпоинтов", _threadpool_metrics)
+registry.gauge("cache_stats", "Состояние кэшей ответов, пользователей и фасетов поиска", _cache_metrics)
+registry.gauge("car_shards", "Шарды автомобилей и размещение дилеров", lambda: [
+	({"stat": key}, value) for key, value in car_shards.stats().items()
+])
 
 
 
 def get_car_repository(db: Session = Depends(get_db)):
-	"""Получение репозитория автомобилей"""
-	return CarRepository(db)
+	"""Получение репозитория автомобилей (при шардировании - общий для всех шардов)"""
+	return sharded_cars if car_shards.enabled else CarRepository(db)
+
+def get_car_read_repository(db: Session = Depends(get_read_db)):
+	"""Получение репозитория автомобилей для чтения"""
+	return sharded_cars if car_shards.enabled else CarRepository(db)
 
 def get_user_repository(db: Session = Depends(get_db)):
 	"""Получение репозитория пользователей"""
 	return UserRepository(db)
 
+def get_user_read_repository(db: Session = Depends(get_read_db)):
+	"""Получение репозитория пользователей для чтения"""
+	return UserRepository(db)
+
 @app.on_event("startup")
 async def startup_event():
-	db = next(get_db())
-	repo = CarRepository(db)
-
-	if not repo.get_all():
-		repo.create({"brand": "Toyota", "model": "Camry", "year": 2020, "price": 25000})
-		repo.create({"brand": "Honda", "model": "Accord", "year": 2021, "price": 27000})
-
-	# Создание администратора 
-	user_repo = UserRepository(db)
-	admin = user_repo.get_by_username("admin")
-	if not admin:
-		user_repo.create({
-			"username": "admin",
-			"email": "admin@carshop.com",
-			"password": "admin123",
-			"full_name": "Администратор",
-			"role": UserRole.ADMIN
-		})
-		print("Создан администратор: admin / admin123")
-
-
-@app.get("/")
-async def serve_index():
-    # Проверяем, существует ли файл index.html в текущей директории
-    if os.path.exists("index.html"):
-        return FileResponse("index.html")
-    else:
-        # Если файл не найден, создаем базовый HTML
-        return """
-        <!DOCTYPE html>
-        <html>
-        <head>
-            <title>Car Shop API</title>
-        </head>
-        <body>
-            <h1>Car Shop API is running!</h1>
-            <p>Visit <a href="/docs">/docs</a> for API documentation</p>
-            <p>Visit <a href="/static/index.html">/static/index.html</a> for the web interface</p>
-        </body>
-        </html>
-        """
+	# Сверка версии схемы одним запросом; миграции - python migrations.py до запуска воркеров
+	await run_in_threadpool(ensure_schema)
+	password_hasher.start()
+	invalidation_bus.start()
+	# Однократно и под блокировкой: воркеры могут стартовать одновременно
+	await run_in_threadpool(seed_initial_data)
+	if car_catalog.enabled:
+		await run_in_threadpool(car_catalog.load)
+
+
+@app.exception_handler(DealerMoving)
+async def dealer_moving_handler(request: Request, exc: DealerMoving):
+	"""Запись дилера приостановлена переносом между шардами: повторить через несколько секунд"""
+	return JSONResponse(
+		{"detail": "Автомобили дилера переносятся, повторите запрос позже"},
+		status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+		headers=retry_after_header(CAR_SHARD_DIRECTORY_TTL_SECONDS + CAR_SHARD_SETTLE_SECONDS),
+	)
+
+
+@app.on_event("shutdown")
+async def shutdown_event():
+	invalidation_bus.shutdown()
+	password_hasher.shutdown()
+	thumbnail_pool.shutdown()
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+	"""Метрики в текстовом формате Prometheus"""
+	return Response(render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.get("/cars/changes", include_in_schema=False)
+async def car_changes_stream(request: Request):
+	"""Лента изменений автомобилей (Server-Sent Events)
+
+	Событие - JSON с монотонным номером seq и операцией op: upsert (cars),
+	update и delete (ids), reload и reset (перечитать список). После разрыва
+	EventSource передает Last-Event-ID, и пропущенные события досылаются из буфера.
+	"""
+	return StreamingResponse(
+		car_changes.stream(request.headers.get("last-event-id")),
+		media_type="text/event-stream",
+		headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+	)
+
+
+# index.html читается и сжимается один раз при запуске (без обращения к диску на каждый запрос)
+INDEX_FALLBACK_HTML = b"""<!DOCTYPE html>
+<html>
+<head>
+	<title>Car Shop API</title>
+</head>
+<body>
+	<h1>Car Shop API is running!</h1>
+	<p>Visit <a href="/docs">/docs</a> for API documentation</p>
+</body>
+</html>
+"""
+index_page = StaticAsset.from_file(
+	os.path.join(os.path.dirname(os.path.abspath(__file__)), "index.html"), "text/html; charset=utf-8", INDEX_FALLBACK_HTML
+)
+
+
+@app.get("/", include_in_schema=False)
+async def serve_index(request: Request):
+	return index_page.respond(request)
 
 
 # ========== ЭНДПОИНТЫ АВТОМОБИЛЕЙ  ==========
 
-@app.get("/cars", response_model=list[Car])
-def get_all_cars(repo: CarRepository = Depends(get_car_repository)):
-	return repo.get_all()
+@router.get("/cars", response_model=CarPage)
+def get_all_cars(
+	request: Request,
+	brand: Optional[str] = None,
+	model: Optional[str] = None,
+	color: Optional[str] = None,
+	year_min: Optional[int] = None,
+	year_max: Optional[int] = None,
+	price_min: Optional[float] = None,
+	price_max: Optional[float] = None,
+	dealer_id: Optional[int] = None,
+	sort: str = Query("id", pattern="^-?(id|price|year)$"),
+	cursor: Optional[str] = None,
+	limit: int = Query(50, ge=1, le=500),
+	layout: str = Query("rows", pattern="^(rows|columns)$"),
+	repo: CarRepository = Depends(get_car_read_repository)
+):
+	"""Страница автомобилей с фильтрами; следующая страница - по next_cursor
+
+	layout=columns возвращает страницу в колоночном виде {"columns": {колонка: [значения]}}.
+	"""
+	filters = {
+		"brand": brand,
+		"model": model,
+		"color": color,
+		"year_min": year_min,
+		"year_max": year_max,
+		"price_min": price_min,
+		"price_max": price_max,
+		"dealer_id": dealer_id,
+	}
+
+	# Быстрый путь: кортежи колонок сразу кодируются в JSON, без моделей Pydantic
+	def produce():
+		try:
+			rows, next_cursor = repo.get_page_rows(filters, sort=sort, cursor=cursor, limit=limit)
+		except ValueError:
+			raise HTTPException(
+				status_code=status.HTTP_400_BAD_REQUEST,
+				detail="Некорректный курсор"
+			)
+		if layout == "columns":
+			return fast_json.dumps({"columns": rows_to_columns(CAR_COLUMN_NAMES, rows), "next_cursor": next_cursor})
+		return fast_json.dumps({"items": rows_to_dicts(CAR_COLUMN_NAMES, rows), "next_cursor": next_cursor})
+
+	return car_response_cache.respond(request, CARS_TABLE, produce)
+
+@router.get("/cars/search", response_model=CarSearchResult)
+def search_cars(
+	request: Request,
+	q: str = Query(..., min_length=1, max_length=200),
+	year_min: Optional[int] = None,
+	year_max: Optional[int] = None,
+	price_min: Optional[float] = None,
+	price_max: Optional[float] = None,
+	dealer_id: Optional[int] = None,
+	cursor: Optional[str] = None,
+	limit: int = Query(20, ge=1, le=100),
+	repo: CarRepository = Depends(get_car_read_repository)
+):
+	"""Полнотекстовый поиск по марке, модели и цвету с фасетами
 
-@app.get("/cars/{car_id}", response_model=Car)
-def get_car(car_id: int, repo: CarRepository = Depends(get_car_repository)):
-	car = repo.get_by_id(car_id)
-	if not car:
+	Слова ищутся по префиксу, слова с опечатками заменяются похожими терминами индекса.
+	Фасеты (марка, десятилетие, ценовой диапазон) возвращаются для первой страницы.
+	"""
+	if not tokenize(q):
 		raise HTTPException(
-			status_code=status.HTTP_404_NOT_FOUND,
-			detail="Автомобиль не найден"
+			status_code=status.HTTP_400_BAD_REQUEST,
+			detail="Пустой поисковый запрос"
 		)
-	return car
+	filters = {
+		"year_min": year_min,
+		"year_max": year_max,
+		"price_min": price_min,
+		"price_max": price_max,
+		"dealer_id": dealer_id,
+	}
+
+	def produce():
+		try:
+			rows, next_cursor, facets, truncated = repo.search(q, filters, cursor=cursor, limit=limit, facets=cursor is None)
+		except ValueError:
+			raise HTTPException(
+				status_code=status.HTTP_400_BAD_REQUEST,
+				detail="Некорректный курсор"
+			)
+		return fast_json.dumps({"items": rows_to_dicts(CAR_COLUMN_NAMES, rows), "next_cursor": next_cursor, "facets": facets, "truncated": truncated})
+
+	return car_response_cache.respond(request, CARS_TABLE, produce)
+
+@router.get("/cars/stats", response_model=CarStats)
+def get_car_stats(
+	request: Request,
+	group_by: str = Query("brand", pattern="^(brand|year|brand_year)$"),
+	brand: Optional[str] = None,
+	year_min: Optional[int] = None,
+	year_max: Optional[int] = None,
+	percentiles: Optional[str] = Query(None, max_length=200),
+	repo: CarRepository = Depends(get_car_read_repository)
+):
+	"""Количество, средняя, минимальная и максимальная цена и стоимость склада по группам
+
+	Считается по сводной таблице car_stats (O(марок x лет)). percentiles=50,90,99 -
+	перцентили цены по колоночному снимку; freshness - актуальность сводки и снимка.
+	"""
+	try:
+		quantiles = parse_percentiles(percentiles) if percentiles else None
+	except ValueError:
+		raise HTTPException(
+			status_code=status.HTTP_400_BAD_REQUEST,
+			detail="Некорректный список перцентилей"
+		)
+	filters = {"brand": brand, "year_min": year_min, "year_max": year_max}
+
+	def produce():
+		return fast_json.dumps(repo.stats(group_by, filters, quantiles))
+
+	return car_response_cache.respond(request, CARS_TABLE, produce)
 
-@app.post("/cars", response_model=Car, status_code=status.HTTP_201_CREATED)
+@router.post("/cars/stats/rebuild", response_model=CarStats)
+def rebuild_car_stats(
+	current_user: Principal = Depends(require_admin),
+	repo: CarRepository = Depends(get_car_repository)
+):
+	"""Полная перестройка сводной таблицы статистики (только для администраторов)"""
+	repo.rebuild_stats()
+	return repo.stats()
+
+@router.post("/cars/bulk", response_model=BulkImportResult)
+async def import_cars_bulk(
+	request: Request,
+	format: Optional[str] = Query(None, pattern="^(ndjson|csv)$"),
+	current_user: Principal = Depends(require_manager_or_admin),
+	repo: CarRepository = Depends(get_car_repository)
+):
+	"""Пакетный импорт автомобилей из потока NDJSON или CSV"""
+	fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+	return await import_cars(
+		iter_lines(request.stream()),
+		fmt,
+		lambda rows: run_in_threadpool(repo.bulk_insert, rows)
+	)
+
+@router.patch("/cars", response_model=CarBatchResult)
+def update_cars(
+	batch: CarBatchUpdate,
+	current_user: Principal = Depends(require_manager_or_admin),
+	repo: CarRepository = Depends(get_car_repository)
+):
+	"""Пакетное обновление автомобилей по списку id и/или фильтру одной транзакцией"""
+	ids = list(dict.fromkeys(batch.ids)) if batch.ids is not None else None
+	filters = batch.filter.model_dump() if batch.filter else None
+	affected = repo.update_many(
+		batch.set.model_dump(exclude_unset=True), ids=ids, filters=filters, price_factor=batch.price_factor
+	)
+	return CarBatchResult.from_affected(ids, affected)
+
+@router.post("/cars/delete", response_model=CarBatchResult)
+def delete_cars(
+	batch: CarBatchDelete,
+	background_tasks: BackgroundTasks,
+	current_user: Principal = Depends(require_manager_or_admin),
+	repo: CarRepository = Depends(get_car_repository)
+):
+	"""Пакетное удаление автомобилей по списку id и/или фильтру одной транзакцией"""
+	ids = list(dict.fromkeys(batch.ids)) if batch.ids is not None else None
+	filters = batch.filter.model_dump() if batch.filter else None
+	result = CarBatchResult.from_affected(ids, repo.delete_many(ids=ids, filters=filters))
+	background_tasks.add_task(collect_orphaned_photos, repo.deleted_photo_digests)
+	return result
+
+@router.get("/cars/export")
+def export_cars(request: Request, format: str = Query("ndjson", pattern="^(ndjson|csv)$")):
+	"""Потоковая выгрузка всех автомобилей в NDJSON или CSV"""
+	primary = prefers_primary(request.cookies)
+
+	def generate():
+		# Собственная сессия: сессия зависимости закрывается до отправки тела ответа
+		db = read_session(primary=primary)
+		try:
+			if format == "csv":
+				yield format_csv([], header=True)
+			repo = sharded_cars if car_shards.enabled else CarRepository(db)
+			for rows in repo.iter_rows(CAR_EXPORT_COLUMNS, EXPORT_BATCH_SIZE):
+				yield format_csv(rows) if format == "csv" else format_ndjson(rows)
+		finally:
+			db.close()
+
+	media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+	return StreamingResponse(generate(), media_type=media_type)
+
+@router.get("/cars/{car_id}", response_model=Car)
+def get_car(car_id: int, request: Request, repo: CarRepository = Depends(get_car_read_repository)):
+	def produce():
+		row = repo.get_row_by_id(car_id)
+		if not row:
+			raise HTTPException(
+				status_code=status.HTTP_404_NOT_FOUND,
+				detail="Автомобиль не найден"
+			)
+		car = dict(zip(CAR_COLUMN_NAMES, row))
+		return fast_json.dumps(car), entity_etag(car["version"])
+
+	return car_response_cache.respond(request, CARS_TABLE, produce, entity=True)
+
+@router.post("/cars", response_model=Car, status_code=status.HTTP_201_CREATED)
 def create_car(car_data: CarCreate, repo: CarRepository = Depends(get_car_repository)):
 	return repo.create(car_data.model_dump())
 
-@app.put("/cars/{car_id}", response_model=Car)
-def update_car(car_id: int, car_data: CarUpdate, repo: CarRepository = Depends(get_car_repository)):
-	car = repo.update(car_id, car_data.model_dump(exclude_unset=True))
+@router.put("/cars/{car_id}", response_model=Car)
+def update_car(
+	car_id: int,
+	car_data: CarUpdate,
+	request: Request,
+	response: Response,
+	repo: CarRepository = Depends(get_car_repository)
+):
+	"""Обновить автомобиль; с If-Match - только если версия строки не изменилась"""
+	try:
+		car = repo.update(car_id, car_data.model_dump(exclude_unset=True), if_match_versions(request))
+	except VersionConflict:
+		raise HTTPException(
+			status_code=status.HTTP_412_PRECONDITION_FAILED,
+			detail="Автомобиль изменен другим запросом"
+		)
 	if not car:
 		raise HTTPException(
 			status_code=status.HTTP_404_NOT_FOUND,
 			detail="Автомобиль не найден"
 		)
+	response.headers["ETag"] = entity_etag(car.version)
 	return car
 
-@app.delete("/cars/{car_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_car(car_id: int, repo: CarRepository = Depends(get_car_repository)):
-	if not repo.delete(car_id):
+@router.delete("/cars/{car_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_car(
+	car_id: int,
+	request: Request,
+	background_tasks: BackgroundTasks,
+	repo: CarRepository = Depends(get_car_repository)
+):
+	try:
+		deleted = repo.delete(car_id, if_match_versions(request))
+	except VersionConflict:
+		raise HTTPException(
+			status_code=status.HTTP_412_PRECONDITION_FAILED,
+			detail="Автомобиль изменен другим запросом"
+		)
+	if not deleted:
 		raise HTTPException(
 			status_code=status.HTTP_404_NOT_FOUND,
 			detail="Автомобиль не найден"
 		)
+	# Файлы фотографий удаленного автомобиля удаляются после ответа
+	background_tasks.add_task(collect_orphaned_photos, repo.deleted_photo_digests)
 	return None
 
 # ========== ЭНДПОИНТЫ АУТЕНТИФИКАЦИИ ==========
 
-@app.post("/auth/login", response_model=Token)
-def login(user_credentials: UserLogin, user_repo: UserRepository = Depends(get_user_repository)):
+@router.post("/auth/login", response_model=Token)
+async def login(request: Request, user_credentials: UserLogin, user_repo: UserRepository = Depends(get_user_repository)):
 	"""Вход в систему"""
-	user = user_repo.authenticate_user(user_credentials.username, user_credentials.password)
+	ip = client_ip(request.scope)
+	# До проверки пароля: перебор не должен расходовать процессор на хеширование
+	await rate_limiter.check_login(user_credentials.username, ip)
+	user = await user_repo.authenticate_user(user_credentials.username, user_credentials.password)
 	if not user:
+		delay = await rate_limiter.login_failed(user_credentials.username, ip)
 		raise HTTPException(
 			status_code=status.HTTP_401_UNAUTHORIZED,
 			detail="Неверное логин или пароль",
-			headers={"WWW-Authenticate": "Bearer"},
+			headers={"WWW-Authenticate": "Bearer", **(retry_after_header(delay) if delay else {})},
 		)
 	
+	await rate_limiter.login_succeeded(user_credentials.username, ip)
 	# Создаем токен
 	access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-	access_token = AuthService.create_access_token(
-		data={"sub": user.username}, expires_delta=access_token_expires
-	)
+	access_token = AuthService.create_user_token(user, expires_delta=access_token_expires)
 	
 	return {"access_token": access_token, "token_type": "bearer"}
 
 
-@app.get("/auth/me", response_model=User)
-def get_current_user_info(current_user: DBUser = Depends(get_current_user)):
+@router.get("/auth/me", response_model=User)
+def get_current_user_info(
+	current_user: Principal = Depends(get_current_user),
+	user_repo: UserRepository = Depends(get_user_read_repository)
+):
 	"""Получение информации о текущем пользователе"""
-	return User(
-		id=current_user.id,
-		username=current_user.username,
-		email=current_user.email,
-		full_name=current_user.full_name,
-		role=current_user.role,
-		is_active=current_user.is_active == "true",
-		created_at=current_user.created_at,
-		updated_at=current_user.updated_at
-	)
+	user = user_repo.get_by_id(current_user.id)
+	if not user:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Пользователь не найден"
+		)
+	return user
 
 
-@app.post("/auth/change-password")
-def change_password(
+@router.post("/auth/change-password")
+async def change_password(
 	password_data: UserChangePassword,
-	current_user: DBUser = Depends(get_current_user),
+	current_user: Principal = Depends(get_current_user),
 	user_repo: UserRepository = Depends(get_user_repository)
 ):
 	"""Смена пароля текущего пользователя"""
-	success = user_repo.change_password(
+	success = await user_repo.change_password(
 		current_user.id, 
 		password_data.current_password, 
 		password_data.new_password
@@ -175,21 +480,31 @@ def change_password(
 		)
 	return {"message": "Пароль изменен"}
 
+@router.post("/auth/logout-all")
+def logout_all(
+	current_user: Principal = Depends(get_current_user),
+	user_repo: UserRepository = Depends(get_user_repository)
+):
+	"""Отзыв всех выданных токенов текущего пользователя"""
+	user_repo.revoke_tokens(current_user.id)
+	return {"message": "Все токены отозваны"}
+
 # ========== ЭНДПОИНТЫ УПРАВЛЕНИЯ ПОЛЬЗОВАТЕЛЯМИ ==========
 
-@app.get("/users", response_model=list[User])
+@router.get("/users", response_model=list[User])
 def get_all_users(
-	current_user: DBUser = Depends(require_manager_or_admin),
-	user_repo: UserRepository = Depends(get_user_repository)
+	current_user: Principal = Depends(require_manager_or_admin),
+	user_repo: UserRepository = Depends(get_user_read_repository)
 ):
 	"""Получить всех пользователей (доступно менеджерам и администраторам)"""
 	return user_repo.get_all()
 
-@app.get("/users/{user_id}", response_model=User)
+@router.get("/users/{user_id}", response_model=User)
 def get_user(
 	user_id: int,
-	current_user: DBUser = Depends(require_manager_or_admin),
-	user_repo: UserRepository = Depends(get_user_repository)
+	response: Response,
+	current_user: Principal = Depends(require_manager_or_admin),
+	user_repo: UserRepository = Depends(get_user_read_repository)
 ):
 	"""Получить пользователя по ID"""
 	user = user_repo.get_by_id(user_id)
@@ -198,53 +513,71 @@ def get_user(
 			status_code=status.HTTP_404_NOT_FOUND,
 			detail="Пользователь не найден"
 		)
+	response.headers["ETag"] = entity_etag(user.version)
 	return user
 
-@app.post("/users", response_model=User, status_code=status.HTTP_201_CREATED)
-def create_user(
+@router.post("/users", response_model=User, status_code=status.HTTP_201_CREATED)
+async def create_user(
 	user_data: UserCreate,
-	current_user: DBUser = Depends(require_admin),
+	current_user: Principal = Depends(require_admin),
 	user_repo: UserRepository = Depends(get_user_repository)
 ):
 	"""Создать нового пользователя (только для администраторов)"""
 	# Проверяем, что пользователь с таким именем не существует
-	if user_repo.get_by_username(user_data.username):
+	if await run_in_threadpool(user_repo.get_by_username, user_data.username):
 		raise HTTPException(
 			status_code=status.HTTP_400_BAD_REQUEST,
 			detail="Пользователь с таким именем существует"
 		)
 	# Проверяем, что пользователь с таким email не существует
-	if user_repo.get_by_email(user_data.email):
+	if await run_in_threadpool(user_repo.get_by_email, user_data.email):
 		raise HTTPException(
 			status_code=status.HTTP_400_BAD_REQUEST,
 			detail="Такой email уже занят"
 		)    
-	return user_repo.create(user_data.model_dump())
+	return await user_repo.create_with_password(user_data.model_dump())
 
-@app.put("/users/{user_id}", response_model=User)
+@router.put("/users/{user_id}", response_model=User)
 def update_user(
 	user_id: int,
 	user_data: UserUpdate,
-	current_user: DBUser = Depends(require_admin),
+	request: Request,
+	response: Response,
+	current_user: Principal = Depends(require_admin),
 	user_repo: UserRepository = Depends(get_user_repository)
 ):
 	"""Обновить пользователя (только для администраторов)"""
-	user = user_repo.update(user_id, user_data.model_dump(exclude_unset=True))
+	try:
+		user = user_repo.update(user_id, user_data.model_dump(exclude_unset=True), if_match_versions(request))
+	except VersionConflict:
+		raise HTTPException(
+			status_code=status.HTTP_412_PRECONDITION_FAILED,
+			detail="Пользователь изменен другим запросом"
+		)
 	if not user:
 		raise HTTPException(
 			status_code=status.HTTP_404_NOT_FOUND,
 			detail="Пользователь не найден"
 		)
+	response.headers["ETag"] = entity_etag(user.version)
 	return user
 
-@app.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
+@router.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete_user(
 	user_id: int,
-	current_user: DBUser = Depends(require_admin),
+	request: Request,
+	current_user: Principal = Depends(require_admin),
 	user_repo: UserRepository = Depends(get_user_repository)
 ):
 	"""Удалить пользователя (только для администраторов)"""
-	if not user_repo.delete(user_id):
+	try:
+		deleted = user_repo.delete(user_id, if_match_versions(request))
+	except VersionConflict:
+		raise HTTPException(
+			status_code=status.HTTP_412_PRECONDITION_FAILED,
+			detail="Пользователь изменен другим запросом"
+		)
+	if not deleted:
 		raise HTTPException(
 			status_code=status.HTTP_404_NOT_FOUND,
 			detail="Пользователь не найден"
@@ -252,7 +585,111 @@ def delete_user(
 	return None
 
 
+# ========== ФОТОГРАФИИ АВТОМОБИЛЕЙ ==========
+# Общие для обоих режимов БД: файлы и пул миниатюр синхронные, а метаданные читаются короткими запросами
+
+@app.post("/cars/{car_id}/photos", response_model=CarPhoto, status_code=status.HTTP_201_CREATED)
+async def upload_car_photo(
+	car_id: int,
+	request: Request,
+	current_user: Principal = Depends(require_manager_or_admin)
+):
+	"""Загрузить фотографию: тело запроса - файл JPEG, PNG, GIF или WebP (без multipart)"""
+	content_length = request.headers.get("content-length", "")
+	if content_length.isdigit() and int(content_length) > MEDIA_MAX_UPLOAD_BYTES:
+		raise HTTPException(
+			status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+			detail=f"Файл больше {MEDIA_MAX_UPLOAD_BYTES} байт"
+		)
+	if not await run_in_threadpool(car_exists, car_id):
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Автомобиль не найден"
+		)
+	try:
+		upload = await blob_store.receive(request.stream())
+	except UploadRejected as e:
+		raise HTTPException(status_code=e.status_code, detail=e.detail)
+	photo = await run_in_threadpool(create_photo, car_id, upload)
+	if photo is None:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Автомобиль не найден"
+		)
+	return photo
+
+@app.get("/cars/{car_id}/photos", response_model=List[CarPhoto])
+def list_car_photos(car_id: int, db: Session = Depends(get_read_db)):
+	"""Фотографии автомобиля в порядке загрузки"""
+	repo = PhotoRepository(db)
+	photos = repo.list(car_id)
+	if not photos and not repo.car_exists(car_id):
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Автомобиль не найден"
+		)
+	return photos
+
+@app.get("/cars/{car_id}/photos/{photo_id}", response_class=Response)
+def get_car_photo(car_id: int, photo_id: int, request: Request, db: Session = Depends(get_read_db)):
+	"""Файл фотографии (Range, If-None-Match)"""
+	photo = PhotoRepository(db).get(car_id, photo_id)
+	response = photo_response(request, photo) if photo else None
+	if response is None:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Фотография не найдена"
+		)
+	return response
+
+@app.get("/cars/{car_id}/photos/{photo_id}/thumbnail", response_class=Response)
+def get_car_photo_thumbnail(car_id: int, photo_id: int, request: Request, db: Session = Depends(get_read_db)):
+	"""Миниатюра фотографии (JPEG); 404, пока она строится"""
+	photo = PhotoRepository(db).get(car_id, photo_id)
+	if not photo:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Фотография не найдена"
+		)
+	if photo.thumbnail == THUMBNAIL_PENDING:
+		# Задача могла потеряться при перезапуске воркера; повторная постановка в очередь не дублирует ее
+		schedule_thumbnail(photo.digest)
+	response = photo_response(request, photo, thumbnail=True) if photo.thumbnail == THUMBNAIL_READY else None
+	if response is None:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Миниатюра не готова"
+		)
+	return response
+
+@app.delete("/cars/{car_id}/photos/{photo_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_car_photo(
+	car_id: int,
+	photo_id: int,
+	background_tasks: BackgroundTasks,
+	current_user: Principal = Depends(require_manager_or_admin),
+	db: Session = Depends(get_db)
+):
+	"""Удалить фотографию; файл удаляется после ответа, если на него не ссылаются другие фотографии"""
+	digest = PhotoRepository(db).delete(car_id, photo_id)
+	if digest is None:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Фотография не найдена"
+		)
+	background_tasks.add_task(release_blobs, [digest])
+	return None
+
+
+if DB_MODE == "async":
+	from async_routes import router as async_router
+	app.include_router(async_router)
+else:
+	app.include_router(router)
 
 
 if __name__ == "__main__":
+	import uvicorn
+
+	# Один процесс для разработки; несколько воркеров - python serve.py
 	uvicorn.run(app, host="0.0.0.0", port=8000)
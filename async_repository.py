@@ -0,0 +1,420 @@
+from typing import AsyncIterator, List, Optional, Tuple
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from models import Car, User, UserRole
+from database import DBCar, DBCarPhoto, DBUser
+from auth import revoke_user_tokens
+from hashing import password_hasher
+from response_cache import CARS_TABLE, table_versions
+from change_feed import car_changes
+from fast_json import rows_to_columns
+from repository import (
+    CAR_COLUMN_NAMES, CAR_COLUMNS, CarRepository, ShardedCarRepository, UserRepository, build_car_batch_update,
+    build_car_facets_query, build_car_page_query, build_car_search_query,
+    car_batch_criteria, car_photo_criteria, order_rows_by_ids, page_search_candidates, split_car_page, trim_search_candidates,
+    PRICE_SNAPSHOT_QUERY, add_price_percentiles, group_snapshot_prices, build_car_stats_freshness_query, build_car_stats_query,
+    car_stats_result, car_from_row, catalog_page_rows, sharded_cars,
+    USER_COLUMNS, VersionConflict, build_versioned_delete, build_versioned_update, user_from_row, user_update_values,
+)
+from catalog import car_catalog
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from stats import car_price_snapshot, rebuild_car_stats
+from search import VOCABULARY_QUERY, build_match, car_search_vocabulary, collect_facets, facet_cache, facet_cache_key, tokenize
+
+
+async def execute_returning(db: AsyncSession, stmt, columns: list, model, row_id: int):
+    """Асинхронный вариант repository.execute_returning"""
+    if db.get_bind().dialect.update_returning:
+        return (await db.execute(stmt.returning(*columns))).first()
+    if (await db.execute(stmt)).rowcount == 0:
+        return None
+    return (await db.execute(select(*columns).where(model.id == row_id))).first()
+
+
+async def check_conflict(db: AsyncSession, model, row_id: int, expected_versions: Optional[List[int]]) -> None:
+    """Асинхронный вариант repository.check_conflict"""
+    if expected_versions is not None and (await db.execute(select(model.id).where(model.id == row_id))).first():
+        raise VersionConflict(row_id)
+
+
+class AsyncCarRepository:
+    """Асинхронный репозиторий для работы с автомобилями (AsyncSession)"""
+
+    _convert_to_pydantic = CarRepository._convert_to_pydantic
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+        # См. CarRepository.deleted_photo_digests
+        self.deleted_photo_digests: List[str] = []
+
+    async def get_all(self) -> List[Car]:
+        """Получить все автомобили"""
+        result = await self.db.execute(select(DBCar))
+        return [self._convert_to_pydantic(car) for car in result.scalars()]
+
+    async def get_page(
+        self,
+        filters: Optional[dict] = None,
+        sort: str = "id",
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[List[Car], Optional[str]]:
+        """Получить страницу автомобилей по курсору (см. CarRepository.get_page)"""
+        if car_catalog.enabled:
+            rows, next_cursor = await run_in_threadpool(catalog_page_rows, filters, sort, cursor, limit)
+            return [car_from_row(row) for row in rows], next_cursor
+        stmt, key_columns = build_car_page_query(filters, sort, cursor, limit)
+        result = await self.db.execute(stmt)
+        return split_car_page(result.scalars().all(), key_columns, limit, self._convert_to_pydantic)
+
+    async def get_page_rows(
+        self,
+        filters: Optional[dict] = None,
+        sort: str = "id",
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[List[tuple], Optional[str]]:
+        """Страница автомобилей кортежами в порядке CAR_COLUMN_NAMES (без ORM и Pydantic)"""
+        if car_catalog.enabled:
+            # Синхронизация каталога обращается к БД синхронным движком - в пуле потоков
+            return await run_in_threadpool(catalog_page_rows, filters, sort, cursor, limit)
+        stmt, key_columns = build_car_page_query(filters, sort, cursor, limit, columns=CAR_COLUMNS)
+        result = await self.db.execute(stmt)
+        return split_car_page(result.all(), key_columns, limit, tuple)
+
+    async def get_page_columns(
+        self,
+        filters: Optional[dict] = None,
+        sort: str = "id",
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[dict, Optional[str]]:
+        """Страница автомобилей в колоночном виде {колонка: [значения]}"""
+        rows, next_cursor = await self.get_page_rows(filters, sort, cursor, limit)
+        return rows_to_columns(CAR_COLUMN_NAMES, rows), next_cursor
+
+    async def search(
+        self,
+        query: str,
+        filters: Optional[dict] = None,
+        cursor: Optional[str] = None,
+        limit: int = 20,
+        facets: bool = True,
+    ) -> Tuple[List[tuple], Optional[str], Optional[dict], bool]:
+        """Полнотекстовый поиск автомобилей (см. CarRepository.search)"""
+        tokens = tokenize(query)
+        if not tokens:
+            raise ValueError("Empty search query")
+        version = table_versions.get(CARS_TABLE)
+        if car_search_vocabulary.is_stale(version):
+            car_search_vocabulary.load((await self.db.execute(VOCABULARY_QUERY)).scalars(), version)
+        terms = car_search_vocabulary.expand(tokens)
+        match = build_match(terms)
+
+        candidates, truncated = trim_search_candidates((await self.db.execute(build_car_search_query(match, filters))).all())
+        ids, next_cursor = page_search_candidates(terms, candidates, cursor, limit)
+        result = await self.db.execute(select(*CAR_COLUMNS).where(DBCar.id.in_(ids)))
+        rows = order_rows_by_ids(result.all(), ids)
+        facet_counts = None
+        if facets:
+            key = facet_cache_key(match, filters or {}, version)
+            facet_counts = facet_cache.get(key)
+            if facet_counts is None:
+                facet_counts = collect_facets(await self.db.execute(build_car_facets_query(match, filters)))
+                facet_cache.set(key, facet_counts)
+        return rows, next_cursor, facet_counts, truncated
+
+    async def stats(
+        self,
+        group_by: str = "brand",
+        filters: Optional[dict] = None,
+        percentiles: Optional[List[float]] = None,
+    ) -> dict:
+        """Статистика по сводке car_stats (см. CarRepository.stats)"""
+        rows = (await self.db.execute(build_car_stats_query(group_by, filters))).all()
+        freshness = (await self.db.execute(build_car_stats_freshness_query())).one()
+        result = car_stats_result(group_by, rows, freshness, self.db.get_bind().dialect)
+        if not percentiles:
+            return result
+        version = table_versions.get(CARS_TABLE)
+        if car_price_snapshot.is_stale(version):
+            car_price_snapshot.load(group_snapshot_prices(await self.db.execute(PRICE_SNAPSHOT_QUERY)), version)
+        return add_price_percentiles(result, percentiles, filters)
+
+    async def rebuild_stats(self) -> None:
+        """Полная перестройка сводки car_stats"""
+        try:
+            await self.db.run_sync(lambda session: rebuild_car_stats(session.connection()))
+            await self.db.commit()
+        except Exception:
+            await self.db.rollback()
+            raise
+        await run_in_threadpool(table_versions.bump, CARS_TABLE)
+
+    async def get_by_id(self, car_id: int) -> Optional[Car]:
+        """Получить автомобиль по его id"""
+        if car_catalog.enabled:
+            row = await run_in_threadpool(car_catalog.get_row, car_id)
+            return car_from_row(row) if row else None
+        db_car = await self.db.get(DBCar, car_id)
+        return self._convert_to_pydantic(db_car) if db_car else None
+
+    async def get_row_by_id(self, car_id: int) -> Optional[tuple]:
+        """Автомобиль кортежем в порядке CAR_COLUMN_NAMES"""
+        if car_catalog.enabled:
+            return await run_in_threadpool(car_catalog.get_row, car_id)
+        result = await self.db.execute(select(*CAR_COLUMNS).where(DBCar.id == car_id))
+        row = result.first()
+        return tuple(row) if row else None
+
+    async def create(self, car_data: dict) -> Car:
+        """Создать автомобиль"""
+        db_car = DBCar(**car_data)
+        self.db.add(db_car)
+        await self.db.commit()
+        await run_in_threadpool(table_versions.bump, CARS_TABLE)
+        await self.db.refresh(db_car)
+        car = self._convert_to_pydantic(db_car)
+        car_changes.publish("upsert", cars=[car.model_dump(mode="json")])
+        return car
+
+    async def update(self, car_id: int, car_data: dict, expected_versions: Optional[List[int]] = None) -> Optional[Car]:
+        """Обновить автомобиль одним UPDATE ... RETURNING (см. CarRepository.update)"""
+        stmt = build_versioned_update(DBCar, car_id, car_data, expected_versions)
+        row = await execute_returning(self.db, stmt, CAR_COLUMNS, DBCar, car_id)
+        if row is None:
+            await self.db.rollback()
+            await check_conflict(self.db, DBCar, car_id, expected_versions)
+            return None
+        await self.db.commit()
+        await run_in_threadpool(table_versions.bump, CARS_TABLE)
+        car = car_from_row(row)
+        car_changes.publish("upsert", cars=[car.model_dump(mode="json")])
+        return car
+
+    async def delete(self, car_id: int, expected_versions: Optional[List[int]] = None) -> bool:
+        """Удалить автомобиль одним DELETE (см. CarRepository.update)"""
+        if (await self.db.execute(build_versioned_delete(DBCar, car_id, expected_versions))).rowcount == 0:
+            await self.db.rollback()
+            await check_conflict(self.db, DBCar, car_id, expected_versions)
+            return False
+        await self._delete_photos([car_id])
+        await self.db.commit()
+        car_changes.publish("delete", ids=[car_id])
+        await run_in_threadpool(table_versions.bump, CARS_TABLE)
+        return True
+
+    async def bulk_insert(self, rows: List[dict]) -> int:
+        """Вставить пакет автомобилей одной транзакцией (executemany)"""
+        if not rows:
+            return 0
+        try:
+            await self.db.execute(insert(DBCar), rows)
+            await self.db.commit()
+            await run_in_threadpool(table_versions.bump, CARS_TABLE)
+            car_changes.publish("reload")
+        except Exception:
+            await self.db.rollback()
+            raise
+        return len(rows)
+
+    async def update_many(
+        self,
+        values: dict,
+        ids: Optional[List[int]] = None,
+        filters: Optional[dict] = None,
+        price_factor: Optional[float] = None,
+    ) -> List[int]:
+        """Обновить автомобили по списку id и/или фильтру одной транзакцией; возвращает id"""
+        stmt = build_car_batch_update(values, price_factor)
+        affected = await self._run_batch(stmt, ids, filters, self.db.get_bind().dialect.update_returning)
+        if affected:
+            await run_in_threadpool(table_versions.bump, CARS_TABLE)
+            car_changes.publish("update", ids=affected)
+        return affected
+
+    async def delete_many(self, ids: Optional[List[int]] = None, filters: Optional[dict] = None) -> List[int]:
+        """Удалить автомобили по списку id и/или фильтру одной транзакцией; возвращает id"""
+        affected = await self._run_batch(delete(DBCar), ids, filters, self.db.get_bind().dialect.delete_returning)
+        if affected:
+            car_changes.publish("delete", ids=affected)
+            await run_in_threadpool(table_versions.bump, CARS_TABLE)
+        return affected
+
+    async def _run_batch(self, stmt, ids: Optional[List[int]], filters: Optional[dict], returning: bool) -> List[int]:
+        """Выполнение UPDATE/DELETE порциями в одной транзакции (см. CarRepository._run_batch)"""
+        affected = []
+        try:
+            for criteria in car_batch_criteria(ids, filters):
+                if returning:
+                    result = await self.db.execute(
+                        stmt.where(*criteria).returning(DBCar.id),
+                        execution_options={"synchronize_session": False},
+                    )
+                    affected += result.scalars().all()
+                else:
+                    affected += (await self.db.execute(select(DBCar.id).where(*criteria))).scalars().all()
+                    await self.db.execute(stmt.where(*criteria), execution_options={"synchronize_session": False})
+            if stmt.is_delete:
+                await self._delete_photos(affected)
+            await self.db.commit()
+        except Exception:
+            await self.db.rollback()
+            raise
+        return affected
+
+    async def _delete_photos(self, car_ids: List[int]) -> None:
+        """Строки фотографий удаляемых автомобилей в текущей транзакции (см. car_photo_criteria)"""
+        for criteria in car_photo_criteria(car_ids):
+            self.deleted_photo_digests += (await self.db.execute(select(DBCarPhoto.digest).where(criteria))).scalars().all()
+            await self.db.execute(delete(DBCarPhoto).where(criteria))
+
+    async def iter_rows(self, columns: List[str], batch_size: int) -> AsyncIterator[List[tuple]]:
+        """Все автомобили порциями кортежей через серверный курсор (yield_per)"""
+        stmt = (
+            select(*[getattr(DBCar, name) for name in columns])
+            .order_by(DBCar.id)
+            .execution_options(yield_per=batch_size)
+        )
+        result = await self.db.stream(stmt)
+        async for partition in result.partitions():
+            yield partition
+
+
+class AsyncShardedCarRepository:
+    """Интерфейс AsyncCarRepository для шардов (sharding.py)
+
+    Запросы к шардам выполняет синхронный ShardedCarRepository в пуле потоков:
+    шарды опрашиваются параллельно его собственным пулом.
+    """
+
+    deleted_photo_digests = ShardedCarRepository.deleted_photo_digests
+
+    def __getattr__(self, name: str):
+        method = getattr(sharded_cars, name)
+
+        async def call(*args, **kwargs):
+            return await run_in_threadpool(method, *args, **kwargs)
+        return call
+
+    def iter_rows(self, columns: List[str], batch_size: int) -> AsyncIterator[List[tuple]]:
+        """Все автомобили порциями кортежей (см. ShardedCarRepository.iter_rows)"""
+        return iterate_in_threadpool(sharded_cars.iter_rows(columns, batch_size))
+
+
+class AsyncUserRepository:
+    """Асинхронный репозиторий для работы с пользователями (AsyncSession)"""
+
+    _convert_to_pydantic = UserRepository._convert_to_pydantic
+
+    def __init__(self, db: AsyncSession):
+        self.db = db
+
+    async def get_all(self) -> List[User]:
+        """Получить всех пользователей"""
+        result = await self.db.execute(select(DBUser))
+        return [self._convert_to_pydantic(user) for user in result.scalars()]
+
+    async def get_by_id(self, user_id: int) -> Optional[User]:
+        """Получить пользователя по ID"""
+        db_user = await self.db.get(DBUser, user_id)
+        return self._convert_to_pydantic(db_user) if db_user else None
+
+    async def get_by_username(self, username: str) -> Optional[DBUser]:
+        """Получить пользователя по имени (для аутентификации)"""
+        result = await self.db.execute(select(DBUser).where(DBUser.username == username))
+        return result.scalars().first()
+
+    async def get_by_email(self, email: str) -> Optional[DBUser]:
+        """Получить пользователя по email"""
+        result = await self.db.execute(select(DBUser).where(DBUser.email == email))
+        return result.scalars().first()
+
+    async def create(self, user_data: dict) -> User:
+        """Создать нового пользователя (пароль хешируется в пуле процессов)"""
+        user_data = dict(user_data)
+        if 'password' in user_data:
+            user_data['hashed_password'] = await password_hasher.hash(user_data.pop('password'))
+
+        db_user = DBUser(**user_data)
+        self.db.add(db_user)
+        await self.db.commit()
+        await self.db.refresh(db_user)
+        return self._convert_to_pydantic(db_user)
+
+    async def update(self, user_id: int, user_data: dict, expected_versions: Optional[List[int]] = None) -> Optional[User]:
+        """Обновить пользователя одним UPDATE ... RETURNING (см. CarRepository.update)"""
+        user_data = dict(user_data)
+        if 'password' in user_data:
+            user_data['hashed_password'] = await password_hasher.hash(user_data.pop('password'))
+
+        values = user_update_values(user_data)
+        stmt = build_versioned_update(DBUser, user_id, values, expected_versions)
+        row = await execute_returning(self.db, stmt, USER_COLUMNS, DBUser, user_id)
+        if row is None:
+            await self.db.rollback()
+            await check_conflict(self.db, DBUser, user_id, expected_versions)
+            return None
+        await self.db.commit()
+        if "token_version" in values:
+            revoke_user_tokens(user_id)
+        return user_from_row(row)
+
+    async def delete(self, user_id: int, expected_versions: Optional[List[int]] = None) -> bool:
+        """Удалить пользователя одним DELETE (см. CarRepository.update)"""
+        if (await self.db.execute(build_versioned_delete(DBUser, user_id, expected_versions))).rowcount == 0:
+            await self.db.rollback()
+            await check_conflict(self.db, DBUser, user_id, expected_versions)
+            return False
+        await self.db.commit()
+        revoke_user_tokens(user_id)
+        return True
+
+    async def revoke_tokens(self, user_id: int) -> bool:
+        """Отозвать все токены пользователя"""
+        db_user = await self.db.get(DBUser, user_id)
+        if not db_user:
+            return False
+        db_user.token_version = (db_user.token_version or 0) + 1
+        await self.db.commit()
+        revoke_user_tokens(user_id)
+        return True
+
+    async def authenticate_user(self, username: str, password: str) -> Optional[DBUser]:
+        """Аутентификация пользователя"""
+        user = await self.get_by_username(username)
+        if not user:
+            return None
+        valid, new_hash = await password_hasher.verify(password, user.hashed_password)
+        if not valid:
+            return None
+        if new_hash:
+            await self._store_password_hash(user, new_hash)
+        return user
+
+    async def change_password(self, user_id: int, current_password: str, new_password: str) -> bool:
+        """Смена пароля пользователя"""
+        db_user = await self.db.get(DBUser, user_id)
+        if not db_user:
+            return False
+
+        valid, _ = await password_hasher.verify(current_password, db_user.hashed_password)
+        if not valid:
+            return False
+
+        await self._store_password_hash(db_user, await password_hasher.hash(new_password), revoke_tokens=True)
+        return True
+
+    async def get_users_by_role(self, role: UserRole) -> List[User]:
+        """Получить пользователей по роли"""
+        result = await self.db.execute(select(DBUser).where(DBUser.role == role))
+        return [self._convert_to_pydantic(user) for user in result.scalars()]
+
+    async def _store_password_hash(self, db_user: DBUser, hashed_password: str, revoke_tokens: bool = False) -> None:
+        """Сохранить новый хеш пароля; при смене пароля выданные токены отзываются"""
+        db_user.hashed_password = hashed_password
+        if revoke_tokens:
+            db_user.token_version = (db_user.token_version or 0) + 1
+        await self.db.commit()
+        if revoke_tokens:
+            revoke_user_tokens(db_user.id)
@@ -0,0 +1,438 @@
+from datetime import timedelta
+from typing import Optional
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request, status
+from fastapi.responses import Response, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from async_repository import AsyncCarRepository, AsyncShardedCarRepository, AsyncUserRepository
+from auth import AuthService, get_current_user_async, require_admin_async, require_manager_or_admin_async, ACCESS_TOKEN_EXPIRE_MINUTES
+from bulk import CAR_EXPORT_COLUMNS, EXPORT_BATCH_SIZE, format_csv, format_ndjson, import_cars, iter_lines
+from database import get_async_db, get_async_session_factory
+from ratelimit import client_ip, rate_limiter, retry_after_header
+from models import BulkImportResult, Car, CarBatchResult, CarPage, CarSearchResult, CarStats, Principal, Token, User, UserChangePassword, UserCreate, UserLogin, UserUpdate
+from response_cache import CARS_TABLE, car_response_cache, entity_etag, if_match_versions
+import fast_json
+from fast_json import rows_to_columns, rows_to_dicts
+from media import collect_orphaned_photos
+from repository import CAR_COLUMN_NAMES, VersionConflict
+from sharding import car_shards
+from schemas import CarBatchDelete, CarBatchUpdate, CarCreate, CarUpdate
+from search import tokenize
+from stats import parse_percentiles
+
+# Асинхронные версии эндпоинтов, работающих с БД (DB_MODE=async)
+router = APIRouter()
+
+
+def get_car_repository(db: AsyncSession = Depends(get_async_db)):
+	"""Получение асинхронного репозитория автомобилей (при шардировании - общий для всех шардов)"""
+	return AsyncShardedCarRepository() if car_shards.enabled else AsyncCarRepository(db)
+
+def get_user_repository(db: AsyncSession = Depends(get_async_db)):
+	"""Получение асинхронного репозитория пользователей"""
+	return AsyncUserRepository(db)
+
+
+# ========== ЭНДПОИНТЫ АВТОМОБИЛЕЙ  ==========
+
+@router.get("/cars", response_model=CarPage)
+async def get_all_cars(
+	request: Request,
+	brand: Optional[str] = None,
+	model: Optional[str] = None,
+	color: Optional[str] = None,
+	year_min: Optional[int] = None,
+	year_max: Optional[int] = None,
+	price_min: Optional[float] = None,
+	price_max: Optional[float] = None,
+	dealer_id: Optional[int] = None,
+	sort: str = Query("id", pattern="^-?(id|price|year)$"),
+	cursor: Optional[str] = None,
+	limit: int = Query(50, ge=1, le=500),
+	layout: str = Query("rows", pattern="^(rows|columns)$"),
+	repo: AsyncCarRepository = Depends(get_car_repository)
+):
+	"""Страница автомобилей с фильтрами; следующая страница - по next_cursor
+
+	layout=columns возвращает страницу в колоночном виде {"columns": {колонка: [значения]}}.
+	"""
+	filters = {
+		"brand": brand,
+		"model": model,
+		"color": color,
+		"year_min": year_min,
+		"year_max": year_max,
+		"price_min": price_min,
+		"price_max": price_max,
+		"dealer_id": dealer_id,
+	}
+
+	# Быстрый путь: кортежи колонок сразу кодируются в JSON, без моделей Pydantic
+	async def produce():
+		try:
+			rows, next_cursor = await repo.get_page_rows(filters, sort=sort, cursor=cursor, limit=limit)
+		except ValueError:
+			raise HTTPException(
+				status_code=status.HTTP_400_BAD_REQUEST,
+				detail="Некорректный курсор"
+			)
+		if layout == "columns":
+			return fast_json.dumps({"columns": rows_to_columns(CAR_COLUMN_NAMES, rows), "next_cursor": next_cursor})
+		return fast_json.dumps({"items": rows_to_dicts(CAR_COLUMN_NAMES, rows), "next_cursor": next_cursor})
+
+	return await car_response_cache.respond_async(request, CARS_TABLE, produce)
+
+@router.get("/cars/search", response_model=CarSearchResult)
+async def search_cars(
+	request: Request,
+	q: str = Query(..., min_length=1, max_length=200),
+	year_min: Optional[int] = None,
+	year_max: Optional[int] = None,
+	price_min: Optional[float] = None,
+	price_max: Optional[float] = None,
+	dealer_id: Optional[int] = None,
+	cursor: Optional[str] = None,
+	limit: int = Query(20, ge=1, le=100),
+	repo: AsyncCarRepository = Depends(get_car_repository)
+):
+	"""Полнотекстовый поиск по марке, модели и цвету с фасетами
+
+	Слова ищутся по префиксу, слова с опечатками заменяются похожими терминами индекса.
+	Фасеты (марка, десятилетие, ценовой диапазон) возвращаются для первой страницы.
+	"""
+	if not tokenize(q):
+		raise HTTPException(
+			status_code=status.HTTP_400_BAD_REQUEST,
+			detail="Пустой поисковый запрос"
+		)
+	filters = {
+		"year_min": year_min,
+		"year_max": year_max,
+		"price_min": price_min,
+		"price_max": price_max,
+		"dealer_id": dealer_id,
+	}
+
+	async def produce():
+		try:
+			rows, next_cursor, facets, truncated = await repo.search(q, filters, cursor=cursor, limit=limit, facets=cursor is None)
+		except ValueError:
+			raise HTTPException(
+				status_code=status.HTTP_400_BAD_REQUEST,
+				detail="Некорректный курсор"
+			)
+		return fast_json.dumps({"items": rows_to_dicts(CAR_COLUMN_NAMES, rows), "next_cursor": next_cursor, "facets": facets, "truncated": truncated})
+
+	return await car_response_cache.respond_async(request, CARS_TABLE, produce)
+
+@router.get("/cars/stats", response_model=CarStats)
+async def get_car_stats(
+	request: Request,
+	group_by: str = Query("brand", pattern="^(brand|year|brand_year)$"),
+	brand: Optional[str] = None,
+	year_min: Optional[int] = None,
+	year_max: Optional[int] = None,
+	percentiles: Optional[str] = Query(None, max_length=200),
+	repo: AsyncCarRepository = Depends(get_car_repository)
+):
+	"""Количество, средняя, минимальная и максимальная цена и стоимость склада по группам
+
+	Считается по сводной таблице car_stats (O(марок x лет)). percentiles=50,90,99 -
+	перцентили цены по колоночному снимку; freshness - актуальность сводки и снимка.
+	"""
+	try:
+		quantiles = parse_percentiles(percentiles) if percentiles else None
+	except ValueError:
+		raise HTTPException(
+			status_code=status.HTTP_400_BAD_REQUEST,
+			detail="Некорректный список перцентилей"
+		)
+	filters = {"brand": brand, "year_min": year_min, "year_max": year_max}
+
+	async def produce():
+		return fast_json.dumps(await repo.stats(group_by, filters, quantiles))
+
+	return await car_response_cache.respond_async(request, CARS_TABLE, produce)
+
+@router.post("/cars/stats/rebuild", response_model=CarStats)
+async def rebuild_car_stats(
+	current_user: Principal = Depends(require_admin_async),
+	repo: AsyncCarRepository = Depends(get_car_repository)
+):
+	"""Полная перестройка сводной таблицы статистики (только для администраторов)"""
+	await repo.rebuild_stats()
+	return await repo.stats()
+
+@router.post("/cars/bulk", response_model=BulkImportResult)
+async def import_cars_bulk(
+	request: Request,
+	format: Optional[str] = Query(None, pattern="^(ndjson|csv)$"),
+	current_user: Principal = Depends(require_manager_or_admin_async),
+	repo: AsyncCarRepository = Depends(get_car_repository)
+):
+	"""Пакетный импорт автомобилей из потока NDJSON или CSV"""
+	fmt = format or ("csv" if "csv" in request.headers.get("content-type", "") else "ndjson")
+	return await import_cars(iter_lines(request.stream()), fmt, repo.bulk_insert)
+
+@router.patch("/cars", response_model=CarBatchResult)
+async def update_cars(
+	batch: CarBatchUpdate,
+	current_user: Principal = Depends(require_manager_or_admin_async),
+	repo: AsyncCarRepository = Depends(get_car_repository)
+):
+	"""Пакетное обновление автомобилей по списку id и/или фильтру одной транзакцией"""
+	ids = list(dict.fromkeys(batch.ids)) if batch.ids is not None else None
+	filters = batch.filter.model_dump() if batch.filter else None
+	affected = await repo.update_many(
+		batch.set.model_dump(exclude_unset=True), ids=ids, filters=filters, price_factor=batch.price_factor
+	)
+	return CarBatchResult.from_affected(ids, affected)
+
+@router.post("/cars/delete", response_model=CarBatchResult)
+async def delete_cars(
+	batch: CarBatchDelete,
+	background_tasks: BackgroundTasks,
+	current_user: Principal = Depends(require_manager_or_admin_async),
+	repo: AsyncCarRepository = Depends(get_car_repository)
+):
+	"""Пакетное удаление автомобилей по списку id и/или фильтру одной транзакцией"""
+	ids = list(dict.fromkeys(batch.ids)) if batch.ids is not None else None
+	filters = batch.filter.model_dump() if batch.filter else None
+	result = CarBatchResult.from_affected(ids, await repo.delete_many(ids=ids, filters=filters))
+	background_tasks.add_task(collect_orphaned_photos, repo.deleted_photo_digests)
+	return result
+
+@router.get("/cars/export")
+async def export_cars(format: str = Query("ndjson", pattern="^(ndjson|csv)$")):
+	"""Потоковая выгрузка всех автомобилей в NDJSON или CSV"""
+	async def generate():
+		# Собственная сессия: сессия зависимости закрывается до отправки тела ответа
+		async with get_async_session_factory()() as db:
+			if format == "csv":
+				yield format_csv([], header=True)
+			repo = AsyncShardedCarRepository() if car_shards.enabled else AsyncCarRepository(db)
+			async for rows in repo.iter_rows(CAR_EXPORT_COLUMNS, EXPORT_BATCH_SIZE):
+				yield format_csv(rows) if format == "csv" else format_ndjson(rows)
+
+	media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+	return StreamingResponse(generate(), media_type=media_type)
+
+@router.get("/cars/{car_id}", response_model=Car)
+async def get_car(car_id: int, request: Request, repo: AsyncCarRepository = Depends(get_car_repository)):
+	async def produce():
+		row = await repo.get_row_by_id(car_id)
+		if not row:
+			raise HTTPException(
+				status_code=status.HTTP_404_NOT_FOUND,
+				detail="Автомобиль не найден"
+			)
+		car = dict(zip(CAR_COLUMN_NAMES, row))
+		return fast_json.dumps(car), entity_etag(car["version"])
+
+	return await car_response_cache.respond_async(request, CARS_TABLE, produce, entity=True)
+
+@router.post("/cars", response_model=Car, status_code=status.HTTP_201_CREATED)
+async def create_car(car_data: CarCreate, repo: AsyncCarRepository = Depends(get_car_repository)):
+	return await repo.create(car_data.model_dump())
+
+@router.put("/cars/{car_id}", response_model=Car)
+async def update_car(
+	car_id: int,
+	car_data: CarUpdate,
+	request: Request,
+	response: Response,
+	repo: AsyncCarRepository = Depends(get_car_repository)
+):
+	"""Обновить автомобиль; с If-Match - только если версия строки не изменилась"""
+	try:
+		car = await repo.update(car_id, car_data.model_dump(exclude_unset=True), if_match_versions(request))
+	except VersionConflict:
+		raise HTTPException(
+			status_code=status.HTTP_412_PRECONDITION_FAILED,
+			detail="Автомобиль изменен другим запросом"
+		)
+	if not car:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Автомобиль не найден"
+		)
+	response.headers["ETag"] = entity_etag(car.version)
+	return car
+
+@router.delete("/cars/{car_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_car(
+	car_id: int,
+	request: Request,
+	background_tasks: BackgroundTasks,
+	repo: AsyncCarRepository = Depends(get_car_repository)
+):
+	try:
+		deleted = await repo.delete(car_id, if_match_versions(request))
+	except VersionConflict:
+		raise HTTPException(
+			status_code=status.HTTP_412_PRECONDITION_FAILED,
+			detail="Автомобиль изменен другим запросом"
+		)
+	if not deleted:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Автомобиль не найден"
+		)
+	# Файлы фотографий удаленного автомобиля удаляются после ответа
+	background_tasks.add_task(collect_orphaned_photos, repo.deleted_photo_digests)
+	return None
+
+# ========== ЭНДПОИНТЫ АУТЕНТИФИКАЦИИ ==========
+
+@router.post("/auth/login", response_model=Token)
+async def login(request: Request, user_credentials: UserLogin, user_repo: AsyncUserRepository = Depends(get_user_repository)):
+	"""Вход в систему"""
+	ip = client_ip(request.scope)
+	await rate_limiter.check_login(user_credentials.username, ip)
+	user = await user_repo.authenticate_user(user_credentials.username, user_credentials.password)
+	if not user:
+		delay = await rate_limiter.login_failed(user_credentials.username, ip)
+		raise HTTPException(
+			status_code=status.HTTP_401_UNAUTHORIZED,
+			detail="Неверное логин или пароль",
+			headers={"WWW-Authenticate": "Bearer", **(retry_after_header(delay) if delay else {})},
+		)
+
+	await rate_limiter.login_succeeded(user_credentials.username, ip)
+	access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+	access_token = AuthService.create_user_token(user, expires_delta=access_token_expires)
+	return {"access_token": access_token, "token_type": "bearer"}
+
+@router.get("/auth/me", response_model=User)
+async def get_current_user_info(
+	current_user: Principal = Depends(get_current_user_async),
+	user_repo: AsyncUserRepository = Depends(get_user_repository)
+):
+	"""Получение информации о текущем пользователе"""
+	user = await user_repo.get_by_id(current_user.id)
+	if not user:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Пользователь не найден"
+		)
+	return user
+
+@router.post("/auth/change-password")
+async def change_password(
+	password_data: UserChangePassword,
+	current_user: Principal = Depends(get_current_user_async),
+	user_repo: AsyncUserRepository = Depends(get_user_repository)
+):
+	"""Смена пароля текущего пользователя"""
+	success = await user_repo.change_password(
+		current_user.id,
+		password_data.current_password,
+		password_data.new_password
+	)
+	if not success:
+		raise HTTPException(
+			status_code=status.HTTP_400_BAD_REQUEST,
+			detail="Текущий пароль не корректный"
+		)
+	return {"message": "Пароль изменен"}
+
+@router.post("/auth/logout-all")
+async def logout_all(
+	current_user: Principal = Depends(get_current_user_async),
+	user_repo: AsyncUserRepository = Depends(get_user_repository)
+):
+	"""Отзыв всех выданных токенов текущего пользователя"""
+	await user_repo.revoke_tokens(current_user.id)
+	return {"message": "Все токены отозваны"}
+
+# ========== ЭНДПОИНТЫ УПРАВЛЕНИЯ ПОЛЬЗОВАТЕЛЯМИ ==========
+
+@router.get("/users", response_model=list[User])
+async def get_all_users(
+	current_user: Principal = Depends(require_manager_or_admin_async),
+	user_repo: AsyncUserRepository = Depends(get_user_repository)
+):
+	"""Получить всех пользователей (доступно менеджерам и администраторам)"""
+	return await user_repo.get_all()
+
+@router.get("/users/{user_id}", response_model=User)
+async def get_user(
+	user_id: int,
+	response: Response,
+	current_user: Principal = Depends(require_manager_or_admin_async),
+	user_repo: AsyncUserRepository = Depends(get_user_repository)
+):
+	"""Получить пользователя по ID"""
+	user = await user_repo.get_by_id(user_id)
+	if not user:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Пользователь не найден"
+		)
+	response.headers["ETag"] = entity_etag(user.version)
+	return user
+
+@router.post("/users", response_model=User, status_code=status.HTTP_201_CREATED)
+async def create_user(
+	user_data: UserCreate,
+	current_user: Principal = Depends(require_admin_async),
+	user_repo: AsyncUserRepository = Depends(get_user_repository)
+):
+	"""Создать нового пользователя (только для администраторов)"""
+	if await user_repo.get_by_username(user_data.username):
+		raise HTTPException(
+			status_code=status.HTTP_400_BAD_REQUEST,
+			detail="Пользователь с таким именем существует"
+		)
+	if await user_repo.get_by_email(user_data.email):
+		raise HTTPException(
+			status_code=status.HTTP_400_BAD_REQUEST,
+			detail="Такой email уже занят"
+		)
+	return await user_repo.create(user_data.model_dump())
+
+@router.put("/users/{user_id}", response_model=User)
+async def update_user(
+	user_id: int,
+	user_data: UserUpdate,
+	request: Request,
+	response: Response,
+	current_user: Principal = Depends(require_admin_async),
+	user_repo: AsyncUserRepository = Depends(get_user_repository)
+):
+	"""Обновить пользователя (только для администраторов)"""
+	try:
+		user = await user_repo.update(user_id, user_data.model_dump(exclude_unset=True), if_match_versions(request))
+	except VersionConflict:
+		raise HTTPException(
+			status_code=status.HTTP_412_PRECONDITION_FAILED,
+			detail="Пользователь изменен другим запросом"
+		)
+	if not user:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Пользователь не найден"
+		)
+	response.headers["ETag"] = entity_etag(user.version)
+	return user
+
+@router.delete("/users/{user_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_user(
+	user_id: int,
+	request: Request,
+	current_user: Principal = Depends(require_admin_async),
+	user_repo: AsyncUserRepository = Depends(get_user_repository)
+):
+	"""Удалить пользователя (только для администраторов)"""
+	try:
+		deleted = await user_repo.delete(user_id, if_match_versions(request))
+	except VersionConflict:
+		raise HTTPException(
+			status_code=status.HTTP_412_PRECONDITION_FAILED,
+			detail="Пользователь изменен другим запросом"
+		)
+	if not deleted:
+		raise HTTPException(
+			status_code=status.HTTP_404_NOT_FOUND,
+			detail="Пользователь не найден"
+		)
+	return None
@@ -1,21 +1,52 @@
+import hashlib
+import os
+import time
 from datetime import datetime, timedelta
-from typing import Optional, List
+from typing import Dict, Optional, List, Tuple
 from fastapi import Depends, HTTPException, status
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from passlib.context import CryptContext
-import jwt
-from jwt import PyJWTError, ExpiredSignatureError, InvalidTokenError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from database import DBUser, get_db
-from models import UserRole
+from cache import TTLCache
+from invalidation import invalidation_bus
+from database import DBUser, get_async_db, get_db
+from hashing import get_pwd_context
+from models import Principal, UserRole
 
 # Настройки для JWT токенов
 SECRET_KEY = "your-secret-key"
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-# Настройка хеширования паролей
-pwd_context = CryptContext(schemes=["sha256_crypt"], deprecated="auto")
+
+def _parse_keys(value: str) -> Dict[str, str]:
+	"""Ключи подписи из строки "kid:secret,kid:secret" """
+	keys = {}
+	for item in value.split(","):
+		kid, _, secret = item.strip().partition(":")
+		if kid and secret:
+			keys[kid] = secret
+	return keys
+
+# Ключи подписи по kid: новые токены подписываются JWT_ACTIVE_KID, проверяются
+# токены любого из ключей. Ротация: добавить новый ключ, сделать его активным,
+# а старый удалить после истечения выданных им токенов
+JWT_KEYS = _parse_keys(os.getenv("JWT_KEYS", "")) or {"default": SECRET_KEY}
+JWT_ACTIVE_KID = os.getenv("JWT_ACTIVE_KID") or next(iter(JWT_KEYS))
+if JWT_ACTIVE_KID not in JWT_KEYS:
+	raise RuntimeError(f"JWT_ACTIVE_KID={JWT_ACTIVE_KID!r} отсутствует в JWT_KEYS")
+
+# Кэш проверенных токенов: sha256(токен) -> claims; запись живет не дольше exp
+TOKEN_CACHE_TTL_SECONDS = 300
+TOKEN_CACHE_MAXSIZE = 16384
+token_cache = TTLCache(maxsize=TOKEN_CACHE_MAXSIZE, ttl=TOKEN_CACHE_TTL_SECONDS)
+
+# Кэш состояния пользователей: id -> (версия токенов, активен ли). Отзыв в этом
+# процессе действует сразу, в остальных - не позже чем через TTL
+TOKEN_STATE_TTL_SECONDS = 60
+TOKEN_STATE_MAXSIZE = 4096
+token_state_cache = TTLCache(maxsize=TOKEN_STATE_MAXSIZE, ttl=TOKEN_STATE_TTL_SECONDS)
+
 security = HTTPBearer()
 
 class AuthService:
@@ -25,7 +56,7 @@ class AuthService:
 	def verify_password(plain_password: str, hashed_password: str) -> bool:
 		"""Проверка пароля"""
 		try:
-			return pwd_context.verify(plain_password, hashed_password)
+			return get_pwd_context().verify(plain_password, hashed_password)
 		except ValueError as e:
 			# Обработка ошибок, связанных с длиной пароля
 			raise HTTPException(
@@ -36,78 +67,152 @@ class AuthService:
 	@staticmethod
 	def get_password_hash(password: str) -> str:
 		"""Хеширование пароля"""
-		return pwd_context.hash(password)
+		return get_pwd_context().hash(password)
 	
 
 	
 	@staticmethod
 	def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
-		"""Создание JWT токена"""
+		"""Создание JWT токена (подписывается активным ключом, kid в заголовке)"""
 		to_encode = data.copy()
 		if expires_delta:
 			expire = datetime.utcnow() + expires_delta
 		else:
 			expire = datetime.utcnow() + timedelta(minutes=65)
 		to_encode.update({"exp": expire})
-		encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
+		import jwt  # при первом выпуске токена, а не при старте воркера
+
+		encoded_jwt = jwt.encode(
+			to_encode, JWT_KEYS[JWT_ACTIVE_KID], algorithm=ALGORITHM, headers={"kid": JWT_ACTIVE_KID}
+		)
 		return encoded_jwt
+
+	@staticmethod
+	def create_user_token(user: DBUser, expires_delta: Optional[timedelta] = None) -> str:
+		"""Токен пользователя: id, роль и версия токенов в claims для проверки без БД"""
+		return AuthService.create_access_token(
+			{"sub": user.username, "uid": user.id, "role": user.role.value, "ver": user.token_version or 0},
+			expires_delta=expires_delta,
+		)
 	
 	@staticmethod
 	def verify_token(token: str) -> Optional[dict]:
-		"""Проверка JWT токена"""
-		try:
-			payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+		"""Проверка JWT токена; повторная проверка того же токена берется из кэша"""
+		digest = hashlib.sha256(token.encode()).digest()
+		payload = token_cache.get(digest)
+		if payload is not None:
 			return payload
-		except ExpiredSignatureError:
+		import jwt  # при первой проверке токена, а не при старте воркера
+
+		try:
+			kid = jwt.get_unverified_header(token).get("kid")
+			if kid not in JWT_KEYS:
+				raise jwt.InvalidTokenError("Unknown key id")
+			payload = jwt.decode(token, JWT_KEYS[kid], algorithms=[ALGORITHM])
+		except jwt.ExpiredSignatureError:
 			raise HTTPException(
 				status_code=status.HTTP_401_UNAUTHORIZED,
 				detail="Token expired"
 			)
-		except InvalidTokenError:
+		except jwt.InvalidTokenError:
 			raise HTTPException(
 				status_code=status.HTTP_401_UNAUTHORIZED,
 				detail="Invalid token"
 			)
-		except PyJWTError as e:
+		except jwt.PyJWTError as e:
 			raise HTTPException(
 				status_code=status.HTTP_401_UNAUTHORIZED,
 				detail=f"Could not validate credentials: {str(e)}"
 			)
+		expires_in = payload.get("exp", 0) - time.time()
+		if expires_in > 0:
+			token_cache.set(digest, payload, ttl=min(TOKEN_CACHE_TTL_SECONDS, expires_in))
+		return payload
 
-def get_current_user(
-	credentials: HTTPAuthorizationCredentials = Depends(security),
-	db: Session = Depends(get_db)
-) -> DBUser:
-	"""Получение текущего пользователя из токена"""
-	credentials_exception = HTTPException(
+def revoke_user_tokens(user_id: int, broadcast: bool = True) -> None:
+	"""Сброс состояния пользователя после увеличения версии токенов в БД (во всех воркерах)"""
+	token_state_cache.pop(user_id)
+	if broadcast:
+		invalidation_bus.publish(TOKEN_REVOCATION_CHANNEL, str(user_id))
+
+TOKEN_REVOCATION_CHANNEL = "user_tokens"
+invalidation_bus.subscribe(TOKEN_REVOCATION_CHANNEL, lambda user_id: revoke_user_tokens(int(user_id), broadcast=False))
+
+def _credentials_exception(detail: str = "Could not validate credentials") -> HTTPException:
+	return HTTPException(
 		status_code=status.HTTP_401_UNAUTHORIZED,
-		detail="Could not validate credentials",
+		detail=detail,
 		headers={"WWW-Authenticate": "Bearer"},
 	)
-	
+
+def _claims_principal(token: str) -> Tuple[Principal, int]:
+	"""Пользователь и версия токенов из claims проверенного токена"""
+	payload = AuthService.verify_token(token)
 	try:
-		# Проверяем токен
-		payload = AuthService.verify_token(credentials.credentials)
-		
-		# Получаем username из токена
-		username: str = payload.get("sub")
-		if username is None:
-			raise credentials_exception
-		
-		# Находим пользователя в базе данных
-		user = db.query(DBUser).filter(DBUser.username == username).first()
-		if user is None:
-			raise credentials_exception
-		
-		return user
+		principal = Principal(
+			id=payload["uid"],
+			username=payload["sub"],
+			role=UserRole(payload["role"]),
+			is_active=True,
+		)
+		return principal, int(payload.get("ver", 0))
+	except (KeyError, TypeError, ValueError):
+		raise _credentials_exception()
+
+def _user_token_state(user: Optional[DBUser]) -> tuple:
+	if user is None:
+		raise _credentials_exception()
+	return (user.token_version or 0, user.is_active == "true")
+
+def _check_token_state(principal: Principal, version: int, state: tuple) -> Principal:
+	current_version, is_active = state
+	if version != current_version:
+		raise _credentials_exception("Token revoked")
+	return principal if is_active else principal.model_copy(update={"is_active": False})
+
+def get_current_user(
+	credentials: HTTPAuthorizationCredentials = Depends(security),
+	db: Session = Depends(get_db)
+) -> Principal:
+	"""Получение текущего пользователя из токена
+
+	Роль и id берутся из claims; БД читается только при промахе кэша состояния
+	пользователя (версия токенов для отзыва).
+	"""
+	try:
+		principal, version = _claims_principal(credentials.credentials)
+		state = token_state_cache.get(principal.id)
+		if state is None:
+			generation = token_state_cache.generation
+			state = _user_token_state(db.get(DBUser, principal.id))
+			token_state_cache.set(principal.id, state, generation=generation)
+		return _check_token_state(principal, version, state)
 	except HTTPException:
 		raise
 	except Exception:
-		raise credentials_exception
+		raise _credentials_exception()
+
+async def get_current_user_async(
+	credentials: HTTPAuthorizationCredentials = Depends(security),
+	db: AsyncSession = Depends(get_async_db)
+) -> Principal:
+	"""Получение текущего пользователя из токена (асинхронная сессия)"""
+	try:
+		principal, version = _claims_principal(credentials.credentials)
+		state = token_state_cache.get(principal.id)
+		if state is None:
+			generation = token_state_cache.generation
+			state = _user_token_state(await db.get(DBUser, principal.id))
+			token_state_cache.set(principal.id, state, generation=generation)
+		return _check_token_state(principal, version, state)
+	except HTTPException:
+		raise
+	except Exception:
+		raise _credentials_exception()
 
 def require_role(required_roles: List[UserRole]):
 	"""Декоратор для проверки ролей пользователя"""
-	def role_checker(current_user: DBUser = Depends(get_current_user)):
+	def role_checker(current_user: Principal = Depends(get_current_user)):
 		if current_user.role not in required_roles:
 			raise HTTPException(
 				status_code=status.HTTP_403_FORBIDDEN,
@@ -116,8 +221,7 @@ def require_role(required_roles: List[UserRole]):
 		return current_user
 	return role_checker
 
-def require_admin(current_user: DBUser = Depends(get_current_user)) -> DBUser:
-	"""Требует роль администратора"""
+def _check_admin(current_user: Principal) -> Principal:
 	if current_user.role != UserRole.ADMIN:
 		raise HTTPException(
 			status_code=status.HTTP_403_FORBIDDEN,
@@ -125,8 +229,7 @@ def require_admin(current_user: DBUser = Depends(get_current_user)) -> DBUser:
 		)
 	return current_user
 
-def require_manager_or_admin(current_user: DBUser = Depends(get_current_user)) -> DBUser:
-	"""Требует роль менеджера или администратора"""
+def _check_manager_or_admin(current_user: Principal) -> Principal:
 	if current_user.role not in [UserRole.MANAGER, UserRole.ADMIN]:
 		raise HTTPException(
 			status_code=status.HTTP_403_FORBIDDEN,
@@ -134,6 +237,22 @@ def require_manager_or_admin(current_user: DBUser = Depends(get_current_user)) -
 		)
 	return current_user
 
-def require_any_role(current_user: DBUser = Depends(get_current_user)) -> DBUser:
+def require_admin(current_user: Principal = Depends(get_current_user)) -> Principal:
+	"""Требует роль администратора"""
+	return _check_admin(current_user)
+
+def require_manager_or_admin(current_user: Principal = Depends(get_current_user)) -> Principal:
+	"""Требует роль менеджера или администратора"""
+	return _check_manager_or_admin(current_user)
+
+async def require_admin_async(current_user: Principal = Depends(get_current_user_async)) -> Principal:
+	"""Требует роль администратора (асинхронный режим)"""
+	return _check_admin(current_user)
+
+async def require_manager_or_admin_async(current_user: Principal = Depends(get_current_user_async)) -> Principal:
+	"""Требует роль менеджера или администратора (асинхронный режим)"""
+	return _check_manager_or_admin(current_user)
+
+def require_any_role(current_user: Principal = Depends(get_current_user)) -> Principal:
 	"""Требует любую валидную роль (авторизованный пользователь)"""
 	return current_user
@@ -0,0 +1,95 @@
+"""Сравнение стоимости чтения страницы автомобилей: ORM + Pydantic против быстрого пути
+
+Старый путь повторяет то, что делает FastAPI для response_model=CarPage:
+ORM-объекты -> Car -> повторная проверка по response_model -> json.dumps.
+Быстрый путь: кортежи колонок -> fast_json.dumps.
+Отдельно выводится стоимость преобразования (полное время минус выборка кортежей
+колонок), т.к. выборка из SQLite одинакова для обоих путей.
+
+Запуск: python benchmarks/bench_car_serialization.py --cars 20000 --limit 500
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def measure(func, repeat: int) -> float:
+    """Минимальное время одного вызова, с"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cars", type=int, default=20000, help="число автомобилей в тестовой БД")
+    parser.add_argument("--limit", type=int, default=500, help="размер страницы")
+    parser.add_argument("--repeat", type=int, default=30, help="число повторов")
+    parser.add_argument("--min-speedup", type=float, default=0.0, help="код возврата 1, если ускорение преобразования меньше")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench-cars-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+
+    from pydantic import TypeAdapter
+    import fast_json
+    from database import SessionLocal
+    from migrations import migrate
+    from models import CarPage
+    from repository import CAR_COLUMN_NAMES, CarRepository
+
+    migrate()
+    db = SessionLocal()
+    repo = CarRepository(db)
+    repo.bulk_insert([
+        {"brand": f"Brand{i % 50}", "model": f"Model{i % 400}", "year": 1990 + i % 35,
+         "price": 5000.0 + (i * 37) % 90000, "color": "red" if i % 3 else None}
+        for i in range(args.cars)
+    ])
+
+    response_adapter = TypeAdapter(CarPage)
+
+    def legacy():
+        cars, next_cursor = repo.get_page(limit=args.limit)
+        value = response_adapter.validate_python({"items": cars, "next_cursor": next_cursor})
+        return json.dumps(response_adapter.dump_python(value, mode="json")).encode()
+
+    def fast():
+        rows, next_cursor = repo.get_page_rows(limit=args.limit)
+        return fast_json.dumps({"items": fast_json.rows_to_dicts(CAR_COLUMN_NAMES, rows), "next_cursor": next_cursor})
+
+    assert json.loads(legacy()) == json.loads(fast())
+
+    fetch_time = measure(lambda: repo.get_page_rows(limit=args.limit), args.repeat)
+    legacy_time = measure(legacy, args.repeat)
+    fast_time = measure(fast, args.repeat)
+    per_car = 1e6 / args.limit
+    result = {
+        "benchmark": "car_page_serialization",
+        "cars": args.cars,
+        "limit": args.limit,
+        "orjson": fast_json.orjson is not None,
+        "fetch_us_per_car": fetch_time * per_car,
+        "legacy_us_per_car": legacy_time * per_car,
+        "fast_us_per_car": fast_time * per_car,
+        "speedup": legacy_time / fast_time,
+        "legacy_conversion_us_per_car": (legacy_time - fetch_time) * per_car,
+        "fast_conversion_us_per_car": (fast_time - fetch_time) * per_car,
+        "conversion_speedup": (legacy_time - fetch_time) / max(fast_time - fetch_time, 1e-9),
+    }
+    print(json.dumps(result, indent=2))
+    db.close()
+    return 0 if result["conversion_speedup"] >= args.min_speedup else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
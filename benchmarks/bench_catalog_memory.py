@@ -0,0 +1,100 @@
+"""Память и скорость каталога автомобилей в памяти (catalog.py) против ORM-объектов
+
+Каталог загружается из существующей БД целиком; для сравнения в словарь
+id -> DBCar загружается выборка --orm-sample автомобилей, и ее память
+пересчитывается на одну машину (полная загрузка ORM-объектами на больших БД
+не помещается в память). Страницы списка сравниваются с запросами к SQLite.
+
+Запуск: python benchmarks/bench_catalog_memory.py --database-url sqlite:///./data.db
+"""
+import argparse
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+from common import metadata, setup_environment, time_calls, write_report
+
+
+def rss_bytes() -> int:
+    """Резидентная память процесса (Linux); 0, если недоступно"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return 0
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="БД с автомобилями (по умолчанию DATABASE_URL или ./data.db)")
+    parser.add_argument("--orm-sample", type=int, default=100000, help="автомобилей в выборке ORM-объектов")
+    parser.add_argument("--limit", type=int, default=50, help="размер страницы")
+    parser.add_argument("--iterations", type=int, default=200, help="число замеров страниц")
+    parser.add_argument("--output", help="файл для JSON-результата")
+    args = parser.parse_args()
+
+    url = setup_environment(args.database_url)
+    os.environ["CAR_CATALOG_ENABLED"] = "1"
+
+    from catalog import car_catalog
+    from database import DBCar, SessionLocal, engine
+    from repository import CarRepository
+
+    if not car_catalog.enabled:
+        print("numpy is required for the in-memory catalog", file=sys.stderr)
+        return 1
+
+    results = {}
+    gc.collect()
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    car_catalog.load()
+    load_seconds = time.perf_counter() - start
+    gc.collect()
+    cars = car_catalog.stats()["cars"]
+    results["catalog"] = {
+        "cars": cars,
+        "load_seconds": load_seconds,
+        "nbytes": car_catalog.nbytes(),
+        "bytes_per_car": car_catalog.nbytes() / max(cars, 1),
+        "rss_delta_bytes": rss_bytes() - rss_before,
+    }
+
+    # Выборка ORM-объектов: память считает tracemalloc (RSS после освобождения не уменьшается)
+    db = SessionLocal()
+    tracemalloc.start()
+    objects = {car.id: car for car in db.query(DBCar).order_by(DBCar.id).limit(args.orm_sample)}
+    traced, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    sample = max(len(objects), 1)
+    results["orm_objects"] = {
+        "cars": len(objects),
+        "traced_bytes": traced,
+        "bytes_per_car": traced / sample,
+        "estimated_bytes_for_catalog": traced / sample * cars,
+    }
+    objects.clear()
+    db.expunge_all()
+    results["catalog"]["memory_ratio"] = results["orm_objects"]["bytes_per_car"] / max(
+        results["catalog"]["bytes_per_car"], 1e-9)
+
+    repo = CarRepository(db)
+    for sort in ("id", "-price", "year"):
+        filters = {"price_max": 30000} if sort != "id" else None
+        car_catalog.enabled = True
+        results[f"page_catalog[{sort}]"] = time_calls(
+            lambda: repo.get_page_rows(filters, sort, None, args.limit), args.iterations)
+        car_catalog.enabled = False
+        results[f"page_sqlite[{sort}]"] = time_calls(
+            lambda: repo.get_page_rows(filters, sort, None, args.limit), args.iterations)
+    db.close()
+    engine.dispose()
+
+    write_report(metadata(benchmark="catalog_memory", database_url=url, limit=args.limit), results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,101 @@
+"""Общие функции бенчмарков: настройка БД, замеры, перцентили и формат результатов
+
+Все скрипты выводят JSON одного формата:
+{"meta": {...}, "results": {"<имя>": {"p50_us": ..., "p95_us": ..., ...}}},
+поэтому результаты разных коммитов можно сравнить через benchmarks/compare.py.
+"""
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_DATABASE_URL = "sqlite:///./data.db"
+
+
+def setup_environment(database_url: Optional[str]) -> str:
+    """Подготовка окружения до импорта модулей приложения
+
+    URL БД задается через DATABASE_URL/ASYNC_DATABASE_URL, поэтому вызывать
+    до импорта database/app. Возвращает используемый URL.
+    """
+    url = database_url or os.getenv("DATABASE_URL", DEFAULT_DATABASE_URL)
+    os.environ["DATABASE_URL"] = url
+    if url.startswith("sqlite:///") and "ASYNC_DATABASE_URL" not in os.environ:
+        os.environ["ASYNC_DATABASE_URL"] = url.replace("sqlite:///", "sqlite+aiosqlite:///", 1)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+    return url
+
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    """Перцентиль по отсортированной выборке (ближайший ранг)"""
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, int(round(fraction * len(sorted_values))) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples: List[float], elapsed: Optional[float] = None, errors: int = 0) -> dict:
+    """Сводка по длительностям в секундах: перцентили в мкс и пропускная способность"""
+    values = sorted(samples)
+    total = elapsed if elapsed is not None else sum(values)
+    return {
+        "count": len(values),
+        "errors": errors,
+        "mean_us": (sum(values) / len(values) * 1e6) if values else 0.0,
+        "p50_us": percentile(values, 0.50) * 1e6,
+        "p95_us": percentile(values, 0.95) * 1e6,
+        "p99_us": percentile(values, 0.99) * 1e6,
+        "max_us": (values[-1] * 1e6) if values else 0.0,
+        "ops_per_sec": (len(values) / total) if total else 0.0,
+    }
+
+
+def time_calls(func: Callable[[], object], iterations: int, warmup: int = 3) -> dict:
+    """Замер отдельных вызовов функции"""
+    for _ in range(warmup):
+        func()
+    samples = []
+    clock = time.perf_counter
+    for _ in range(iterations):
+        start = clock()
+        func()
+        samples.append(clock() - start)
+    return summarize(samples)
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, stderr=subprocess.DEVNULL, text=True
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(**extra) -> dict:
+    """Сведения о запуске для сравнения результатов между коммитами"""
+    meta = {
+        "commit": _git_revision(),
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+    }
+    meta.update(extra)
+    return meta
+
+
+def write_report(meta: dict, results: Dict[str, dict], output: Optional[str]) -> None:
+    """Вывод результатов в JSON (в файл или stdout)"""
+    report = json.dumps({"meta": meta, "results": results}, indent=2, ensure_ascii=False)
+    if output:
+        with open(output, "w", encoding="utf-8") as f:
+            f.write(report + "\n")
+    else:
+        print(report)
@@ -0,0 +1,56 @@
+"""Сравнение двух JSON-результатов бенчмарков (например, двух коммитов)
+
+Регрессией считается рост метрики задержки (или падение ops_per_sec) больше
+чем на --threshold. При наличии регрессий код возврата 1.
+
+Запуск: python benchmarks/compare.py base.json new.json --threshold 0.10
+"""
+import argparse
+import json
+import sys
+
+LATENCY_METRICS = ["p50_us", "p95_us", "p99_us"]
+
+
+def load(path: str) -> dict:
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def compare(base: dict, new: dict, threshold: float) -> list:
+    """Строки сравнения: (бенчмарк, метрика, было, стало, изменение, регрессия)"""
+    rows = []
+    for name, base_result in base["results"].items():
+        new_result = new["results"].get(name)
+        if new_result is None:
+            continue
+        for metric in LATENCY_METRICS + ["ops_per_sec"]:
+            before, after = base_result.get(metric), new_result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            worse = -change if metric == "ops_per_sec" else change
+            rows.append((name, metric, before, after, change, worse > threshold))
+    return rows
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("base", help="базовый результат")
+    parser.add_argument("new", help="новый результат")
+    parser.add_argument("--threshold", type=float, default=0.10, help="допустимое ухудшение (доля)")
+    args = parser.parse_args()
+
+    base, new = load(args.base), load(args.new)
+    print(f"base: {base['meta'].get('commit')}  new: {new['meta'].get('commit')}")
+    rows = compare(base, new, args.threshold)
+    regressions = 0
+    for name, metric, before, after, change, regressed in rows:
+        regressions += regressed
+        mark = "REGRESSION" if regressed else ""
+        print(f"{name:40} {metric:12} {before:14.1f} {after:14.1f} {change:+8.1%} {mark}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+"""Нагрузочный тест эндпоинтов /cars, /cars/{id}, /auth/login и /users
+
+Режимы:
+  по умолчанию  - приложение в том же процессе (httpx + ASGITransport);
+  --uvicorn     - запуск локального uvicorn (--workers) и нагрузка по HTTP;
+  --url URL     - нагрузка на уже запущенный сервер.
+
+Требуется httpx. Результат - JSON с p50/p95/p99 и RPS по каждому сценарию.
+
+Запуск: python benchmarks/load.py --cars 100k --requests 2000 --concurrency 32 --output load.json
+"""
+import argparse
+import asyncio
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+
+from common import ROOT, metadata, setup_environment, summarize, write_report
+
+ADMIN_CREDENTIALS = {"username": "admin", "password": "admin123"}
+BRANDS = ["Toyota", "Honda", "BMW", "Audi", "Ford"]
+
+
+async def run_scenario(client, make_request, requests: int, concurrency: int, expected=(200,)) -> dict:
+    """Выполнение requests запросов с заданной конкурентностью"""
+    samples = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, url, kwargs = make_request()
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                ok = response.status_code in expected
+            except Exception:
+                ok = False
+            samples.append(time.perf_counter() - start)
+            if not ok:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(samples, elapsed=time.perf_counter() - started, errors=errors)
+
+
+async def run_load(client, args) -> dict:
+    rng = random.Random(7)
+    response = await client.post("/auth/login", json=ADMIN_CREDENTIALS)
+    response.raise_for_status()
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    response = await client.get("/cars", params={"sort": "-id", "limit": 1})
+    items = response.json()["items"]
+    max_id = items[0]["id"] if items else 1
+
+    scenarios = {
+        "GET /cars": (lambda: ("GET", "/cars", {"params": {"limit": 50}}), args.requests),
+        "GET /cars?filtered": (lambda: ("GET", "/cars", {"params": {
+            "limit": 50, "brand": rng.choice(BRANDS), "year_min": rng.randint(1995, 2024), "sort": "-price",
+        }}), args.requests),
+        "GET /cars/{id}": (lambda: ("GET", f"/cars/{rng.randint(1, max_id)}", {}), args.requests),
+        "GET /users": (lambda: ("GET", "/users", {"headers": headers}), args.requests),
+        "POST /auth/login": (lambda: ("POST", "/auth/login", {"json": ADMIN_CREDENTIALS}), args.login_requests),
+    }
+    expected = {"GET /cars/{id}": (200, 404)}
+    results = {}
+    for name, (make_request, count) in scenarios.items():
+        if args.only and name not in args.only:
+            continue
+        results[name] = await run_scenario(
+            client, make_request, count, args.concurrency, expected.get(name, (200,))
+        )
+    return results
+
+
+async def run_in_process(args) -> dict:
+    import httpx
+    from app import app
+
+    await app.router.startup()
+    try:
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=60) as client:
+            return await run_load(client, args)
+    finally:
+        await app.router.shutdown()
+
+
+async def run_over_http(args, url: str) -> dict:
+    import httpx
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=url, timeout=60, limits=limits) as client:
+        return await run_load(client, args)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def start_uvicorn(workers: int) -> tuple:
+    """Запуск локального uvicorn и ожидание готовности"""
+    import httpx
+
+    port = _free_port()
+    process = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--host", "127.0.0.1", "--port", str(port),
+         "--workers", str(workers), "--log-level", "warning"],
+        cwd=ROOT, env=os.environ.copy(),
+    )
+    url = f"http://127.0.0.1:{port}"
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("uvicorn завершился при запуске")
+        try:
+            if httpx.get(f"{url}/cars", params={"limit": 1}).status_code == 200:
+                return process, url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError("uvicorn не запустился за отведенное время")
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cars", default="1k", help="число автомобилей в БД: 1k, 100k, 1m")
+    parser.add_argument("--users", default="100", help="число тестовых пользователей")
+    parser.add_argument("--database-url", default=None, help="URL БД (по умолчанию DATABASE_URL или ./data.db)")
+    parser.add_argument("--requests", type=int, default=2000, help="запросов на сценарий")
+    parser.add_argument("--login-requests", type=int, default=50, help="запросов на сценарий входа")
+    parser.add_argument("--concurrency", type=int, default=32, help="одновременных клиентов")
+    parser.add_argument("--only", nargs="*", default=None, help="запустить только указанные сценарии")
+    parser.add_argument("--url", default=None, help="URL уже запущенного сервера")
+    parser.add_argument("--uvicorn", action="store_true", help="запустить локальный uvicorn")
+    parser.add_argument("--workers", type=int, default=1, help="число воркеров uvicorn")
+    parser.add_argument("--output", default=None, help="файл для JSON-результата")
+    args = parser.parse_args()
+
+    database_url = setup_environment(args.database_url)
+    seeded = {}
+    if not args.url:
+        from seed import parse_count, seed
+        seeded = seed(parse_count(args.cars), parse_count(args.users), 0)
+
+    mode = "url" if args.url else ("uvicorn" if args.uvicorn else "in-process")
+    process = None
+    try:
+        if args.url:
+            results = asyncio.run(run_over_http(args, args.url))
+        elif args.uvicorn:
+            process, url = start_uvicorn(args.workers)
+            results = asyncio.run(run_over_http(args, url))
+        else:
+            results = asyncio.run(run_in_process(args))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    meta = metadata(
+        suite="load", mode=mode, database_url=database_url, db_mode=os.getenv("DB_MODE", "sync"),
+        concurrency=args.concurrency, workers=args.workers if args.uvicorn else None, **seeded,
+    )
+    write_report(meta, results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
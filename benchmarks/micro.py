@@ -0,0 +1,89 @@
+"""Микробенчмарки репозиториев, JWT и хеширования паролей
+
+Перед запуском БД наполняется через seed.py до --cars автомобилей.
+
+Запуск: python benchmarks/micro.py --cars 100k --output micro.json
+"""
+import argparse
+import random
+import sys
+
+from common import metadata, setup_environment, time_calls, write_report
+
+
+def run(iterations: int, hash_iterations: int) -> dict:
+    from datetime import timedelta
+    from sqlalchemy import func, select
+    from auth import AuthService, token_cache
+    from database import DBCar, SessionLocal
+    from hashing import get_pwd_context
+    from repository import CarRepository
+
+    db = SessionLocal()
+    repo = CarRepository(db)
+    max_id = db.execute(select(func.max(DBCar.id))).scalar_one() or 1
+    rng = random.Random(1)
+    db_car = db.execute(select(DBCar).limit(1)).scalar_one()
+
+    results = {
+        "car_repo.get_page[50]": time_calls(lambda: repo.get_page(limit=50), iterations),
+        "car_repo.get_page[50,price,filter]": time_calls(
+            lambda: repo.get_page({"brand": "Toyota", "year_min": 2010}, sort="-price", limit=50), iterations
+        ),
+        "car_repo.get_page_rows[50]": time_calls(lambda: repo.get_page_rows(limit=50), iterations),
+        "car_repo.get_by_id": time_calls(lambda: repo.get_by_id(rng.randint(1, max_id)), iterations),
+        "car_repo.get_row_by_id": time_calls(lambda: repo.get_row_by_id(rng.randint(1, max_id)), iterations),
+        "car_repo.search[toyota]": time_calls(lambda: repo.search("toyota", facets=False), iterations),
+        "car_repo.search[typo+prefix]": time_calls(lambda: repo.search("toyta 1", facets=False), iterations),
+        "car_repo.search[facets,cached]": time_calls(lambda: repo.search("toyota"), iterations),
+        "car_repo._convert_to_pydantic": time_calls(lambda: repo._convert_to_pydantic(db_car), iterations * 10),
+    }
+
+    def create_and_delete():
+        car = repo.create({"brand": "Bench", "model": "Micro", "year": 2024, "price": 1.0})
+        repo.delete(car.id)
+
+    results["car_repo.create+delete"] = time_calls(create_and_delete, max(iterations // 10, 10))
+
+    token = AuthService.create_access_token({"sub": "admin"}, expires_delta=timedelta(minutes=30))
+    results["auth.create_access_token"] = time_calls(
+        lambda: AuthService.create_access_token({"sub": "admin"}, expires_delta=timedelta(minutes=30)),
+        iterations * 10,
+    )
+    results["auth.verify_token[cached]"] = time_calls(lambda: AuthService.verify_token(token), iterations * 10)
+
+    def verify_uncached():
+        token_cache.clear()
+        AuthService.verify_token(token)
+
+    results["auth.verify_token[uncached]"] = time_calls(verify_uncached, iterations * 10)
+
+    hashed = get_pwd_context().hash("bench-password")
+    results["password.hash"] = time_calls(lambda: get_pwd_context().hash("bench-password"), hash_iterations, warmup=1)
+    results["password.verify"] = time_calls(
+        lambda: get_pwd_context().verify("bench-password", hashed), hash_iterations, warmup=1
+    )
+    db.close()
+    return results
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cars", default="1k", help="число автомобилей в БД: 1k, 100k, 1m")
+    parser.add_argument("--users", default="100", help="число тестовых пользователей")
+    parser.add_argument("--database-url", default=None, help="URL БД (по умолчанию DATABASE_URL или ./data.db)")
+    parser.add_argument("--iterations", type=int, default=1000, help="число вызовов на бенчмарк")
+    parser.add_argument("--hash-iterations", type=int, default=10, help="число вызовов хеширования")
+    parser.add_argument("--output", default=None, help="файл для JSON-результата")
+    args = parser.parse_args()
+
+    url = setup_environment(args.database_url)
+    from seed import parse_count, seed
+    seeded = seed(parse_count(args.cars), parse_count(args.users), 0)
+    results = run(args.iterations, args.hash_iterations)
+    write_report(metadata(suite="micro", database_url=url, **seeded), results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,103 @@
+"""Наполнение БД тестовыми данными для бенчмарков
+
+Досоздает автомобили и пользователей до заданного количества (повторный запуск
+с теми же параметрами ничего не добавляет). Данные детерминированы.
+
+Запуск: python benchmarks/seed.py --cars 100k --users 1k [--database-url sqlite:///./data.db]
+"""
+import argparse
+import random
+import sys
+import time
+
+from common import setup_environment
+
+BRANDS = ["Toyota", "Honda", "BMW", "Audi", "Ford", "Kia", "Lada", "Skoda", "Volvo", "Mazda"]
+COLORS = ["red", "black", "white", "silver", "blue", None]
+BENCH_PASSWORD = "bench-password"
+
+
+def parse_count(value: str) -> int:
+    """Количество с суффиксами: 1k, 100k, 1m"""
+    value = value.strip().lower()
+    multiplier = {"k": 1_000, "m": 1_000_000}.get(value[-1:], 1)
+    number = value[:-1] if multiplier != 1 else value
+    return int(float(number) * multiplier)
+
+
+def seed(cars: int, users: int, batch_size: int, seed_value: int = 42) -> dict:
+    """Досоздать автомобили и пользователей; возвращает число добавленных строк"""
+    from sqlalchemy import func, insert, select
+    from bulk import BULK_BATCH_SIZE
+    from database import DBCar, DBUser, SessionLocal
+    from hashing import get_pwd_context
+    from migrations import migrate
+    from models import UserRole
+    from repository import CarRepository
+
+    migrate()
+    batch_size = batch_size or BULK_BATCH_SIZE
+    rng = random.Random(seed_value)
+    db = SessionLocal()
+    try:
+        existing_cars = db.execute(select(func.count(DBCar.id))).scalar_one()
+        repo = CarRepository(db)
+        added_cars = 0
+        while existing_cars + added_cars < cars:
+            size = min(batch_size, cars - existing_cars - added_cars)
+            added_cars += repo.bulk_insert([
+                {
+                    "brand": (brand := rng.choice(BRANDS)),
+                    "model": f"{brand}-{rng.randint(1, 40)}",
+                    "year": rng.randint(1995, 2025),
+                    "price": float(rng.randint(3_000, 150_000)),
+                    "color": rng.choice(COLORS),
+                }
+                for _ in range(size)
+            ])
+
+        existing_users = db.execute(
+            select(func.count(DBUser.id)).where(DBUser.username.like("bench_user_%"))
+        ).scalar_one()
+        added_users = 0
+        if existing_users < users:
+            # Один хеш на всех пользователей: хеширование намеренно дорогое
+            hashed_password = get_pwd_context().hash(BENCH_PASSWORD)
+            rows = [
+                {
+                    "username": f"bench_user_{i}",
+                    "email": f"bench_user_{i}@bench.local",
+                    "hashed_password": hashed_password,
+                    "full_name": f"Bench User {i}",
+                    "role": UserRole.BUYER,
+                    "is_active": "true",
+                }
+                for i in range(existing_users, users)
+            ]
+            for start in range(0, len(rows), batch_size):
+                db.execute(insert(DBUser), rows[start:start + batch_size])
+                db.commit()
+            added_users = len(rows)
+        return {"cars_added": added_cars, "users_added": added_users,
+                "cars_total": existing_cars + added_cars, "users_total": max(existing_users, users)}
+    finally:
+        db.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cars", default="1k", help="число автомобилей: 1k, 100k, 1m или число")
+    parser.add_argument("--users", default="100", help="число тестовых пользователей")
+    parser.add_argument("--database-url", default=None, help="URL БД (по умолчанию DATABASE_URL или ./data.db)")
+    parser.add_argument("--batch-size", type=int, default=0, help="размер пакета вставки")
+    args = parser.parse_args()
+
+    url = setup_environment(args.database_url)
+    start = time.perf_counter()
+    result = seed(parse_count(args.cars), parse_count(args.users), args.batch_size)
+    print(f"{url}: {result}, {time.perf_counter() - start:.1f} с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
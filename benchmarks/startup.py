@@ -0,0 +1,125 @@
+"""Время холодного старта: от запуска воркера до первого успешного ответа
+
+Сценарии:
+- import_app - импорт приложения в новом процессе интерпретатора;
+- cold_process - новый процесс uvicorn (как новый под без preload);
+- forked_worker - воркер, созданный fork из процесса с уже импортированным
+  приложением (как gunicorn с preload_app в serve.py).
+Время до первого ответа - до 200 на GET /cars?limit=1. Миграции применяются
+до замеров (как python migrations.py перед запуском воркеров).
+
+Запуск: python benchmarks/startup.py --runs 5 --max-first-request-ms 200
+"""
+import argparse
+import http.client
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from common import ROOT, metadata, setup_environment, summarize, write_report
+
+FIRST_REQUEST_PATH = "/cars?limit=1"
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_first_response(port: int, started: float, timeout: float = 60.0) -> float:
+    """Опрос сервера до первого ответа 200; возвращает время от started, с"""
+    deadline = started + timeout
+    while time.perf_counter() < deadline:
+        connection = http.client.HTTPConnection("127.0.0.1", port, timeout=5)
+        try:
+            connection.request("GET", FIRST_REQUEST_PATH)
+            if connection.getresponse().status == 200:
+                return time.perf_counter() - started
+        except OSError:
+            time.sleep(0.002)
+        finally:
+            connection.close()
+    raise TimeoutError(f"no response on port {port} within {timeout:.0f}s")
+
+
+def measure_import(runs: int) -> list:
+    code = "import time; t = time.perf_counter(); import app; print(time.perf_counter() - t)"
+    return [
+        float(subprocess.check_output([sys.executable, "-c", code], cwd=ROOT, text=True).strip())
+        for _ in range(runs)
+    ]
+
+
+def measure_cold_process(runs: int) -> list:
+    samples = []
+    for _ in range(runs):
+        port = free_port()
+        code = f"import uvicorn; uvicorn.run('app:app', host='127.0.0.1', port={port}, log_level='warning')"
+        started = time.perf_counter()
+        process = subprocess.Popen([sys.executable, "-c", code], cwd=ROOT)
+        try:
+            samples.append(wait_first_response(port, started))
+        finally:
+            process.terminate()
+            process.wait()
+    return samples
+
+
+def measure_forked_worker(runs: int) -> list:
+    import uvicorn
+    from app import app
+    from database import dispose_engines_after_fork
+
+    samples = []
+    for _ in range(runs):
+        port = free_port()
+        started = time.perf_counter()
+        pid = os.fork()
+        if pid == 0:
+            dispose_engines_after_fork()
+            uvicorn.run(app, host="127.0.0.1", port=port, log_level="warning")
+            os._exit(0)
+        try:
+            samples.append(wait_first_response(port, started))
+        finally:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+    return samples
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", help="БД (по умолчанию DATABASE_URL или ./data.db)")
+    parser.add_argument("--runs", type=int, default=5, help="запусков на сценарий")
+    parser.add_argument("--max-first-request-ms", type=float, default=0.0,
+                        help="код возврата 1, если p50 forked_worker больше (0 - не проверять)")
+    parser.add_argument("--output", help="файл для JSON-результата")
+    args = parser.parse_args()
+
+    url = setup_environment(args.database_url)
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "0")
+    os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [ROOT, os.environ.get("PYTHONPATH")]))
+
+    from migrations import migrate
+
+    migrate()
+    results = {
+        "import_app": summarize(measure_import(args.runs)),
+        "cold_process": summarize(measure_cold_process(args.runs)),
+    }
+    if hasattr(os, "fork"):
+        results["forked_worker"] = summarize(measure_forked_worker(args.runs))
+
+    write_report(metadata(benchmark="startup", database_url=url, runs=args.runs), results, args.output)
+    forked = results.get("forked_worker")
+    if args.max_first_request_ms and forked and forked["p50_us"] > args.max_first_request_ms * 1000:
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
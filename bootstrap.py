@@ -0,0 +1,62 @@
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
+
+from auth import AuthService
+from database import DBAppState, DBCar, DBUser, SessionLocal
+from models import UserRole
+from response_cache import CARS_TABLE, table_versions
+
+# Отметка в app_state: начальное наполнение выполнено
+INITIAL_DATA_MARKER = "initial_data"
+
+DEMO_CARS = [
+    {"brand": "Toyota", "model": "Camry", "year": 2020, "price": 25000},
+    {"brand": "Honda", "model": "Accord", "year": 2021, "price": 27000},
+]
+
+DEFAULT_ADMIN = {
+    "username": "admin",
+    "email": "admin@carshop.com",
+    "password": "admin123",
+    "full_name": "Администратор",
+    "role": UserRole.ADMIN,
+}
+
+
+def seed_initial_data() -> bool:
+    """Однократное начальное наполнение БД: демонстрационные автомобили и администратор
+
+    Отметка в app_state вставляется в той же транзакции, что и данные. Вставка
+    берет блокировку записи, поэтому одновременно стартующие воркеры ждут первого
+    и получают IntegrityError: наполнение выполняется ровно один раз. Возвращает
+    True, если наполнение выполнил этот вызов.
+    """
+    db = SessionLocal()
+    try:
+        if db.get(DBAppState, INITIAL_DATA_MARKER) is not None:
+            return False
+        # Хеширование - до блокировки, чтобы не удерживать ее лишние сотни миллисекунд
+        admin = dict(DEFAULT_ADMIN)
+        admin["hashed_password"] = AuthService.get_password_hash(admin.pop("password"))
+
+        db.add(DBAppState(name=INITIAL_DATA_MARKER))
+        db.flush()
+        cars_added = db.execute(select(DBCar.id).limit(1)).first() is None
+        if cars_added:
+            db.add_all([DBCar(**car) for car in DEMO_CARS])
+        admin_added = db.execute(select(DBUser.id).where(DBUser.username == admin["username"])).first() is None
+        if admin_added:
+            db.add(DBUser(**admin))
+        db.commit()
+    except IntegrityError:
+        # Наполнение уже выполнил другой процесс
+        db.rollback()
+        return False
+    finally:
+        db.close()
+
+    if cars_added:
+        table_versions.bump(CARS_TABLE)
+    if admin_added:
+        print(f"Создан администратор: {DEFAULT_ADMIN['username']} / {DEFAULT_ADMIN['password']}")
+    return True
@@ -0,0 +1,139 @@
+import csv
+import io
+import json
+from datetime import datetime
+from typing import AsyncIterator, Awaitable, Callable, Iterable, List, Optional
+from pydantic import ValidationError
+from schemas import CarCreate
+
+# Размер пакета вставки (одна транзакция executemany на пакет)
+BULK_BATCH_SIZE = 5000
+# Размер порции строк при выгрузке через серверный курсор
+EXPORT_BATCH_SIZE = 1000
+# Ограничение размера отчета об ошибках, чтобы память не росла с размером файла
+MAX_REPORTED_ERRORS = 1000
+# Максимальная длина строки файла импорта: более длинные строки отклоняются
+MAX_LINE_BYTES = 64 * 1024
+
+CAR_EXPORT_COLUMNS = ["id", "brand", "model", "year", "price", "color", "created_at", "updated_at", "dealer_id"]
+
+
+async def iter_lines(chunks: AsyncIterator[bytes], max_length: int = MAX_LINE_BYTES) -> AsyncIterator[bytes]:
+    """Разбиение потока байтов тела запроса на строки (без декодирования)
+
+    Строка длиннее max_length не накапливается в памяти: возвращаются ее первые
+    max_length + 1 байт, остаток до конца строки пропускается.
+    """
+    buffer = bytearray()
+    skipping = False
+    async for chunk in chunks:
+        start = 0
+        end = chunk.find(b"\n")
+        while end >= 0:
+            if not skipping:
+                buffer += chunk[start:end]
+                yield bytes(buffer[:max_length + 1])
+            buffer.clear()
+            skipping = False
+            start = end + 1
+            end = chunk.find(b"\n", start)
+        if not skipping:
+            buffer += chunk[start:]
+            if len(buffer) > max_length:
+                yield bytes(buffer[:max_length + 1])
+                buffer.clear()
+                skipping = True
+    if buffer:
+        yield bytes(buffer)
+
+
+async def import_cars(
+    lines: AsyncIterator[bytes],
+    fmt: str,
+    write_batch: Callable[[List[dict]], Awaitable[int]],
+    batch_size: int = BULK_BATCH_SIZE,
+) -> dict:
+    """Потоковый импорт автомобилей из NDJSON или CSV
+
+    Строки проверяются по CarCreate по мере чтения и записываются пакетами
+    через write_batch. CSV должен содержать заголовок и одну запись на строку.
+    Строки декодируются по одной: строка не в UTF-8 или длиннее MAX_LINE_BYTES
+    отклоняется, как и строка с неверными данными.
+    Возвращает отчет: число вставленных и отклоненных строк и ошибки по строкам.
+    """
+    report = {"inserted": 0, "failed": 0, "errors": []}
+    batch: List[dict] = []
+    batch_lines: List[int] = []
+    header: Optional[List[str]] = None
+    line_no = 0
+
+    def add_error(line: int, error: str) -> None:
+        report["failed"] += 1
+        if len(report["errors"]) < MAX_REPORTED_ERRORS:
+            report["errors"].append({"line": line, "error": error})
+
+    async def flush() -> None:
+        if not batch:
+            return
+        try:
+            report["inserted"] += await write_batch(batch)
+        except Exception as e:
+            for line in batch_lines:
+                add_error(line, f"Database error: {e}")
+        batch.clear()
+        batch_lines.clear()
+
+    async for line in lines:
+        line_no += 1
+        if not line.strip():
+            continue
+        try:
+            if len(line) > MAX_LINE_BYTES:
+                raise ValueError(f"Line is longer than {MAX_LINE_BYTES} bytes")
+            line = line.decode("utf-8-sig").rstrip("\r")
+            if fmt == "csv":
+                values = next(csv.reader([line]))
+                if header is None:
+                    header = [name.strip() for name in values]
+                    continue
+                raw = {name: value for name, value in zip(header, values) if value != ""}
+            else:
+                raw = json.loads(line)
+            car = CarCreate.model_validate(raw)
+        except ValidationError as e:
+            add_error(line_no, "; ".join(
+                f"{'.'.join(map(str, err['loc']))}: {err['msg']}" for err in e.errors()
+            ))
+            continue
+        except ValueError as e:
+            add_error(line_no, str(e))
+            continue
+        batch.append(car.model_dump())
+        batch_lines.append(line_no)
+        if len(batch) >= batch_size:
+            await flush()
+
+    await flush()
+    return report
+
+
+def _export_value(value):
+    return value.isoformat() if isinstance(value, datetime) else value
+
+
+def format_ndjson(rows: Iterable[tuple]) -> str:
+    """Порция строк выгрузки в формате NDJSON"""
+    return "".join(
+        json.dumps(dict(zip(CAR_EXPORT_COLUMNS, map(_export_value, row))), ensure_ascii=False) + "\n"
+        for row in rows
+    )
+
+
+def format_csv(rows: Iterable[tuple], header: bool = False) -> str:
+    """Порция строк выгрузки в формате CSV"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(CAR_EXPORT_COLUMNS)
+    writer.writerows([_export_value(value) for value in row] for row in rows)
+    return buffer.getvalue()
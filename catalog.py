@@ -0,0 +1,453 @@
+import logging
+import math
+import os
+import sys
+import threading
+from datetime import datetime, timedelta
+from typing import List, Optional, Sequence
+
+from sqlalchemy import func, select
+
+from change_feed import car_changes
+from database import DBCar, engine
+from metrics import registry
+from response_cache import CARS_TABLE, table_versions
+from sharding import car_shards
+
+# Настройки каталога автомобилей в памяти (переменные окружения)
+CAR_CATALOG_ENABLED = os.getenv("CAR_CATALOG_ENABLED", "0") == "1"
+# Изменения перечитываются по updated_at с запасом на транзакции, зафиксированные не по порядку времени
+CAR_CATALOG_SYNC_MARGIN_SECONDS = float(os.getenv("CAR_CATALOG_SYNC_MARGIN_SECONDS", "5"))
+# Если изменилось больше строк, каталог перезагружается целиком
+CAR_CATALOG_RELOAD_FRACTION = 0.1
+# Доля удаленных позиций, после которой массивы уплотняются
+CAR_CATALOG_COMPACT_FRACTION = 0.25
+# Строк в одной порции последовательного просмотра (сортировка по id)
+CAR_CATALOG_SCAN_CHUNK = 8192
+
+# NumPy - необязательная зависимость; без нее каталог в памяти недоступен.
+# Импортируется, только если каталог включен: без него воркер стартует быстрее
+np = None
+if CAR_CATALOG_ENABLED:
+    try:
+        import numpy as np
+    except ImportError:  # pragma: no cover
+        np = None
+
+NULL_INT = -2 ** 31
+NULL_TIME = -2 ** 63
+_EPOCH = datetime(1970, 1, 1)
+
+logger = logging.getLogger("carshop.catalog")
+
+
+def _to_micros(value: Optional[datetime]) -> int:
+    if value is None:
+        return NULL_TIME
+    return (value - _EPOCH) // timedelta(microseconds=1)
+
+
+def _from_micros(value: int) -> Optional[datetime]:
+    return None if value == NULL_TIME else _EPOCH + timedelta(microseconds=value)
+
+
+def _is_cursor_id(value) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool) and -2 ** 63 <= value < 2 ** 63
+
+
+def _is_cursor_number(value) -> bool:
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+def page_cursor_values(sort: str, values: list) -> list:
+    """Значения курсора страницы: [id] для сортировки по id, иначе [ключ или None, id]
+
+    Курсор приходит от клиента, поэтому типы проверяются до сравнения с ключами
+    (в SQL и в каталоге). ValueError - курсор не подходит к сортировке.
+    """
+    key_count = 1 if sort.lstrip("-") == "id" else 2
+    if not isinstance(values, list) or len(values) != key_count or not _is_cursor_id(values[-1]):
+        raise ValueError("Invalid cursor")
+    if key_count == 1:
+        return list(values)
+    key = values[0]
+    if key is not None and not _is_cursor_number(key):
+        raise ValueError("Invalid cursor")
+    return [None if key is None else float(key), values[1]]
+
+
+class CarCatalog:
+    """Автомобили в памяти процесса в колоночных массивах NumPy
+
+    id, год, цена и время - массивы чисел; марка, модель и цвет - коды строк
+    общей таблицы (каждая строка хранится один раз). Позиции упорядочены по
+    id (новые id больше существующих), поэтому индекс id -> позиция - бинарный
+    поиск по массиву id без отдельного словаря. Удаление помечает позицию,
+    массивы уплотняются, когда удаленных становится много.
+
+    Записи идут в БД через CarRepository; каталог догоняет их перед чтением,
+    если изменилась версия таблицы: удаления приходят из ленты изменений,
+    вставки и изменения перечитываются по updated_at, а несовпадение числа
+    строк с БД приводит к полной перезагрузке.
+    """
+
+    COLUMNS = ("id", "brand", "model", "year", "price", "color", "created_at", "updated_at", "version", "dealer_id")
+
+    def __init__(self, bind=None, enabled: bool = CAR_CATALOG_ENABLED):
+        if enabled and np is None:
+            logger.warning("CAR_CATALOG_ENABLED=1 requires numpy; the in-memory catalog is disabled")
+            enabled = False
+        self.enabled = enabled
+        self.bind = bind
+        self.version = None
+        self.loaded_at: Optional[datetime] = None
+        self.reloads = 0
+        self.synced_rows = 0
+        self._size = 0
+        self._alive_count = 0
+        self._strings: List[Optional[str]] = []
+        self._codes: dict = {}
+        self._watermark = NULL_TIME
+        self._pending_deletes: set = set()
+        self._lock = threading.RLock()
+        self._columns = None
+        self._orders: dict = {}
+
+    # ---------- загрузка и синхронизация ----------
+
+    def _allocate(self, capacity: int) -> dict:
+        return {
+            "id": np.empty(capacity, dtype=np.int64),
+            "brand": np.empty(capacity, dtype=np.int32),
+            "model": np.empty(capacity, dtype=np.int32),
+            "color": np.empty(capacity, dtype=np.int32),
+            "year": np.empty(capacity, dtype=np.int32),
+            "price": np.empty(capacity, dtype=np.float64),
+            "created_at": np.empty(capacity, dtype=np.int64),
+            "updated_at": np.empty(capacity, dtype=np.int64),
+            "version": np.empty(capacity, dtype=np.int32),
+            "dealer_id": np.empty(capacity, dtype=np.int32),
+            "alive": np.zeros(capacity, dtype=bool),
+        }
+
+    def _code(self, value: Optional[str]) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self._strings)
+            self._strings.append(value)
+        return code
+
+    def _select(self, *criteria):
+        columns = [getattr(DBCar, name) for name in self.COLUMNS]
+        return select(*columns).where(*criteria).order_by(DBCar.id).execution_options(yield_per=50000)
+
+    def load(self, version=None) -> None:
+        """Полная загрузка из БД"""
+        if not self.enabled:
+            return
+        with self._lock:
+            version = table_versions.get(CARS_TABLE) if version is None else version
+            with self.bind.connect() as connection:
+                count = connection.execute(select(func.count()).select_from(DBCar)).scalar()
+                self._strings, self._codes = [], {}
+                self._columns = self._allocate(max(count, 1024))
+                self._size = self._alive_count = 0
+                self._watermark = NULL_TIME
+                self._pending_deletes.clear()
+                self._orders = {}
+                for partition in connection.execute(self._select()).partitions():
+                    self._append(partition)
+            self.version = version
+            self.loaded_at = datetime.utcnow()
+            self.reloads += 1
+
+    def _append(self, rows: Sequence[Sequence]) -> None:
+        count = len(rows)
+        if not count:
+            return
+        self._reserve(self._size + count)
+        ids, brands, models, years, prices, colors, created, updated, versions, dealers = zip(*rows)
+        start, end = self._size, self._size + count
+        columns = self._columns
+        code = self._code
+        columns["id"][start:end] = ids
+        columns["brand"][start:end] = [code(value) for value in brands]
+        columns["model"][start:end] = [code(value) for value in models]
+        columns["color"][start:end] = [code(value) for value in colors]
+        columns["year"][start:end] = [NULL_INT if value is None else value for value in years]
+        columns["price"][start:end] = [np.nan if value is None else value for value in prices]
+        columns["created_at"][start:end] = [_to_micros(value) for value in created]
+        updated_micros = [_to_micros(value) for value in updated]
+        columns["updated_at"][start:end] = updated_micros
+        columns["version"][start:end] = versions
+        columns["dealer_id"][start:end] = dealers
+        columns["alive"][start:end] = True
+        self._size = end
+        self._alive_count += count
+        self._watermark = max(self._watermark, max(updated_micros))
+
+    def _reserve(self, capacity: int) -> None:
+        current = len(self._columns["id"])
+        if capacity <= current:
+            return
+        grown = self._allocate(max(capacity, current * 2))
+        for name, values in self._columns.items():
+            grown[name][:self._size] = values[:self._size]
+        self._columns = grown
+
+    def _position(self, car_id: int) -> int:
+        """Позиция id или -1"""
+        ids = self._columns["id"]
+        position = int(np.searchsorted(ids[:self._size], car_id))
+        if position < self._size and ids[position] == car_id:
+            return position
+        return -1
+
+    def _upsert(self, row: Sequence) -> bool:
+        """Обновление или добавление строки; False - id не по порядку (нужна перезагрузка)"""
+        position = self._position(row[0])
+        if position < 0:
+            if self._size and row[0] < self._columns["id"][self._size - 1]:
+                return False
+            self._append([row])
+            return True
+        columns = self._columns
+        car_id, brand, model, year, price, color, created_at, updated_at, version, dealer_id = row
+        if not columns["alive"][position]:
+            columns["alive"][position] = True
+            self._alive_count += 1
+        columns["brand"][position] = self._code(brand)
+        columns["model"][position] = self._code(model)
+        columns["color"][position] = self._code(color)
+        columns["year"][position] = NULL_INT if year is None else year
+        columns["price"][position] = np.nan if price is None else price
+        columns["created_at"][position] = _to_micros(created_at)
+        columns["updated_at"][position] = _to_micros(updated_at)
+        columns["version"][position] = version
+        columns["dealer_id"][position] = dealer_id
+        self._watermark = max(self._watermark, _to_micros(updated_at))
+        return True
+
+    def _delete(self, car_id: int) -> None:
+        position = self._position(car_id)
+        if position >= 0 and self._columns["alive"][position]:
+            self._columns["alive"][position] = False
+            self._alive_count -= 1
+
+    def _compact(self) -> None:
+        alive = self._columns["alive"][:self._size]
+        compacted = self._allocate(max(self._alive_count * 2, 1024))
+        for name, values in self._columns.items():
+            compacted[name][:self._alive_count] = values[:self._size][alive]
+        self._columns = compacted
+        self._size = self._alive_count
+
+    def on_change(self, event: dict) -> None:
+        """Событие ленты изменений: удаленные id применяются при следующей синхронизации"""
+        if not self.enabled or self._columns is None:
+            return
+        if event["op"] == "delete":
+            with self._lock:
+                self._pending_deletes.update(event["ids"])
+
+    def sync(self) -> None:
+        """Догнать изменения таблицы, если изменилась ее версия"""
+        version = table_versions.get(CARS_TABLE)
+        if version == self.version and self._columns is not None:
+            return
+        with self._lock:
+            if version == self.version and self._columns is not None:
+                return
+            if self._columns is None:
+                self.load(version)
+                return
+            self._orders = {}
+            for car_id in self._pending_deletes:
+                self._delete(car_id)
+            self._pending_deletes.clear()
+            since = _EPOCH + timedelta(microseconds=max(0, self._watermark)) \
+                - timedelta(seconds=CAR_CATALOG_SYNC_MARGIN_SECONDS)
+            with self.bind.connect() as connection:
+                count = connection.execute(select(func.count()).select_from(DBCar)).scalar()
+                changed = connection.execute(
+                    select(func.count()).select_from(DBCar).where(DBCar.updated_at >= since)
+                ).scalar()
+                reload = changed > max(1000, CAR_CATALOG_RELOAD_FRACTION * count)
+                if not reload:
+                    for row in connection.execute(self._select(DBCar.updated_at >= since)):
+                        if not self._upsert(row):
+                            reload = True
+                            break
+                    self.synced_rows += changed
+            if reload or count != self._alive_count:
+                # Изменения, не попавшие в выборку по updated_at (или слишком много изменений)
+                self.load(version)
+                return
+            if self._size - self._alive_count > CAR_CATALOG_COMPACT_FRACTION * self._size:
+                self._compact()
+            self.version = version
+
+    # ---------- чтение ----------
+
+    def _rows(self, positions) -> List[tuple]:
+        columns = self._columns
+        strings = self._strings
+        years = columns["year"][positions].tolist()
+        prices = columns["price"][positions].tolist()
+        return [
+            (
+                car_id, strings[brand], strings[model], None if year == NULL_INT else year,
+                None if price != price else price, strings[color],
+                _from_micros(created_at), _from_micros(updated_at), version, dealer_id,
+            )
+            for car_id, brand, model, year, price, color, created_at, updated_at, version, dealer_id in zip(
+                columns["id"][positions].tolist(), columns["brand"][positions].tolist(),
+                columns["model"][positions].tolist(), years, prices, columns["color"][positions].tolist(),
+                columns["created_at"][positions].tolist(), columns["updated_at"][positions].tolist(),
+                columns["version"][positions].tolist(), columns["dealer_id"][positions].tolist(),
+            )
+        ]
+
+    def get_row(self, car_id: int) -> Optional[tuple]:
+        """Автомобиль кортежем в порядке CAR_COLUMN_NAMES"""
+        self.sync()
+        with self._lock:
+            position = self._position(car_id)
+            if position < 0 or not self._columns["alive"][position]:
+                return None
+            return self._rows([position])[0]
+
+    def _mask(self, index, filters: dict):
+        """Маска строк index (срез или массив позиций), прошедших фильтры (NULL не проходит сравнения, как в SQL)"""
+        columns = self._columns
+        mask = columns["alive"][index].copy()
+        if filters.get("dealer_id") is not None:
+            mask &= columns["dealer_id"][index] == filters["dealer_id"]
+        for name in ("brand", "model", "color"):
+            if filters.get(name) is not None:
+                code = self._codes.get(filters[name])
+                if code is None:
+                    return np.zeros(len(mask), dtype=bool)
+                mask &= columns[name][index] == code
+        if filters.get("year_min") is not None or filters.get("year_max") is not None:
+            years = columns["year"][index]
+            if filters.get("year_min") is not None:
+                mask &= (years >= filters["year_min"]) & (years != NULL_INT)
+            if filters.get("year_max") is not None:
+                mask &= (years <= filters["year_max"]) & (years != NULL_INT)
+        if filters.get("price_min") is not None or filters.get("price_max") is not None:
+            prices = columns["price"][index]
+            if filters.get("price_min") is not None:
+                mask &= prices >= filters["price_min"]
+            if filters.get("price_max") is not None:
+                mask &= prices <= filters["price_max"]
+        return mask
+
+    def _order(self, sort_name: str):
+        """Позиции по возрастанию (ключ, id) и ключи в этом порядке; NULL - -inf (первым, как в SQLite)
+
+        Строится при первом запросе и сбрасывается при любом изменении каталога.
+        """
+        cached = self._orders.get(sort_name)
+        if cached is None:
+            keys = self._columns[sort_name][:self._size].astype(np.float64)
+            if sort_name == "price":
+                keys[np.isnan(keys)] = -np.inf
+            else:
+                keys[self._columns[sort_name][:self._size] == NULL_INT] = -np.inf
+            # Позиции уже упорядочены по id, устойчивая сортировка по ключу дает порядок (ключ, id)
+            order = np.argsort(keys, kind="stable").astype(np.int32)
+            cached = self._orders[sort_name] = (order, keys[order])
+        return cached
+
+    def page(self, filters: Optional[dict], sort: str, cursor_values: Optional[list], limit: int) -> List[tuple]:
+        """До limit + 1 строк страницы в порядке (ключ сортировки, id), как build_car_page_query"""
+        self.sync()
+        filters = filters or {}
+        if cursor_values:
+            cursor_values = page_cursor_values(sort, cursor_values)
+            # Ключ NULL в курсоре: в SQL сравнение с ним не истинно ни для одной строки
+            if cursor_values[0] is None:
+                return []
+        descending = sort.startswith("-")
+        sort_name = sort.lstrip("-")
+        with self._lock:
+            ids = self._columns["id"][:self._size]
+            if sort_name == "id":
+                order = None
+                begin, end = 0, self._size
+                if cursor_values and descending:
+                    end = int(np.searchsorted(ids, cursor_values[0], "left"))
+                elif cursor_values:
+                    begin = int(np.searchsorted(ids, cursor_values[0], "right"))
+            else:
+                order, keys = self._order(sort_name)
+                begin, end = 0, self._size
+                # Фильтр по ключу сортировки сужает диапазон бинарным поиском
+                low_bound, high_bound = filters.get(f"{sort_name}_min"), filters.get(f"{sort_name}_max")
+                if low_bound is not None:
+                    begin = int(np.searchsorted(keys, low_bound, "left"))
+                if high_bound is not None:
+                    end = int(np.searchsorted(keys, high_bound, "right"))
+                if cursor_values:
+                    bound_key, bound_id = cursor_values
+                    low = int(np.searchsorted(keys, bound_key, "left"))
+                    high = int(np.searchsorted(keys, bound_key, "right"))
+                    # Среди равных ключей позиции упорядочены по id
+                    split = low + int(np.searchsorted(ids[order[low:high]], bound_id, "left" if descending else "right"))
+                    if descending:
+                        # Строки с ключом NULL не проходят сравнение кортежей с курсором
+                        begin, end = max(begin, int(np.searchsorted(keys, -np.inf, "right"))), min(end, split)
+                    else:
+                        begin = max(begin, split)
+            return self._rows(self._scan(order, begin, end, filters, limit + 1, descending))
+
+    def _scan(self, order, begin: int, end: int, filters: dict, count: int, descending: bool) -> list:
+        """Первые count позиций диапазона [begin, end) порядка order (None - по id), прошедших фильтры
+
+        Просмотр идет порциями от начала (или конца при убывании) до count совпадений.
+        """
+        if descending:
+            ranges = ((max(begin, stop - CAR_CATALOG_SCAN_CHUNK), stop) for stop in range(end, begin, -CAR_CATALOG_SCAN_CHUNK))
+        else:
+            ranges = ((start, min(start + CAR_CATALOG_SCAN_CHUNK, end)) for start in range(begin, end, CAR_CATALOG_SCAN_CHUNK))
+        found = []
+        for start, stop in ranges:
+            if order is None:
+                matched = np.flatnonzero(self._mask(slice(start, stop), filters)) + start
+            else:
+                positions = order[start:stop]
+                matched = positions[self._mask(positions, filters)]
+            found.extend((matched[::-1] if descending else matched)[:count - len(found)].tolist())
+            if len(found) >= count:
+                break
+        return found
+
+    def stats(self) -> dict:
+        if self._columns is None:
+            return {"cars": 0, "positions": 0, "strings": 0, "bytes": 0, "reloads": self.reloads}
+        return {
+            "cars": self._alive_count,
+            "positions": self._size,
+            "strings": len(self._strings),
+            "bytes": self.nbytes(),
+            "reloads": self.reloads,
+        }
+
+    def nbytes(self) -> int:
+        """Память массивов и таблицы строк (байт)"""
+        if self._columns is None:
+            return 0
+        arrays = sum(values.nbytes for values in self._columns.values())
+        arrays += sum(order.nbytes + keys.nbytes for order, keys in self._orders.values())
+        strings = sum(sys.getsizeof(value) for value in self._strings if value is not None)
+        return arrays + strings
+
+
+# Автомобили в шардах (CAR_SHARD_URLS) каталог одной БД не видит: при шардировании он отключен
+car_catalog = CarCatalog(engine, enabled=CAR_CATALOG_ENABLED and not car_shards.enabled)
+car_changes.listen(car_catalog.on_change)
+
+registry.gauge("car_catalog", "Каталог автомобилей в памяти", lambda: [
+    ({"stat": key}, value) for key, value in car_catalog.stats().items()
+])
@@ -0,0 +1,145 @@
+import asyncio
+import json
+import os
+import threading
+import uuid
+from collections import deque
+from typing import AsyncIterator, Callable, List, Optional, Tuple
+
+import fast_json
+from invalidation import invalidation_bus
+from metrics import registry
+
+# Настройки ленты изменений (переменные окружения)
+CHANGE_FEED_BUFFER_SIZE = int(os.getenv("CHANGE_FEED_BUFFER_SIZE", "1000"))
+CHANGE_FEED_HEARTBEAT_SECONDS = float(os.getenv("CHANGE_FEED_HEARTBEAT_SECONDS", "15"))
+# Очередь одного подписчика; отстающий клиент получает reset и переподключается
+CHANGE_FEED_SUBSCRIBER_QUEUE = 1000
+# Интервал переподключения EventSource (мс)
+CHANGE_FEED_RETRY_MS = 3000
+
+
+class ChangeFeed:
+    """Внутрипроцессная лента изменений таблицы с кольцевым буфером последних событий
+
+    Событие - словарь с полем op; publish присваивает ему монотонный номер seq.
+    Идентификатор события для SSE - "эпоха-seq": после перезапуска процесса
+    клиент с Last-Event-ID прошлой эпохи получает reset. События других воркеров
+    приходят через invalidation_bus и нумеруются seq этого процесса.
+    """
+
+    def __init__(self, channel: str, buffer_size: int = CHANGE_FEED_BUFFER_SIZE):
+        self.channel = channel
+        self.epoch = uuid.uuid4().hex[:8]
+        self.seq = 0
+        self._buffer: deque = deque(maxlen=buffer_size)
+        self._subscribers: set = set()
+        self._listeners: List[Callable[[dict], None]] = []
+        self._lock = threading.Lock()
+
+    def listen(self, listener: Callable[[dict], None]) -> None:
+        """Внутрипроцессный обработчик событий (своих и других воркеров), вызывается до рассылки SSE"""
+        self._listeners.append(listener)
+
+    def publish(self, op: str, **payload) -> None:
+        """Опубликовать событие (вызывается из потоков пула и из цикла событий)"""
+        self._publish_local(op, payload)
+        if invalidation_bus.active:
+            invalidation_bus.publish(self.channel, fast_json.dumps(dict(payload, op=op)).decode())
+
+    def apply_remote(self, payload: str) -> None:
+        """Событие другого воркера"""
+        event = json.loads(payload)
+        self._publish_local(event.pop("op"), event)
+
+    def _publish_local(self, op: str, payload: dict) -> None:
+        with self._lock:
+            self.seq += 1
+            event = dict(payload, seq=self.seq, op=op)
+            self._buffer.append(event)
+            subscribers = list(self._subscribers)
+        for listener in self._listeners:
+            listener(event)
+        for loop, queue in subscribers:
+            loop.call_soon_threadsafe(_offer, queue, event)
+
+    def event_id(self, event: dict) -> str:
+        return f"{self.epoch}-{event['seq']}"
+
+    def _parse_last_event_id(self, last_event_id: Optional[str]) -> Optional[int]:
+        """Номер последнего полученного события; None - клиенту нужен reset"""
+        epoch, _, seq = (last_event_id or "").partition("-")
+        if epoch != self.epoch or not seq.isdigit():
+            return None
+        return int(seq)
+
+    def _subscribe(self, last_event_id: Optional[str]) -> Tuple[tuple, List[dict], bool]:
+        """Регистрация подписчика и пропущенные им события из буфера"""
+        queue: asyncio.Queue = asyncio.Queue(maxsize=CHANGE_FEED_SUBSCRIBER_QUEUE)
+        subscriber = (asyncio.get_running_loop(), queue)
+        with self._lock:
+            self._subscribers.add(subscriber)
+            if last_event_id is None:
+                return subscriber, [], False
+            last_seq = self._parse_last_event_id(last_event_id)
+            oldest = self._buffer[0]["seq"] if self._buffer else self.seq + 1
+            if last_seq is None or last_seq > self.seq or last_seq + 1 < oldest:
+                return subscriber, [], True
+            return subscriber, [event for event in self._buffer if event["seq"] > last_seq], False
+
+    async def stream(self, last_event_id: Optional[str] = None) -> AsyncIterator[bytes]:
+        """Поток SSE: пропущенные события, затем новые; комментарий-heartbeat при простое"""
+        subscriber, missed, reset = self._subscribe(last_event_id)
+        queue = subscriber[1]
+        try:
+            yield f"retry: {CHANGE_FEED_RETRY_MS}\n\n".encode()
+            if reset:
+                yield self._format({"seq": self.seq, "op": "reset"})
+            last_seq = missed[-1]["seq"] if missed else 0
+            for event in missed:
+                yield self._format(event)
+            while True:
+                try:
+                    event = await asyncio.wait_for(queue.get(), CHANGE_FEED_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": ping\n\n"
+                    continue
+                if event is _OVERFLOW:
+                    yield self._format({"seq": self.seq, "op": "reset"})
+                    return
+                # Событие могло попасть и в буфер, и в очередь во время подписки
+                if event["seq"] <= last_seq:
+                    continue
+                last_seq = event["seq"]
+                yield self._format(event)
+        finally:
+            with self._lock:
+                self._subscribers.discard(subscriber)
+
+    def _format(self, event: dict) -> bytes:
+        return b"id: " + self.event_id(event).encode() + b"\ndata: " + fast_json.dumps(event) + b"\n\n"
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"seq": self.seq, "buffered": len(self._buffer), "subscribers": len(self._subscribers)}
+
+
+_OVERFLOW = object()
+
+
+def _offer(queue: asyncio.Queue, event: dict) -> None:
+    """Передача события подписчику; переполненная очередь заменяется сигналом reset"""
+    try:
+        queue.put_nowait(event)
+    except asyncio.QueueFull:
+        while not queue.empty():
+            queue.get_nowait()
+        queue.put_nowait(_OVERFLOW)
+
+
+car_changes = ChangeFeed("car_changes")
+invalidation_bus.subscribe(car_changes.channel, car_changes.apply_remote)
+
+registry.gauge("change_feed", "Лента изменений автомобилей", lambda: [
+    ({"stat": key}, value) for key, value in car_changes.stats().items()
+])
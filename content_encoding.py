@@ -0,0 +1,266 @@
+import gzip
+import hashlib
+import os
+import zlib
+from functools import lru_cache
+from typing import Dict, Optional, Tuple
+
+from fastapi import Request, Response
+from starlette.datastructures import Headers, MutableHeaders
+
+# brotli и zstandard - необязательные зависимости; без них доступен только gzip
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+# Настройки сжатия ответов (переменные окружения)
+COMPRESSION_ENABLED = os.getenv("COMPRESSION_ENABLED", "1") == "1"
+# Ответы меньше порога (байт) не сжимаются: выигрыш меньше накладных расходов
+COMPRESSION_MIN_SIZE = int(os.getenv("COMPRESSION_MIN_SIZE", "1024"))
+# Cache-Control статических файлов (index.html): по умолчанию проверка по ETag при каждом открытии
+STATIC_CACHE_CONTROL = os.getenv("STATIC_CACHE_CONTROL", "no-cache")
+
+# Уровни сжатия: динамические ответы - быстро, статические файлы сжимаются один раз - максимально
+_LEVELS = {
+    "br": (5, 11),
+    "zstd": (3, 19),
+    "gzip": (6, 9),
+}
+
+# Поддерживаемые кодировки в порядке предпочтения сервера
+AVAILABLE_ENCODINGS: Tuple[str, ...] = tuple(
+    name for name, module in (("zstd", zstandard), ("br", brotli), ("gzip", gzip)) if module is not None
+)
+
+# Типы содержимого, которые имеет смысл сжимать (text/event-stream - нет: прокси буферизуют сжатый поток)
+COMPRESSIBLE_TYPES = ("application/json", "application/x-ndjson", "application/javascript", "text/html", "text/csv", "text/plain")
+
+
+def compress(data: bytes, encoding: str, static: bool = False) -> bytes:
+    level = _LEVELS[encoding][1 if static else 0]
+    if encoding == "gzip":
+        return gzip.compress(data, compresslevel=level, mtime=0)
+    if encoding == "br":
+        return brotli.compress(data, quality=level)
+    return zstandard.ZstdCompressor(level=level).compress(data)
+
+
+@lru_cache(maxsize=256)
+def negotiate(accept_encoding: Optional[str], available: Tuple[str, ...] = AVAILABLE_ENCODINGS) -> Optional[str]:
+    """Кодировка ответа по Accept-Encoding: наибольший q, при равенстве - предпочтение сервера"""
+    if not accept_encoding or not COMPRESSION_ENABLED:
+        return None
+    weights: Dict[str, float] = {}
+    for item in accept_encoding.lower().split(","):
+        coding, _, params = item.strip().partition(";")
+        weight = 1.0
+        params = params.strip()
+        if params.startswith("q="):
+            try:
+                weight = float(params[2:])
+            except ValueError:
+                weight = 0.0
+        weights[coding.strip()] = weight
+    wildcard = weights.get("*", 0.0)
+    best, best_weight = None, 0.0
+    for encoding in available:
+        weight = weights.get(encoding, wildcard)
+        if weight > best_weight:
+            best, best_weight = encoding, weight
+    return best
+
+
+def is_compressible(content_type: str) -> bool:
+    return content_type.startswith(COMPRESSIBLE_TYPES)
+
+
+def encoded_etag(etag: str, encoding: Optional[str]) -> str:
+    """ETag сжатого варианта: у разных кодировок одного ответа ETag должны различаться"""
+    if encoding is None:
+        return etag
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def matched_etag(request: Request, etag: str) -> Optional[str]:
+    """Значение If-None-Match, совпавшее с ETag ответа (в любой кодировке), или None"""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return None
+    for value in header.split(","):
+        value = value.strip()
+        if value == "*":
+            return etag
+        candidate = value[2:] if value.startswith("W/") else value
+        if candidate == etag or any(candidate == encoded_etag(etag, name) for name in _LEVELS):
+            return value
+    return None
+
+
+class EncodedBody:
+    """Тело ответа и его сжатые варианты
+
+    Каждый вариант сжимается при первом запросе с этой кодировкой и затем
+    переиспользуется, пока тело хранится в кэше. Вариант, который не меньше
+    исходного тела, не используется.
+    """
+
+    __slots__ = ("identity", "static", "_encoded")
+
+    def __init__(self, identity: bytes, static: bool = False):
+        self.identity = identity
+        self.static = static
+        self._encoded: Dict[str, Optional[bytes]] = {}
+
+    def precompress(self) -> "EncodedBody":
+        for encoding in AVAILABLE_ENCODINGS:
+            self.get(encoding)
+        return self
+
+    def get(self, encoding: str) -> Optional[bytes]:
+        if encoding not in self._encoded:
+            data = compress(self.identity, encoding, static=self.static)
+            # Параллельный запрос может сжать то же тело повторно - результат одинаков
+            self._encoded[encoding] = data if len(data) < len(self.identity) else None
+        return self._encoded[encoding]
+
+    def select(self, accept_encoding: Optional[str]) -> Tuple[Optional[str], bytes]:
+        """Кодировка и тело для запроса"""
+        encoding = negotiate(accept_encoding) if len(self.identity) >= COMPRESSION_MIN_SIZE else None
+        data = self.get(encoding) if encoding is not None else None
+        if data is None:
+            return None, self.identity
+        return encoding, data
+
+
+def encoded_response(request: Request, body: EncodedBody, etag: str, media_type: str,
+                     cache_control: str = "no-cache") -> Response:
+    """Ответ с вариантом тела по Accept-Encoding, ETag варианта и Vary"""
+    encoding, data = body.select(request.headers.get("accept-encoding"))
+    headers = {"ETag": encoded_etag(etag, encoding), "Cache-Control": cache_control, "Vary": "Accept-Encoding"}
+    if encoding is not None:
+        headers["Content-Encoding"] = encoding
+    return Response(content=data, media_type=media_type, headers=headers)
+
+
+def not_modified_response(etag: str, cache_control: str = "no-cache") -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control, "Vary": "Accept-Encoding"})
+
+
+class StaticAsset:
+    """Статический файл, загруженный в память и заранее сжатый всеми доступными кодировками"""
+
+    def __init__(self, content: bytes, media_type: str, cache_control: str = STATIC_CACHE_CONTROL):
+        self.media_type = media_type
+        self.cache_control = cache_control
+        self.etag = f'"{hashlib.blake2b(content, digest_size=8).hexdigest()}"'
+        self.body = EncodedBody(content, static=True).precompress()
+
+    @classmethod
+    def from_file(cls, path: str, media_type: str, fallback: bytes) -> "StaticAsset":
+        """Файл читается один раз; если его нет - используется fallback"""
+        try:
+            with open(path, "rb") as file:
+                content = file.read()
+        except FileNotFoundError:
+            content = fallback
+        return cls(content, media_type)
+
+    def respond(self, request: Request) -> Response:
+        matched = matched_etag(request, self.etag)
+        if matched is not None:
+            return not_modified_response(matched, self.cache_control)
+        return encoded_response(request, self.body, self.etag, self.media_type, self.cache_control)
+
+
+class CompressionMiddleware:
+    """ASGI-middleware: сжатие ответов, которые не сжаты заранее (кэш ответов, статика)
+
+    Ответ целиком сжимается согласованной кодировкой, если он не меньше
+    minimum_size. Потоковые ответы (выгрузки) сжимаются gzip по частям:
+    каждая часть отправляется сразу, без накопления всего ответа.
+    """
+
+    def __init__(self, app, minimum_size: int = COMPRESSION_MIN_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not COMPRESSION_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        accept_encoding = Headers(scope=scope).get("accept-encoding")
+        await self.app(scope, receive, _CompressionSender(send, accept_encoding, self.minimum_size))
+
+
+class _CompressionSender:
+    """send() одного ответа: начало ответа задерживается до первой части тела"""
+
+    def __init__(self, send, accept_encoding: Optional[str], minimum_size: int):
+        self.send = send
+        self.accept_encoding = accept_encoding
+        self.minimum_size = minimum_size
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, message):
+        if message["type"] == "http.response.start":
+            headers = Headers(raw=message["headers"])
+            # Ответы с Vary: Accept-Encoding уже выбрали вариант сами (EncodedBody)
+            self.passthrough = (
+                "content-encoding" in headers
+                or "accept-encoding" in headers.get("vary", "").lower()
+                or not is_compressible(headers.get("content-type", ""))
+            )
+            if self.passthrough:
+                await self.send(message)
+            else:
+                self.start_message = message
+            return
+        if self.passthrough or message["type"] != "http.response.body":
+            await self.send(message)
+            return
+
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if self.start_message is not None:
+            start, self.start_message = self.start_message, None
+            headers = MutableHeaders(scope=start)
+            headers.add_vary_header("Accept-Encoding")
+            if not more_body:
+                encoding = negotiate(self.accept_encoding) if len(body) >= self.minimum_size else None
+                if encoding is not None:
+                    compressed = compress(body, encoding)
+                    if len(compressed) < len(body):
+                        body = compressed
+                        self._set_encoding(headers, encoding)
+                        headers["Content-Length"] = str(len(body))
+                await self.send(start)
+                await self.send({"type": "http.response.body", "body": body})
+                return
+            # Потоковое сжатие - только gzip из стандартной библиотеки
+            if negotiate(self.accept_encoding, ("gzip",)) is not None:
+                self.compressor = zlib.compressobj(_LEVELS["gzip"][0], zlib.DEFLATED, zlib.MAX_WBITS | 16)
+                self._set_encoding(headers, "gzip")
+                del headers["Content-Length"]
+            await self.send(start)
+
+        if self.compressor is not None:
+            body = self.compressor.compress(body)
+            body += self.compressor.flush(zlib.Z_SYNC_FLUSH if more_body else zlib.Z_FINISH)
+            if not body and more_body:
+                return
+        await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    @staticmethod
+    def _set_encoding(headers: MutableHeaders, encoding: str) -> None:
+        headers["Content-Encoding"] = encoding
+        etag = headers.get("etag")
+        if etag and not etag.startswith("W/"):
+            headers["ETag"] = encoded_etag(etag, encoding)
+
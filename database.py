@@ -1,16 +1,149 @@
-from sqlalchemy import Enum, create_engine, Column, Integer, String, Float, DateTime
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator
+from sqlalchemy import Boolean, Enum, create_engine, event, Column, Integer, String, Float, DateTime, ForeignKey, Index, Text
+from sqlalchemy.engine import Connection, Engine, make_url
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session, sessionmaker
 from datetime import datetime
 
+from fastapi import Request
+
+from metrics import record_query, registry
 from models import UserRole
+from replicas import ReplicaSet, mark_write, prefers_primary
+from stats import CAR_STATS_TABLE, SUMMARY_STATE_TABLE
+
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./data.db")
+# Асинхронный драйвер: aiosqlite локально, postgresql+asyncpg://... для Postgres
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL", "sqlite+aiosqlite:///./data.db")
+# Режим работы эндпоинтов с БД: sync (пул потоков) или async (AsyncSession)
+DB_MODE = os.getenv("DB_MODE", "sync")
+
+# Реплики для чтения: READ_DATABASE_URLS (через запятую; READ_DATABASE_URL - одна реплика)
+# или DB_SEPARATE_READ_ENGINE=1 (для SQLite в режиме WAL - отдельный пул соединений к тому же файлу)
+READ_DATABASE_URLS = [
+    url.strip() for url in os.getenv("READ_DATABASE_URLS", os.getenv("READ_DATABASE_URL", "")).split(",") if url.strip()
+]
+DB_SEPARATE_READ_ENGINE = os.getenv("DB_SEPARATE_READ_ENGINE", "0") == "1" or bool(READ_DATABASE_URLS)
+
+# Параметры пула соединений
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "10"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "20"))
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "1800"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+
+# Ожидание блокировки создания схемы другим процессом (мс)
+SCHEMA_LOCK_TIMEOUT_MS = int(os.getenv("SCHEMA_LOCK_TIMEOUT_MS", "600000"))
+
+# PRAGMA, выполняемые для каждого нового соединения SQLite
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-65536")),  # отрицательное значение - в КиБ
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "temp_store": "MEMORY",
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000")),
+}
+
+
+# Движки приложения для метрик занятости пулов соединений
+_engines: list = []
+
+
+def _pool_metrics():
+    for role, engine in _engines:
+        pool = engine.pool
+        labels = {"engine": f"{role}:{engine.url.render_as_string(hide_password=True)}"}
+        for state, method in (("checked_out", "checkedout"), ("size", "size"), ("overflow", "overflow")):
+            if hasattr(pool, method):
+                yield dict(labels, state=state), getattr(pool, method)()
+
+
+registry.gauge("db_pool_connections", "Состояние пулов соединений с БД", _pool_metrics)
+
+
+def _set_sqlite_pragmas(dbapi_connection, read_only: bool) -> None:
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        if read_only:
+            cursor.execute("PRAGMA query_only=ON")
+    finally:
+        cursor.close()
+
+
+def configure_engine(engine: Engine, read_only: bool = False) -> Engine:
+    """PRAGMA SQLite для каждого нового соединения и учет SQL-запросов в метриках"""
+    if engine.dialect.name == "sqlite":
+        @event.listens_for(engine, "connect")
+        def _on_connect(dbapi_connection, connection_record):
+            _set_sqlite_pragmas(dbapi_connection, read_only)
+
+    # Запросы одного соединения выполняются по очереди: достаточно одного времени начала,
+    # которое следующий запрос перезаписывает и после ошибки предыдущего
+    @event.listens_for(engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info["query_start"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info.pop("query_start", None)
+        if started is not None:
+            record_query(statement, time.perf_counter() - started)
+
+    _engines.append((("read" if read_only else "write"), engine))
+    return engine
+
+
+def dispose_engines_after_fork() -> None:
+    """Сброс пулов соединений, унаследованных от родительского процесса (gunicorn --preload)"""
+    for _, pooled_engine in _engines:
+        pooled_engine.dispose(close=False)
 
-SQLALCHEMY_DATABASE_URL = "sqlite:///./data.db"
 
-engine = create_engine(
-    SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
-)
+def engine_options(url: str) -> dict:
+    """Параметры create_engine/create_async_engine для URL"""
+    parsed = make_url(url)
+    options = {}
+    if parsed.get_backend_name() == "sqlite":
+        options["connect_args"] = {"check_same_thread": False}
+        if parsed.database in (None, "", ":memory:"):
+            # Для БД в памяти используется однопоточный пул без настроек размера
+            return options
+    options.update(
+        pool_size=DB_POOL_SIZE,
+        max_overflow=DB_MAX_OVERFLOW,
+        pool_recycle=DB_POOL_RECYCLE,
+        pool_timeout=DB_POOL_TIMEOUT,
+    )
+    return options
+
+
+def create_db_engine(url: str, read_only: bool = False) -> Engine:
+    """Создание настроенного синхронного движка"""
+    return configure_engine(create_engine(url, **engine_options(url)), read_only=read_only)
+
+
+engine = create_db_engine(SQLALCHEMY_DATABASE_URL)
+read_replicas = ReplicaSet(engine, [
+    create_db_engine(url, read_only=True) for url in (READ_DATABASE_URLS or [SQLALCHEMY_DATABASE_URL])
+] if DB_SEPARATE_READ_ENGINE else [])
+registry.gauge("db_read_replicas", "Состояние реплик для чтения и число направленных на них сессий", read_replicas.stats)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Движок сессии чтения выбирается при создании (см. read_session)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False)
+
+# Зафиксированная транзакция основной сессии - запись: чтения клиента
+# на короткое время направляются в основную БД
+event.listen(SessionLocal, "after_commit", lambda session: mark_write())
+
+# Асинхронный движок создается при первом обращении, чтобы sync-режим
+# не требовал установленного асинхронного драйвера
+_async_session_factory = None
 
 Base = declarative_base()
 
@@ -26,10 +159,68 @@ class DBCar(Base):
     color = Column(String, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Версия строки для оптимистичной блокировки (If-Match): увеличивается каждым изменением
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+    # Дилер (арендатор): все автомобили дилера хранятся в одном шарде (sharding.py)
+    dealer_id = Column(Integer, nullable=False, default=0, server_default="0")
+
+    # Составные индексы под keyset-пагинацию и фильтры списка автомобилей
+    __table_args__ = (
+        Index("ix_cars_dealer_id_id", "dealer_id", "id"),
+        Index("ix_cars_price_id", "price", "id"),
+        Index("ix_cars_year_id", "year", "id"),
+        Index("ix_cars_brand_model_id", "brand", "model", "id"),
+        # Пересчет минимальной и максимальной цены группы сводки car_stats
+        Index("ix_cars_brand_year_price", "brand", "year", "price"),
+        # Догрузка изменений в каталог автомобилей в памяти (catalog.py)
+        Index("ix_cars_updated_at", "updated_at"),
+        # id удаленных автомобилей не выдаются повторно: к id привязаны ETag и фотографии
+        {"sqlite_autoincrement": True},
+    )
+
+class DBCarPhoto(Base):
+    """Фотография автомобиля: метаданные; файл хранится на диске по хешу содержимого (media.py)"""
+    __tablename__ = "car_photos"
+
+    id = Column(Integer, primary_key=True)
+    # Удаляются вместе с автомобилем (в шардах - фоновой очисткой media.collect_orphaned_photos)
+    car_id = Column(Integer, ForeignKey("cars.id", ondelete="CASCADE"), nullable=False, index=True)
+    digest = Column(String(64), nullable=False, index=True)  # SHA-256 содержимого
+    content_type = Column(String, nullable=False)
+    size = Column(Integer, nullable=False)
+    # Миниатюра: pending, ready, failed или unsupported (Pillow не установлен)
+    thumbnail = Column(String, nullable=False, default="pending", server_default="pending")
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+class DBCarStats(Base):
+    """Сводка по автомобилям одной марки и года (обновляется триггерами, см. stats.py)"""
+    __tablename__ = CAR_STATS_TABLE
+
+    id = Column(Integer, primary_key=True)
+    brand = Column(String)
+    year = Column(Integer)
+    car_count = Column(Integer, nullable=False)
+    price_sum = Column(Float, nullable=False)
+    min_price = Column(Float, nullable=True)
+    max_price = Column(Float, nullable=True)
+    updated_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_car_stats_brand_year", "brand", "year", unique=True),
+    )
+
+class DBSummaryState(Base):
+    """Время последней полной перестройки сводной таблицы"""
+    __tablename__ = SUMMARY_STATE_TABLE
+
+    name = Column(String, primary_key=True)
+    rebuilt_at = Column(DateTime, nullable=False)
 
 class DBUser(Base):
     """Модель пользователя для базы данных""" 
     __tablename__ = "users"
+    # id удаленных пользователей не выдаются повторно: к id привязаны ETag и выданные токены
+    __table_args__ = {"sqlite_autoincrement": True}
 
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, index=True, nullable=False)
@@ -38,10 +229,57 @@ class DBUser(Base):
     full_name = Column(String, nullable=True)
     role = Column(Enum(UserRole), nullable=False, default=UserRole.BUYER)
     is_active = Column(String, default="true")  # Используем строку для совместимости с SQLite
+    # Версия токенов: увеличение отзывает все выданные пользователю JWT
+    token_version = Column(Integer, nullable=False, default=0, server_default="0")
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Версия строки для оптимистичной блокировки (If-Match)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
+
+class DBAppState(Base):
+    """Отметки однократных операций (например, начального наполнения БД)"""
+    __tablename__ = "app_state"
+
+    name = Column(String, primary_key=True)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow)
+
+class DBDealerShard(Base):
+    """Размещение дилера по шардам автомобилей (в основной БД, см. sharding.py)"""
+    __tablename__ = "dealer_shards"
+
+    dealer_id = Column(Integer, primary_key=True, autoincrement=False)
+    shard = Column(Integer, nullable=False)
+    # Шард с неосновной копией автомобилей дилера во время переноса
+    copy_shard = Column(Integer, nullable=True)
+    # Запись автомобилей дилера приостановлена (завершение переноса)
+    frozen = Column(Boolean, nullable=False, default=False, server_default="0")
+    updated_at = Column(DateTime, nullable=False, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class DBIdSequence(Base):
+    """Следующее свободное значение id, общее для всех шардов (выдается блоками)"""
+    __tablename__ = "id_sequences"
+
+    name = Column(String, primary_key=True)
+    next_value = Column(Integer, nullable=False)
 
-Base.metadata.create_all(bind=engine)
+class DBTableVersion(Base):
+    """Общая для всех воркеров версия таблицы (ключи кэшей и ETag ответов, см. response_cache.py)"""
+    __tablename__ = "table_versions"
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False)
+    # Случайное значение при создании строки: ETag не повторяются после пересоздания БД
+    epoch = Column(String, nullable=False)
+
+class DBCacheInvalidation(Base):
+    """Журнал межпроцессной инвалидации кэшей воркеров (см. invalidation.py)"""
+    __tablename__ = "cache_invalidations"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    origin = Column(String, nullable=False)
+    channel = Column(String, nullable=False)
+    payload = Column(Text, nullable=False)
+    created_at = Column(DateTime, nullable=False, default=datetime.utcnow, index=True)
 
 def get_db():
     """Получение сессии базы данных"""
@@ -51,9 +289,64 @@ def get_db():
     finally:
         db.close()
 
-def init_database():
-    """Инициализация базы данных и создание таблиц"""
-    Base.metadata.create_all(bind=engine)
+def read_session(primary: bool = False) -> Session:
+    """Сессия чтения: реплика по балансировке или основная БД (primary=True)"""
+    return ReadSessionLocal(bind=engine if primary else read_replicas.choose())
+
+def get_read_db(request: Request):
+    """Получение сессии базы данных для чтения
+
+    Клиент, недавно выполнивший запись, читает из основной БД (read-your-writes).
+    """
+    db = read_session(primary=prefers_primary(request.cookies))
+    try:
+        yield db
+    except OperationalError:
+        read_replicas.mark_failed(db.get_bind())
+        raise
+    finally:
+        db.close()
+
+def get_async_session_factory():
+    """Фабрика асинхронных сессий (создается лениво)"""
+    global _async_session_factory
+    if _async_session_factory is None:
+        from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+        async_engine = create_async_engine(ASYNC_DATABASE_URL, **engine_options(ASYNC_DATABASE_URL))
+        configure_engine(async_engine.sync_engine)
+        _async_session_factory = async_sessionmaker(
+            async_engine, autoflush=False, expire_on_commit=False
+        )
+    return _async_session_factory
+
+async def get_async_db():
+    """Получение асинхронной сессии базы данных"""
+    async with get_async_session_factory()() as db:
+        yield db
+
+@contextmanager
+def schema_transaction(bind: Engine = engine) -> Iterator[Connection]:
+    """Транзакция, в которой схему создает только один процесс
 
-# Создаем таблицы при импорте модуля
-init_database()
\ No newline at end of file
+    В SQLite BEGIN IMMEDIATE сразу берет блокировку записи: одновременно
+    стартующие воркеры создают таблицы по очереди, а не проверяют их наличие
+    одновременно. Ожидание блокировки - до SCHEMA_LOCK_TIMEOUT_MS (первое
+    построение индексов большой БД занимает дольше обычного busy_timeout).
+    """
+    if bind.dialect.name != "sqlite":
+        with bind.begin() as connection:
+            yield connection
+        return
+    with bind.connect().execution_options(isolation_level="AUTOCOMMIT") as connection:
+        connection.exec_driver_sql(f"PRAGMA busy_timeout = {SCHEMA_LOCK_TIMEOUT_MS}")
+        try:
+            connection.exec_driver_sql("BEGIN IMMEDIATE")
+            try:
+                yield connection
+            except BaseException:
+                connection.exec_driver_sql("ROLLBACK")
+                raise
+            connection.exec_driver_sql("COMMIT")
+        finally:
+            connection.exec_driver_sql(f"PRAGMA busy_timeout = {SQLITE_PRAGMAS['busy_timeout']}")
@@ -0,0 +1,34 @@
+import json
+from datetime import date, datetime
+from typing import Iterable, List, Sequence
+
+# orjson - необязательная зависимость; без нее используется стандартный json
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def _default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(value) -> bytes:
+    """Сериализация в JSON-байты (orjson, если установлен)"""
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, default=_default, ensure_ascii=False, separators=(",", ":")).encode()
+
+
+def rows_to_dicts(names: Sequence[str], rows: Iterable[Sequence]) -> List[dict]:
+    """Строки-кортежи в список словарей {колонка: значение}"""
+    return [dict(zip(names, row)) for row in rows]
+
+
+def rows_to_columns(names: Sequence[str], rows: Sequence[Sequence]) -> dict:
+    """Строки-кортежи в колоночное представление {колонка: [значения]}"""
+    if not rows:
+        return {name: [] for name in names}
+    return {name: list(values) for name, values in zip(names, zip(*rows))}
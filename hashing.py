@@ -0,0 +1,119 @@
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+from typing import Optional, Tuple
+from fastapi import HTTPException, status
+from metrics import password_hash_latency, registry
+
+# Настройка хеширования паролей; хеши с числом раундов ниже
+# PASSWORD_HASH_ROUNDS считаются устаревшими и пересчитываются при входе
+PASSWORD_HASH_ROUNDS = 535000
+
+
+@lru_cache(maxsize=None)
+def get_pwd_context():
+    """Контекст passlib; создается при первом хешировании, а не при старте воркера"""
+    from passlib.context import CryptContext
+
+    return CryptContext(
+        schemes=["sha256_crypt"],
+        deprecated="auto",
+        sha256_crypt__default_rounds=PASSWORD_HASH_ROUNDS,
+        sha256_crypt__min_rounds=PASSWORD_HASH_ROUNDS,
+    )
+
+
+# Размер пула процессов (на воркер сервера) и максимальное число задач в очереди
+HASH_WORKERS = int(os.getenv("PASSWORD_HASH_WORKERS", "0")) or os.cpu_count() or 1
+HASH_MAX_PENDING = HASH_WORKERS * 8
+HASH_RETRY_AFTER_SECONDS = 1
+
+
+def _hash_password(password: str) -> str:
+    """Хеширование пароля (выполняется в процессе пула)"""
+    return get_pwd_context().hash(password)
+
+
+def _verify_password(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Проверка пароля и пересчет хеша с устаревшими параметрами (в процессе пула)"""
+    return get_pwd_context().verify_and_update(password, hashed_password)
+
+
+class PasswordHasher:
+    """Сервис хеширования паролей в отдельном пуле процессов
+
+    Хеширование намеренно дорогое, поэтому оно не выполняется в пуле потоков
+    запросов. При переполнении очереди запрос сразу отклоняется с 503.
+    """
+
+    def __init__(self, max_workers: int = HASH_WORKERS, max_pending: int = HASH_MAX_PENDING):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.pending = 0
+        self.rejected = 0
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+
+    def start(self) -> ProcessPoolExecutor:
+        """Запуск пула процессов"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+            return self._executor
+
+    def shutdown(self) -> None:
+        """Остановка пула процессов"""
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    async def hash(self, password: str) -> str:
+        """Хеширование пароля"""
+        return await self._run("hash", _hash_password, password)
+
+    async def verify(self, password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+        """Проверка пароля
+
+        Возвращает (валиден ли пароль, новый хеш или None). Новый хеш
+        возвращается, если параметры старого хеша устарели.
+        """
+        try:
+            return await self._run("verify", _verify_password, password, hashed_password)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"Password verification error: {str(e)}"
+            )
+
+    async def _run(self, operation: str, func, *args):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Сервис аутентификации перегружен, повторите попытку позже",
+                    headers={"Retry-After": str(HASH_RETRY_AFTER_SECONDS)},
+                )
+            self.pending += 1
+        start = time.perf_counter()
+        try:
+            executor = self.start()
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(executor, func, *args)
+        finally:
+            password_hash_latency.observe(time.perf_counter() - start, operation)
+            with self._lock:
+                self.pending -= 1
+
+
+password_hasher = PasswordHasher()
+
+registry.gauge("password_hasher_jobs", "Задачи пула хеширования паролей", lambda: [
+    ({"state": "pending"}, password_hasher.pending),
+    ({"state": "max_pending"}, password_hasher.max_pending),
+    ({"state": "rejected"}, password_hasher.rejected),
+])
@@ -0,0 +1,147 @@
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, select
+
+from database import DBCacheInvalidation, engine
+from metrics import registry
+
+# Настройки межпроцессной инвалидации (переменные окружения)
+INVALIDATION_POLL_SECONDS = float(os.getenv("INVALIDATION_POLL_SECONDS", "0.2"))
+INVALIDATION_RETENTION_SECONDS = float(os.getenv("INVALIDATION_RETENTION_SECONDS", "600"))
+# Как часто процесс удаляет из журнала события старше INVALIDATION_RETENTION_SECONDS
+INVALIDATION_PRUNE_SECONDS = 60
+
+logger = logging.getLogger("carshop.invalidation")
+
+
+class InvalidationBus:
+    """Межпроцессная инвалидация локальных кэшей воркеров через журнал в БД
+
+    publish() ставит событие в очередь; фоновый поток записывает очередь в таблицу
+    cache_invalidations и читает события других процессов (id больше последнего
+    прочитанного), вызывая обработчики канала. Задержка между воркерами -
+    INVALIDATION_POLL_SECONDS. До start() события не публикуются: скрипты,
+    использующие репозитории без сервера, работают без фонового потока.
+    """
+
+    def __init__(self, bind=engine, poll_seconds: float = INVALIDATION_POLL_SECONDS):
+        self.bind = bind
+        self.poll_seconds = poll_seconds
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.published = 0
+        self.received = 0
+        self._handlers: Dict[str, Callable[[str], None]] = {}
+        self._pending: List[Tuple[str, str]] = []
+        self._lock = threading.Lock()
+        self._last_id = 0
+        self._pruned_at = 0.0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def subscribe(self, channel: str, handler: Callable[[str], None]) -> None:
+        """Обработчик событий канала от других процессов"""
+        self._handlers[channel] = handler
+
+    @property
+    def active(self) -> bool:
+        return self._thread is not None
+
+    def publish(self, channel: str, payload: str) -> None:
+        """Сообщить другим процессам об изменении (локальный кэш сбрасывает вызывающий)"""
+        if self._thread is None:
+            return
+        with self._lock:
+            self._pending.append((channel, payload))
+
+    def start(self) -> None:
+        """Запуск фонового потока; события, записанные до запуска, пропускаются"""
+        if self._thread is not None:
+            return
+        with self.bind.connect() as connection:
+            self._last_id = connection.execute(select(func.max(DBCacheInvalidation.id))).scalar() or 0
+        # Новый origin: после fork (gunicorn --preload) он не совпадает с родительским
+        self.origin = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="cache-invalidation", daemon=True)
+        self._thread.start()
+
+    def shutdown(self) -> None:
+        """Остановка потока с записью оставшихся событий"""
+        thread, self._thread = self._thread, None
+        if thread is None:
+            return
+        self._stop.set()
+        thread.join()
+        self._flush()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.sync()
+            except Exception:
+                logger.exception("Cache invalidation sync failed")
+
+    def sync(self) -> None:
+        """Запись своих событий и применение событий других процессов"""
+        self._flush()
+        with self.bind.connect() as connection:
+            rows = connection.execute(
+                select(DBCacheInvalidation.id, DBCacheInvalidation.channel, DBCacheInvalidation.payload)
+                .where(DBCacheInvalidation.id > self._last_id, DBCacheInvalidation.origin != self.origin)
+                .order_by(DBCacheInvalidation.id)
+            ).all()
+        for event_id, channel, payload in rows:
+            handler = self._handlers.get(channel)
+            if handler is not None:
+                handler(payload)
+            self._last_id = event_id
+            self.received += 1
+        if time.monotonic() - self._pruned_at >= INVALIDATION_PRUNE_SECONDS:
+            self._prune()
+
+    def _flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, []
+        if not pending:
+            return
+        now = datetime.utcnow()
+        try:
+            with self.bind.begin() as connection:
+                connection.execute(insert(DBCacheInvalidation), [
+                    {"origin": self.origin, "channel": channel, "payload": payload, "created_at": now}
+                    for channel, payload in pending
+                ])
+        except Exception:
+            # Повтор на следующей итерации
+            with self._lock:
+                self._pending[:0] = pending
+            raise
+        self.published += len(pending)
+
+    def _prune(self) -> None:
+        self._pruned_at = time.monotonic()
+        cutoff = datetime.utcnow() - timedelta(seconds=INVALIDATION_RETENTION_SECONDS)
+        # Последнее событие остается: без него SQLite снова выдает id с 1, и воркеры,
+        # читающие события с id больше последнего прочитанного, пропускают новые
+        latest = select(func.max(DBCacheInvalidation.id)).scalar_subquery()
+        with self.bind.begin() as connection:
+            connection.execute(delete(DBCacheInvalidation).where(
+                DBCacheInvalidation.created_at < cutoff, DBCacheInvalidation.id < latest))
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {"published": self.published, "received": self.received, "pending": pending}
+
+
+invalidation_bus = InvalidationBus()
+
+registry.gauge("cache_invalidation_events", "События межпроцессной инвалидации кэшей", lambda: [
+    ({"stat": key}, value) for key, value in invalidation_bus.stats().items()
+])
@@ -0,0 +1,264 @@
+"""Фотографии автомобилей: файлы на диске по хешу содержимого
+
+Загрузка пишется во временный файл по частям (с подсчетом SHA-256), без
+накопления тела запроса в памяти, и после записи метаданных переносится в
+blobs/<2 символа хеша>/<хеш>; одинаковые файлы хранятся один раз. Файлы
+отдаются FileResponse с Range и ETag (хеш содержимого): без копирования через
+Python, если сервер поддерживает расширение ASGI pathsend, или через nginx
+(MEDIA_ACCEL_REDIRECT - X-Accel-Redirect, sendfile). Миниатюры строятся в пуле
+процессов (thumbnails.py) после ответа на загрузку.
+"""
+import hashlib
+import logging
+import os
+import tempfile
+from typing import AsyncIterator, List, NamedTuple, Optional, Sequence
+
+from fastapi import Request, Response
+from fastapi.responses import FileResponse
+from starlette.concurrency import run_in_threadpool
+
+from content_encoding import matched_etag, not_modified_response
+from database import SessionLocal
+from metrics import Counter, registry
+from models import CarPhoto
+from repository import PhotoRepository
+from thumbnails import THUMBNAIL_SIZE, ThumbnailPool
+
+# Настройки хранения фотографий (переменные окружения)
+MEDIA_ROOT = os.getenv("MEDIA_ROOT", "./media")
+MEDIA_MAX_UPLOAD_BYTES = int(os.getenv("MEDIA_MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+# Содержимое по адресу фотографии не меняется: кэшируется клиентами без проверки
+MEDIA_CACHE_CONTROL = os.getenv("MEDIA_CACHE_CONTROL", "public, max-age=31536000, immutable")
+# Префикс internal-location nginx для MEDIA_ROOT (пусто - файлы отдает приложение)
+MEDIA_ACCEL_REDIRECT = os.getenv("MEDIA_ACCEL_REDIRECT", "")
+
+THUMBNAIL_PENDING = "pending"
+THUMBNAIL_READY = "ready"
+THUMBNAIL_FAILED = "failed"
+THUMBNAIL_UNSUPPORTED = "unsupported"
+
+# Сигнатуры допустимых изображений: тип определяется по содержимому, а не по Content-Type
+IMAGE_SIGNATURES = (
+    (b"\xff\xd8\xff", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "image/png"),
+    (b"GIF87a", "image/gif"),
+    (b"GIF89a", "image/gif"),
+)
+SNIFF_BYTES = 12
+
+media_thumbnails = registry.register(Counter(
+    "media_thumbnails_total", "Построенные миниатюры фотографий по результату", ("result",),
+))
+
+logger = logging.getLogger("carshop.media")
+
+
+class UploadRejected(Exception):
+    """Загрузка отклонена: status_code и detail для ответа"""
+
+    def __init__(self, status_code: int, detail: str):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+
+
+class Upload(NamedTuple):
+    """Принятый файл во временном каталоге хранилища"""
+    path: str
+    digest: str
+    size: int
+    content_type: str
+
+
+def sniff_image_type(head: bytes) -> Optional[str]:
+    """Тип изображения по первым байтам; None - неподдерживаемый формат"""
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    for signature, content_type in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return content_type
+    return None
+
+
+def _write_chunk(file, hasher, chunk: bytes) -> None:
+    hasher.update(chunk)
+    file.write(chunk)
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class BlobStore:
+    """Файлы по хешу содержимого в каталоге root"""
+
+    def __init__(self, root: str = MEDIA_ROOT):
+        self.root = root
+
+    def relative_path(self, digest: str) -> str:
+        return f"blobs/{digest[:2]}/{digest}"
+
+    def thumbnail_relative_path(self, digest: str) -> str:
+        return f"thumbs/{digest[:2]}/{digest}-{THUMBNAIL_SIZE}.jpg"
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, self.relative_path(digest))
+
+    def thumbnail_path(self, digest: str) -> str:
+        return os.path.join(self.root, self.thumbnail_relative_path(digest))
+
+    async def receive(self, chunks: AsyncIterator[bytes], max_bytes: int = MEDIA_MAX_UPLOAD_BYTES) -> Upload:
+        """Запись тела запроса во временный файл по частям с подсчетом хеша"""
+        temp_dir = os.path.join(self.root, "tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=temp_dir, suffix=".upload")
+        hasher = hashlib.sha256()
+        size = 0
+        head = b""
+        content_type = None
+        try:
+            with os.fdopen(fd, "wb") as file:
+                async for chunk in chunks:
+                    if not chunk:
+                        continue
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise UploadRejected(413, f"Файл больше {max_bytes} байт")
+                    if content_type is None:
+                        head += chunk[:SNIFF_BYTES - len(head)]
+                        if len(head) >= SNIFF_BYTES:
+                            content_type = self._check_type(head)
+                    await run_in_threadpool(_write_chunk, file, hasher, chunk)
+            if content_type is None:
+                content_type = self._check_type(head)
+        except BaseException:
+            _remove(path)
+            raise
+        return Upload(path, hasher.hexdigest(), size, content_type)
+
+    @staticmethod
+    def _check_type(head: bytes) -> str:
+        content_type = sniff_image_type(head)
+        if content_type is None:
+            raise UploadRejected(415, "Поддерживаются изображения JPEG, PNG, GIF и WebP")
+        return content_type
+
+    def commit(self, upload: Upload) -> None:
+        """Перенос принятого файла на постоянное место (атомарно; одинаковое содержимое заменяется)"""
+        path = self.path(upload.digest)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(upload.path, path)
+
+    def discard(self, upload: Upload) -> None:
+        _remove(upload.path)
+
+    def remove(self, digest: str) -> None:
+        _remove(self.path(digest))
+        _remove(self.thumbnail_path(digest))
+
+
+blob_store = BlobStore()
+thumbnail_pool = ThumbnailPool()
+
+
+def _thumbnail_done(digest: str, ok: bool) -> None:
+    media_thumbnails.inc(THUMBNAIL_READY if ok else THUMBNAIL_FAILED)
+    db = SessionLocal()
+    try:
+        PhotoRepository(db).set_thumbnail(digest, THUMBNAIL_READY if ok else THUMBNAIL_FAILED)
+    finally:
+        db.close()
+
+
+def schedule_thumbnail(digest: str) -> None:
+    """Построение миниатюры в пуле процессов; состояние в БД обновляется по завершении"""
+    try:
+        thumbnail_pool.submit(digest, blob_store.path(digest), blob_store.thumbnail_path(digest), _thumbnail_done)
+    except Exception:
+        # Фотография остается в состоянии pending: задача повторится при запросе миниатюры
+        logger.exception("Thumbnail %s was not scheduled", digest)
+
+
+def car_exists(car_id: int) -> bool:
+    """Проверка автомобиля до приема файла (короткая сессия: загрузка не держит соединение)"""
+    db = SessionLocal()
+    try:
+        return PhotoRepository(db).car_exists(car_id)
+    finally:
+        db.close()
+
+
+def create_photo(car_id: int, upload: Upload) -> Optional[CarPhoto]:
+    """Метаданные и перенос принятого файла; None - автомобиль не найден"""
+    ready = os.path.exists(blob_store.thumbnail_path(upload.digest))
+    if ready:
+        thumbnail = THUMBNAIL_READY
+    else:
+        thumbnail = THUMBNAIL_PENDING if thumbnail_pool.available else THUMBNAIL_UNSUPPORTED
+    db = SessionLocal()
+    try:
+        photo = PhotoRepository(db).create(car_id, upload.digest, upload.content_type, upload.size, thumbnail)
+    finally:
+        db.close()
+    if photo is None:
+        blob_store.discard(upload)
+        return None
+    # Файл переносится после записи метаданных: очистка не удалит его как неиспользуемый
+    blob_store.commit(upload)
+    if thumbnail == THUMBNAIL_PENDING:
+        schedule_thumbnail(upload.digest)
+    return photo
+
+
+def release_blobs(digests: List[str]) -> None:
+    """Удаление файлов, на которые больше не ссылается ни одна фотография"""
+    if not digests:
+        return
+    db = SessionLocal()
+    try:
+        unused = PhotoRepository(db).unreferenced(digests)
+    finally:
+        db.close()
+    for digest in unused:
+        blob_store.remove(digest)
+
+
+def collect_orphaned_photos(deleted_digests: Sequence[str] = ()) -> int:
+    """Фоновая очистка после удаления автомобилей: файлы фотографий, удаленных вместе
+
+    с автомобилями (deleted_digests), и фотографии автомобилей, удаленных в шардах.
+    """
+    db = SessionLocal()
+    try:
+        digests = list(deleted_digests) + PhotoRepository(db).delete_orphans()
+    finally:
+        db.close()
+    release_blobs(digests)
+    return len(digests)
+
+
+def photo_response(request: Request, photo: CarPhoto, thumbnail: bool = False) -> Optional[Response]:
+    """Файл фотографии или миниатюры с ETag, Range и долгим кэшированием; None - файла нет"""
+    if thumbnail:
+        relative_path, etag, media_type = (
+            blob_store.thumbnail_relative_path(photo.digest), f'"{photo.digest}-{THUMBNAIL_SIZE}"', "image/jpeg")
+    else:
+        relative_path, etag, media_type = blob_store.relative_path(photo.digest), f'"{photo.digest}"', photo.content_type
+    matched = matched_etag(request, etag)
+    if matched is not None:
+        return not_modified_response(matched, MEDIA_CACHE_CONTROL)
+    headers = {"ETag": etag, "Cache-Control": MEDIA_CACHE_CONTROL}
+    if MEDIA_ACCEL_REDIRECT:
+        # Файл отдает nginx (sendfile, Range); приложение только проверяет доступ
+        headers["X-Accel-Redirect"] = f"{MEDIA_ACCEL_REDIRECT.rstrip('/')}/{relative_path}"
+        return Response(media_type=media_type, headers=headers)
+    path = os.path.join(blob_store.root, relative_path)
+    try:
+        stat_result = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat_result)
@@ -0,0 +1,238 @@
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _StatementCounter
+from contextvars import ContextVar
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# Настройки инструментирования (переменные окружения)
+SLOW_REQUEST_MS = float(os.getenv("SLOW_REQUEST_MS", "500"))
+SLOW_REQUEST_LOG = os.getenv("SLOW_REQUEST_LOG", "1") == "1"
+# Запрос считается подозрительным на N+1, если один и тот же SQL выполнен столько раз
+N_PLUS_ONE_THRESHOLD = int(os.getenv("N_PLUS_ONE_THRESHOLD", "10"))
+# Сколько SQL-запросов сохранять для журнала медленных запросов
+SLOW_LOG_MAX_STATEMENTS = 50
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+HASH_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+slow_logger = logging.getLogger("carshop.slow_requests")
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple, extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class Counter:
+    """Счетчик Prometheus с метками"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1.0) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = list(self._values.items())
+        lines += [f"{self.name}{_format_labels(self.labelnames, labels)} {value}" for labels, value in items]
+        return lines
+
+
+class Histogram:
+    """Гистограмма Prometheus с метками"""
+
+    def __init__(self, name: str, documentation: str, labelnames: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._values: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = [(labels, (list(s[0]), s[1], s[2])) for labels, s in self._values.items()]
+        for labels, (counts, total, count) in items:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                bucket_labels = _format_labels(self.labelnames, labels, 'le="' + le + '"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+
+class Registry:
+    """Набор метрик и функций, вычисляющих значения gauge в момент запроса /metrics"""
+
+    def __init__(self):
+        self._metrics: list = []
+        self._gauges: List[Tuple[str, str, Callable[[], Iterable[Tuple[dict, float]]]]] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def gauge(self, name: str, documentation: str, collect: Callable[[], Iterable[Tuple[dict, float]]]) -> None:
+        """Gauge, значения которого collect() возвращает как [(метки, значение)]"""
+        self._gauges.append((name, documentation, collect))
+
+    def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics:
+            lines += metric.render()
+        for name, documentation, collect in self._gauges:
+            lines += [f"# HELP {name} {documentation}", f"# TYPE {name} gauge"]
+            for labels, value in collect():
+                names = tuple(labels)
+                lines.append(f"{name}{_format_labels(names, tuple(labels[n] for n in names))} {value}")
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+http_requests = registry.register(Counter(
+    "http_requests_total", "HTTP-запросы по маршруту, методу и коду ответа", ("route", "method", "status")))
+http_latency = registry.register(Histogram(
+    "http_request_duration_seconds", "Длительность HTTP-запросов", ("route", "method")))
+db_queries = registry.register(Counter(
+    "db_queries_total", "SQL-запросы по маршруту", ("route",)))
+db_query_latency = registry.register(Histogram(
+    "db_query_duration_seconds", "Длительность SQL-запросов", ("route",)))
+db_queries_per_request = registry.register(Histogram(
+    "db_queries_per_request", "Число SQL-запросов на HTTP-запрос", ("route",),
+    buckets=(0, 1, 2, 3, 5, 10, 20, 50, 100)))
+n_plus_one_suspected = registry.register(Counter(
+    "db_n_plus_one_suspected_total", "Запросы с повторяющимся SQL (подозрение на N+1)", ("route",)))
+password_hash_latency = registry.register(Histogram(
+    "password_hash_duration_seconds", "Длительность хеширования и проверки паролей", ("operation",),
+    buckets=HASH_BUCKETS))
+slow_requests = registry.register(Counter(
+    "http_slow_requests_total", "Запросы длительнее SLOW_REQUEST_MS", ("route",)))
+
+
+class RequestStats:
+    """SQL-статистика текущего HTTP-запроса"""
+
+    __slots__ = ("scope", "queries", "query_time", "statements", "counts")
+
+    def __init__(self, scope: dict):
+        self.scope = scope
+        self.queries = 0
+        self.query_time = 0.0
+        self.statements: List[Tuple[str, float]] = []
+        self.counts: _StatementCounter = _StatementCounter()
+
+    @property
+    def route(self) -> str:
+        # Шаблон пути вместо фактического URL, чтобы число меток было ограничено;
+        # scope["route"] заполняется роутером FastAPI до вызова эндпоинта
+        return getattr(self.scope.get("route"), "path", None) or "unmatched"
+
+
+_request_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+def record_query(statement: str, duration: float) -> None:
+    """Учет выполненного SQL-запроса (вызывается из событий движка)"""
+    stats = _request_stats.get()
+    route = stats.route if stats is not None else "background"
+    db_queries.inc(route)
+    db_query_latency.observe(duration, route)
+    if stats is not None:
+        stats.queries += 1
+        stats.query_time += duration
+        stats.counts[statement] += 1
+        if SLOW_REQUEST_LOG and len(stats.statements) < SLOW_LOG_MAX_STATEMENTS:
+            stats.statements.append((statement, duration))
+
+
+class MetricsMiddleware:
+    """ASGI-middleware: задержка и коды ответов по маршрутам, SQL на запрос, журнал медленных запросов"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats(scope)
+        token = _request_stats.set(stats)
+        status_code = 500
+        streaming = False
+        start = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status_code, streaming
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                streaming = any(
+                    name == b"content-type" and value.startswith(b"text/event-stream")
+                    for name, value in message.get("headers", ())
+                )
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            _request_stats.reset(token)
+            self._observe(scope["method"], status_code, duration, stats, streaming)
+
+    @staticmethod
+    def _observe(method: str, status_code: int, duration: float, stats: RequestStats, streaming: bool) -> None:
+        route = stats.route
+        http_requests.inc(route, method, str(status_code))
+        if streaming:
+            # Длительность потока событий - время подключения клиента, а не задержка
+            return
+        http_latency.observe(duration, route, method)
+        db_queries_per_request.observe(stats.queries, route)
+        if stats.counts and max(stats.counts.values()) >= N_PLUS_ONE_THRESHOLD:
+            n_plus_one_suspected.inc(route)
+        if duration * 1000 >= SLOW_REQUEST_MS:
+            slow_requests.inc(route)
+            if SLOW_REQUEST_LOG:
+                statements = "\n".join(f"  [{d * 1000:.1f} ms] {s}" for s, d in stats.statements)
+                slow_logger.warning(
+                    "Slow request %s %s -> %s: %.1f ms, %d SQL queries (%.1f ms)\n%s",
+                    method, route, status_code, duration * 1000, stats.queries,
+                    stats.query_time * 1000, statements,
+                )
+
+
+def render_metrics() -> str:
+    """Все метрики в текстовом формате Prometheus"""
+    return registry.render()
@@ -0,0 +1,217 @@
+"""Версионированные миграции схемы БД
+
+Схема создается и изменяется отдельным шагом, а не при импорте приложения:
+python migrations.py (serve.py выполняет его в главном процессе до запуска
+воркеров). При старте воркер только сверяет версию схемы одним запросом к
+schema_migrations; при DB_AUTO_MIGRATE=1 (по умолчанию, удобно для разработки)
+недостающие миграции применяются, иначе старт завершается ошибкой.
+
+Новая миграция добавляется в конец MIGRATIONS со следующим номером.
+Миграции применяются к основной БД и к каждому шарду автомобилей (CAR_SHARD_URLS).
+
+Запуск: python migrations.py  (python migrations.py --check - только проверка)
+"""
+import argparse
+import logging
+import os
+import sys
+from typing import Callable, List, NamedTuple, Optional
+
+from sqlalchemy import Table, inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateTable
+
+from database import Base, DBCar, DBUser, schema_transaction
+from search import create_search_index
+from sharding import car_shards
+from stats import create_car_stats
+
+# Применять недостающие миграции при старте приложения
+DB_AUTO_MIGRATE = os.getenv("DB_AUTO_MIGRATE", "1") == "1"
+
+MIGRATIONS_TABLE = "schema_migrations"
+MIGRATIONS_TABLE_DDL = (
+    f"CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE} ("
+    "version INTEGER PRIMARY KEY, name VARCHAR NOT NULL, applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+)
+
+logger = logging.getLogger("carshop.migrations")
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    apply: Callable[[Connection], None]
+
+
+def _add_missing_columns(connection: Connection) -> None:
+    """Добавление в существующие таблицы колонок, появившихся в моделях
+
+    create_all не изменяет уже созданные таблицы; новые колонки должны иметь
+    server_default или допускать NULL.
+    """
+    inspector = inspect(connection)
+    for table in Base.metadata.sorted_tables:
+        existing = {column["name"] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            column_type = column.type.compile(dialect=connection.dialect)
+            ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            if column.server_default is not None:
+                ddl += f" DEFAULT {column.server_default.arg}"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+            connection.execute(text(ddl))
+
+
+def _create_car_indexes(connection: Connection) -> None:
+    """create_all не добавляет новые индексы в уже существующие таблицы"""
+    for index in DBCar.__table__.indexes:
+        index.create(bind=connection, checkfirst=True)
+
+
+def _initial_schema(connection: Connection) -> None:
+    """Схема на момент введения миграций; идемпотентна для БД, созданных до них"""
+    Base.metadata.create_all(bind=connection)
+    _add_missing_columns(connection)
+    _create_car_indexes(connection)
+    create_search_index(connection)
+    create_car_stats(connection)
+
+
+def _create_tables(connection: Connection) -> None:
+    """Новые таблицы моделей (create_all пропускает существующие)"""
+    Base.metadata.create_all(bind=connection)
+
+
+def _dealer_key(connection: Connection) -> None:
+    """cars.dealer_id с индексом, размещение дилеров по шардам и счетчик id"""
+    _create_tables(connection)
+    _add_missing_columns(connection)
+    _create_car_indexes(connection)
+
+
+def _rebuild_with_autoincrement(connection: Connection, table: Table) -> bool:
+    """Пересоздание таблицы SQLite с AUTOINCREMENT (ALTER TABLE его не добавляет)
+
+    Строки копируются с прежними id; индексы таблицы создаются заново, триггеры
+    на ней удаляются вместе со старой таблицей. False - пересоздание не нужно.
+    """
+    if connection.dialect.name != "sqlite":
+        return False
+    ddl = connection.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"), {"name": table.name}
+    ).scalar()
+    if "AUTOINCREMENT" in ddl.upper():
+        return False
+    rebuilt = f"{table.name}_rebuild"
+    create = str(CreateTable(table).compile(dialect=connection.dialect))
+    connection.execute(text(create.replace(f"CREATE TABLE {table.name} ", f"CREATE TABLE {rebuilt} ", 1)))
+    columns = ", ".join(column.name for column in table.columns)
+    connection.execute(text(f"INSERT INTO {rebuilt} ({columns}) SELECT {columns} FROM {table.name}"))
+    connection.execute(text(f"DROP TABLE {table.name}"))
+    connection.execute(text(f"ALTER TABLE {rebuilt} RENAME TO {table.name}"))
+    for index in table.indexes:
+        index.create(bind=connection)
+    return True
+
+
+def _autoincrement_ids(connection: Connection) -> None:
+    """Неповторяющиеся id автомобилей и пользователей
+
+    SQLite без AUTOINCREMENT выдает id удаленной последней строки повторно: новая
+    запись получала бы ETag, фотографии и токены удаленной.
+    """
+    if _rebuild_with_autoincrement(connection, DBCar.__table__):
+        create_search_index(connection)
+        create_car_stats(connection)
+    _rebuild_with_autoincrement(connection, DBUser.__table__)
+
+
+MIGRATIONS: List[Migration] = [
+    Migration(1, "initial schema", _initial_schema),
+    # cars.version, users.version (на новой БД их уже создала миграция 1)
+    Migration(2, "row version columns", _add_missing_columns),
+    Migration(3, "car photos", _create_tables),
+    Migration(4, "car dealer key", _dealer_key),
+    Migration(5, "shared table versions", _create_tables),
+    Migration(6, "non-reusable car and user ids", _autoincrement_ids),
+]
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def current_version(connection: Connection) -> int:
+    """Версия схемы; 0 - миграции еще не применялись"""
+    if not inspect(connection).has_table(MIGRATIONS_TABLE):
+        return 0
+    return connection.execute(text(f"SELECT MAX(version) FROM {MIGRATIONS_TABLE}")).scalar() or 0
+
+
+def pending_migrations(bind: Optional[Engine] = None) -> List[Migration]:
+    """Непримененные миграции: проверка без блокировок записи, по первичному ключу schema_migrations
+
+    bind - одна БД; по умолчанию - самая старая схема среди основной БД и шардов.
+    """
+    version = LATEST_VERSION
+    for each in [bind] if bind is not None else car_shards.engines:
+        with each.connect() as connection:
+            version = min(version, current_version(connection))
+    return [migration for migration in MIGRATIONS if migration.version > version]
+
+
+def migrate() -> List[int]:
+    """Применение недостающих миграций к основной БД и шардам; возвращает номера примененных
+
+    Миграции выполняются в одной транзакции под блокировкой схемы, поэтому
+    одновременно запущенные процессы применяют их ровно один раз.
+    """
+    applied = set()
+    for bind in car_shards.engines:
+        if not pending_migrations(bind):
+            continue
+        with schema_transaction(bind) as connection:
+            connection.execute(text(MIGRATIONS_TABLE_DDL))
+            version = current_version(connection)
+            for migration in MIGRATIONS:
+                if migration.version <= version:
+                    continue
+                logger.info("Applying migration %d to %s: %s", migration.version, bind.url.database, migration.name)
+                migration.apply(connection)
+                connection.execute(
+                    text(f"INSERT INTO {MIGRATIONS_TABLE} (version, name) VALUES (:version, :name)"),
+                    {"version": migration.version, "name": migration.name},
+                )
+                applied.add(migration.version)
+    return sorted(applied)
+
+
+def ensure_schema(auto_migrate: bool = DB_AUTO_MIGRATE) -> None:
+    """Проверка версии схемы при старте приложения"""
+    pending = pending_migrations()
+    if not pending:
+        return
+    if not auto_migrate:
+        raise RuntimeError(
+            f"Database schema is at version {pending[0].version - 1}, expected {LATEST_VERSION}: "
+            "run python migrations.py"
+        )
+    migrate()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--check", action="store_true", help="код возврата 1, если есть непримененные миграции")
+    args = parser.parse_args()
+    if args.check:
+        pending = pending_migrations()
+        for migration in pending:
+            print(f"pending {migration.version}: {migration.name}")
+        return 1 if pending else 0
+    applied = migrate()
+    print(f"Применены миграции: {applied}" if applied else f"Схема актуальна (версия {LATEST_VERSION})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
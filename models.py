@@ -1,6 +1,6 @@
 import enum
 from pydantic import BaseModel
-from typing import Optional
+from typing import Dict, List, Optional
 from datetime import datetime
 
 class CarBase(BaseModel):
@@ -10,6 +10,8 @@ class CarBase(BaseModel):
     year: int
     price: float
     color: Optional[str] = None
+    # Дилер (арендатор): определяет шард автомобиля
+    dealer_id: int = 0
 
 class CarCreate(CarBase):
     """Модель создания автомобиля"""
@@ -28,10 +30,85 @@ class Car(CarBase):
     id: int
     created_at: datetime
     updated_at: datetime
+    version: int = 1
 
     class Config:
         from_attributes = True
 
+class CarPhoto(BaseModel):
+    """Фотография автомобиля (файл - GET /cars/{car_id}/photos/{id})"""
+    id: int
+    car_id: int
+    content_type: str
+    size: int
+    digest: str
+    thumbnail: str
+    created_at: datetime
+
+class CarPage(BaseModel):
+    """Страница списка автомобилей (keyset-пагинация)"""
+    items: List[Car]
+    next_cursor: Optional[str] = None
+
+class CarSearchResult(BaseModel):
+    """Результаты полнотекстового поиска и фасеты (только на первой странице)"""
+    items: List[Car]
+    next_cursor: Optional[str] = None
+    facets: Optional[Dict[str, Dict[str, int]]] = None
+    # Совпадений больше SEARCH_MAX_CANDIDATES: ранжированы и листаются только лучшие по bm25
+    truncated: bool = False
+
+class CarBatchResult(BaseModel):
+    """Результат пакетного изменения: затронутые id и id, которых нет в БД"""
+    affected: int
+    ids: List[int]
+    not_found: List[int] = []
+
+    @classmethod
+    def from_affected(cls, requested_ids: Optional[List[int]], affected: List[int]) -> "CarBatchResult":
+        """Итог операции; для списка id - также id, не найденные в БД"""
+        found = set(affected)
+        not_found = [car_id for car_id in requested_ids if car_id not in found] if requested_ids is not None else []
+        return cls(affected=len(affected), ids=sorted(affected), not_found=not_found)
+
+class CarStatsEntry(BaseModel):
+    """Количество автомобилей, цены и стоимость склада"""
+    count: int
+    avg_price: Optional[float] = None
+    min_price: Optional[float] = None
+    max_price: Optional[float] = None
+    inventory_value: float
+
+class CarStatsGroup(CarStatsEntry):
+    """Статистика группы (марка, год или пара марка-год)"""
+    brand: Optional[str] = None
+    year: Optional[int] = None
+
+class CarStatsFreshness(BaseModel):
+    """Актуальность сводки: обновляется ли она при записи, время изменения и перестройки"""
+    incremental: bool
+    updated_at: Optional[datetime] = None
+    rebuilt_at: Optional[datetime] = None
+    percentiles_loaded_at: Optional[datetime] = None
+
+class CarStats(BaseModel):
+    """Статистика склада по сводной таблице и перцентили цены"""
+    groups: List[CarStatsGroup]
+    total: CarStatsEntry
+    percentiles: Optional[Dict[str, Optional[float]]] = None
+    freshness: CarStatsFreshness
+
+class BulkRowError(BaseModel):
+    """Ошибка импорта строки"""
+    line: int
+    error: str
+
+class BulkImportResult(BaseModel):
+    """Отчет о пакетном импорте автомобилей"""
+    inserted: int
+    failed: int
+    errors: List[BulkRowError]
+
 class UserRole(enum.Enum):
     """Роли пользователей в системе"""
     ADMIN = "admin"      # Полный доступ ко всем функциям
@@ -70,6 +147,17 @@ class User(UserBase):
     is_active: bool
     created_at: datetime
     updated_at: datetime
+    version: int = 1
+
+class Principal(BaseModel):
+    """Аутентифицированный пользователь (кэшируется между запросами)"""
+    id: int
+    username: str
+    role: UserRole
+    is_active: bool
+
+    class Config:
+        frozen = True
 
 class UserLogin(BaseModel):
     """Модель для входа в систему"""
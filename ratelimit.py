@@ -0,0 +1,446 @@
+import ipaddress
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional, Tuple
+
+import anyio.to_thread
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+from sqlalchemy import create_engine, event, text
+
+from metrics import Counter, registry
+
+# Настройки ограничения частоты запросов (переменные окружения)
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+# memory - корзины в памяти процесса, sqlite - общие для воркеров в отдельной БД
+RATE_LIMIT_STORE = os.getenv("RATE_LIMIT_STORE", "memory")
+RATE_LIMIT_DATABASE_URL = os.getenv("RATE_LIMIT_DATABASE_URL", "sqlite:///./ratelimit.db")
+# Максимум корзин в хранилище; дольше всех не использованные вытесняются
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+# Лимиты в формате "запросов в секунду/емкость корзины"; 0 - без ограничения.
+# Общий лимит на IP по умолчанию выключен: за прокси без RATE_LIMIT_TRUST_PROXY
+# у всех клиентов один IP, и лимит ограничивал бы весь сайт
+RATE_LIMIT_PER_IP = os.getenv("RATE_LIMIT_PER_IP", "0")
+# Брать IP клиента из X-Forwarded-For (только за доверенным прокси)
+RATE_LIMIT_TRUST_PROXY = os.getenv("RATE_LIMIT_TRUST_PROXY", "0") == "1"
+# Лимиты отдельных маршрутов на IP: "МЕТОД путь=лимит,...". По умолчанию, как и общий
+# лимит, только с доверенным прокси; вход без него ограничивает лимит на имя пользователя
+RATE_LIMIT_ROUTES = os.getenv("RATE_LIMIT_ROUTES", "POST /auth/login=1/10" if RATE_LIMIT_TRUST_PROXY else "")
+RATE_LIMIT_EXEMPT_PATHS = os.getenv("RATE_LIMIT_EXEMPT_PATHS", "/metrics")
+
+# Вход: лимит попыток на имя пользователя из одной сети и экспоненциальная задержка после неудач
+LOGIN_RATE_LIMIT_PER_USERNAME = os.getenv("LOGIN_RATE_LIMIT_PER_USERNAME", "0.2/10")
+# Сеть клиента для лимита на имя: перебор из других сетей не блокирует вход владельцу
+LOGIN_IPV4_PREFIX = 24
+LOGIN_IPV6_PREFIX = 64
+LOGIN_FREE_ATTEMPTS = int(os.getenv("LOGIN_FREE_ATTEMPTS", "3"))
+LOGIN_BACKOFF_BASE_SECONDS = float(os.getenv("LOGIN_BACKOFF_BASE_SECONDS", "1"))
+LOGIN_BACKOFF_MAX_SECONDS = float(os.getenv("LOGIN_BACKOFF_MAX_SECONDS", "900"))
+# Через сколько секунд без неудачных попыток счетчик неудач обнуляется
+LOGIN_FAILURE_RESET_SECONDS = float(os.getenv("LOGIN_FAILURE_RESET_SECONDS", "3600"))
+
+# Как часто общее хранилище удаляет простаивающие корзины
+RATE_LIMIT_PRUNE_SECONDS = 60
+# Корзина, не использованная столько секунд, считается полной и удаляется
+RATE_LIMIT_IDLE_SECONDS = 600
+
+rate_limited = registry.register(Counter(
+    "rate_limited_total", "Запросы, отклоненные ограничением частоты", ("scope",)))
+
+
+class Limit(NamedTuple):
+    """Маркерная корзина: rate маркеров в секунду, не больше burst"""
+    rate: float
+    burst: float
+
+
+def parse_limit(value: str) -> Optional[Limit]:
+    """Лимит из строки "rate/burst" (None - без ограничения)"""
+    rate, _, burst = value.strip().partition("/")
+    rate = float(rate or 0)
+    if rate <= 0:
+        return None
+    return Limit(rate, max(1.0, float(burst or rate)))
+
+
+def parse_route_limits(value: str) -> Dict[Tuple[str, str], Limit]:
+    """Лимиты маршрутов из строки "POST /auth/login=1/10,GET /cars/search=20/40" """
+    limits = {}
+    for item in value.split(","):
+        if not item.strip():
+            continue
+        route, _, limit = item.partition("=")
+        method, _, path = route.strip().partition(" ")
+        parsed = parse_limit(limit)
+        if parsed is not None:
+            limits[(method.upper(), path.strip())] = parsed
+    return limits
+
+
+class BackoffPolicy(NamedTuple):
+    """Экспоненциальная задержка: после free_attempts неудач - base, 2*base, 4*base... до max_seconds"""
+    free_attempts: int
+    base_seconds: float
+    max_seconds: float
+    reset_seconds: float
+
+    def delay(self, failures: int) -> float:
+        if failures <= self.free_attempts:
+            return 0.0
+        return min(self.max_seconds, self.base_seconds * 2 ** min(failures - self.free_attempts - 1, 62))
+
+
+class MemoryBucketStore:
+    """Корзины и счетчики неудач в памяти процесса
+
+    Один OrderedDict на все ключи: каждая операция O(1), при превышении
+    max_keys вытесняется запись, которая дольше всех не использовалась.
+    """
+
+    blocking = False
+
+    def __init__(self, max_keys: int = RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._data: "OrderedDict[str, list]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, limit: Limit, now: float) -> float:
+        """Списать маркер; 0 - разрешено, иначе секунд до появления маркера"""
+        with self._lock:
+            bucket = self._data.get(key)
+            if bucket is None:
+                bucket = self._data[key] = [limit.burst, now]
+                self._evict()
+            else:
+                self._data.move_to_end(key)
+                bucket[0] = min(limit.burst, bucket[0] + max(0.0, now - bucket[1]) * limit.rate)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return 0.0
+            return (1 - bucket[0]) / limit.rate
+
+    def blocked_for(self, key: str, now: float) -> float:
+        """Сколько секунд ключ еще заблокирован после неудач"""
+        with self._lock:
+            state = self._data.get(key)
+            return max(0.0, state[1] - now) if state is not None else 0.0
+
+    def record_failure(self, key: str, policy: BackoffPolicy, now: float) -> float:
+        """Учесть неудачу; возвращает задержку до следующей попытки"""
+        with self._lock:
+            state = self._data.get(key)
+            if state is None or now - state[2] >= policy.reset_seconds:
+                state = self._data[key] = [0, 0.0, now]
+                self._evict()
+            else:
+                self._data.move_to_end(key)
+            state[0] += 1
+            state[2] = now
+            delay = policy.delay(state[0])
+            state[1] = now + delay
+            return delay
+
+    def reset(self, key: str) -> None:
+        with self._lock:
+            self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        return {"keys": len(self._data), "max_keys": self.max_keys}
+
+    def _evict(self) -> None:
+        while len(self._data) > self.max_keys:
+            self._data.popitem(last=False)
+
+
+class SQLiteBucketStore:
+    """Корзины и счетчики неудач, общие для воркеров, в отдельной БД SQLite
+
+    Отдельный файл не конкурирует за блокировку записи с основной БД.
+    Списание маркера - один UPSERT: условие WHERE не дает обновить корзину
+    без маркеров, и тогда RETURNING не возвращает строку. Простаивающие
+    корзины периодически удаляются, число строк ограничено max_keys.
+    """
+
+    blocking = True
+
+    DDL = [
+        """CREATE TABLE IF NOT EXISTS rate_buckets (
+            key TEXT PRIMARY KEY, tokens REAL NOT NULL, updated_at REAL NOT NULL) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS ix_rate_buckets_updated_at ON rate_buckets(updated_at)",
+        """CREATE TABLE IF NOT EXISTS login_failures (
+            key TEXT PRIMARY KEY, failures INTEGER NOT NULL, blocked_until REAL NOT NULL,
+            updated_at REAL NOT NULL) WITHOUT ROWID""",
+    ]
+
+    TAKE_SQL = text("""
+        INSERT INTO rate_buckets(key, tokens, updated_at) VALUES (:key, :burst - 1, :now)
+        ON CONFLICT(key) DO UPDATE SET
+            tokens = MIN(:burst, tokens + MAX(0, :now - updated_at) * :rate) - 1,
+            updated_at = :now
+        WHERE MIN(:burst, tokens + MAX(0, :now - updated_at) * :rate) >= 1
+        RETURNING tokens""")
+    BUCKET_SQL = text("SELECT tokens, updated_at FROM rate_buckets WHERE key = :key")
+    BLOCKED_SQL = text("SELECT blocked_until FROM login_failures WHERE key = :key")
+    FAILURE_SQL = text("""
+        INSERT INTO login_failures(key, failures, blocked_until, updated_at) VALUES (:key, 1, 0, :now)
+        ON CONFLICT(key) DO UPDATE SET
+            failures = CASE WHEN :now - updated_at >= :reset THEN 1 ELSE failures + 1 END,
+            updated_at = :now
+        RETURNING failures""")
+    BLOCK_SQL = text("UPDATE login_failures SET blocked_until = :until WHERE key = :key")
+    RESET_SQL = text("DELETE FROM login_failures WHERE key = :key")
+    PRUNE_SQL = [
+        text("DELETE FROM rate_buckets WHERE updated_at < :idle_before"),
+        text("""DELETE FROM rate_buckets WHERE key IN (
+            SELECT key FROM rate_buckets ORDER BY updated_at DESC LIMIT -1 OFFSET :max_keys)"""),
+        text("DELETE FROM login_failures WHERE updated_at < :reset_before AND blocked_until < :now"),
+    ]
+
+    def __init__(self, url: str = RATE_LIMIT_DATABASE_URL, max_keys: int = RATE_LIMIT_MAX_KEYS,
+                 reset_seconds: float = LOGIN_FAILURE_RESET_SECONDS):
+        self.url = url
+        self.max_keys = max_keys
+        self.reset_seconds = reset_seconds
+        self._engine = None
+        self._engine_lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+
+    @property
+    def engine(self):
+        # Движок создается при первом запросе: после fork воркеры не делят соединения
+        if self._engine is None:
+            with self._engine_lock:
+                if self._engine is None:
+                    self._engine = self._create_engine()
+        return self._engine
+
+    def _create_engine(self):
+        engine = create_engine(self.url, connect_args={"check_same_thread": False})
+
+        @event.listens_for(engine, "connect")
+        def _on_connect(dbapi_connection, connection_record):
+            cursor = dbapi_connection.cursor()
+            # Состояние лимитов не требует надежности: потеря при сбое ОС допустима
+            for pragma in ("journal_mode=WAL", "synchronous=OFF", "busy_timeout=5000"):
+                cursor.execute(f"PRAGMA {pragma}")
+            cursor.close()
+
+        with engine.begin() as connection:
+            for statement in self.DDL:
+                connection.execute(text(statement))
+        return engine
+
+    def take(self, key: str, limit: Limit, now: float) -> float:
+        with self.engine.begin() as connection:
+            params = {"key": key, "rate": limit.rate, "burst": limit.burst, "now": now}
+            if connection.execute(self.TAKE_SQL, params).first() is not None:
+                allowed = True
+            else:
+                allowed = False
+                tokens, updated_at = connection.execute(self.BUCKET_SQL, {"key": key}).one()
+        self._maybe_prune(now)
+        if allowed:
+            return 0.0
+        tokens = min(limit.burst, tokens + max(0.0, now - updated_at) * limit.rate)
+        return max(0.0, (1 - tokens) / limit.rate)
+
+    def blocked_for(self, key: str, now: float) -> float:
+        with self.engine.connect() as connection:
+            blocked_until = connection.execute(self.BLOCKED_SQL, {"key": key}).scalar()
+        return max(0.0, blocked_until - now) if blocked_until is not None else 0.0
+
+    def record_failure(self, key: str, policy: BackoffPolicy, now: float) -> float:
+        with self.engine.begin() as connection:
+            failures = connection.execute(
+                self.FAILURE_SQL, {"key": key, "now": now, "reset": policy.reset_seconds}
+            ).scalar()
+            delay = policy.delay(failures)
+            if delay:
+                connection.execute(self.BLOCK_SQL, {"key": key, "until": now + delay})
+        return delay
+
+    def reset(self, key: str) -> None:
+        with self.engine.begin() as connection:
+            connection.execute(self.RESET_SQL, {"key": key})
+
+    def stats(self) -> dict:
+        if self._engine is None:
+            return {"keys": 0, "max_keys": self.max_keys}
+        with self._engine.connect() as connection:
+            keys = connection.execute(text("SELECT COUNT(*) FROM rate_buckets")).scalar()
+        return {"keys": keys, "max_keys": self.max_keys}
+
+    def _maybe_prune(self, now: float) -> None:
+        if time.monotonic() - self._pruned_at < RATE_LIMIT_PRUNE_SECONDS:
+            return
+        self._pruned_at = time.monotonic()
+        params = {
+            "idle_before": now - RATE_LIMIT_IDLE_SECONDS,
+            "max_keys": self.max_keys,
+            "reset_before": now - self.reset_seconds,
+            "now": now,
+        }
+        with self.engine.begin() as connection:
+            for statement in self.PRUNE_SQL:
+                connection.execute(statement, params)
+
+
+def create_store(kind: str = RATE_LIMIT_STORE):
+    if kind == "memory":
+        return MemoryBucketStore()
+    if kind == "sqlite":
+        return SQLiteBucketStore()
+    raise ValueError(f"Unknown RATE_LIMIT_STORE: {kind}")
+
+
+def client_ip(scope: dict, trust_proxy: bool = RATE_LIMIT_TRUST_PROXY) -> str:
+    """IP клиента; X-Forwarded-For учитывается только за доверенным прокси"""
+    if trust_proxy:
+        for name, value in scope.get("headers", ()):
+            if name == b"x-forwarded-for":
+                return value.decode("latin-1").split(",")[0].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def client_network(ip: str) -> str:
+    """Сеть адреса клиента (/LOGIN_IPV4_PREFIX или /LOGIN_IPV6_PREFIX); нераспознанный адрес - как есть"""
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip
+    if address.version == 6 and address.ipv4_mapped is not None:
+        address = address.ipv4_mapped
+    prefix = LOGIN_IPV4_PREFIX if address.version == 4 else LOGIN_IPV6_PREFIX
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+
+
+def retry_after_header(seconds: float) -> Dict[str, str]:
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+
+def too_many_requests(retry_after: float, detail: str = "Слишком много запросов") -> HTTPException:
+    return HTTPException(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        detail=detail,
+        headers=retry_after_header(retry_after),
+    )
+
+
+class RateLimiter:
+    """Ограничение частоты запросов маркерными корзинами
+
+    На запрос списывается маркер из корзины IP и, если для маршрута задан
+    лимит, из корзины (маршрут, IP) - не больше двух операций с хранилищем.
+    Вход дополнительно ограничен корзиной на имя пользователя в сети клиента
+    (client_network) и экспоненциальной задержкой после неудачных попыток
+    (имя + IP), которые проверяются до дорогой проверки пароля.
+    """
+
+    def __init__(self, store=None, enabled: bool = RATE_LIMIT_ENABLED):
+        self.enabled = enabled
+        self.store = store if store is not None else create_store()
+        self.ip_limit = parse_limit(RATE_LIMIT_PER_IP)
+        self.route_limits = parse_route_limits(RATE_LIMIT_ROUTES)
+        self.exempt_paths = frozenset(path.strip() for path in RATE_LIMIT_EXEMPT_PATHS.split(",") if path.strip())
+        self.username_limit = parse_limit(LOGIN_RATE_LIMIT_PER_USERNAME)
+        self.backoff = BackoffPolicy(
+            LOGIN_FREE_ATTEMPTS, LOGIN_BACKOFF_BASE_SECONDS, LOGIN_BACKOFF_MAX_SECONDS, LOGIN_FAILURE_RESET_SECONDS)
+
+    async def _call(self, func, *args):
+        # Общее хранилище обращается к БД - вне цикла событий
+        if self.store.blocking:
+            return await anyio.to_thread.run_sync(func, *args)
+        return func(*args)
+
+    async def check_scope(self, scope: dict) -> float:
+        """Проверка HTTP-запроса: 0 - разрешен, иначе секунд до повтора"""
+        if not self.enabled or scope["path"] in self.exempt_paths:
+            return 0.0
+        return await self._call(self.check_request, scope["method"], scope["path"], client_ip(scope))
+
+    def check_request(self, method: str, path: str, ip: str) -> float:
+        """0 - запрос разрешен, иначе секунд до повтора"""
+        now = time.time()
+        if self.ip_limit is not None:
+            wait = self.store.take(f"ip:{ip}", self.ip_limit, now)
+            if wait:
+                rate_limited.inc("ip")
+                return wait
+        limit = self.route_limits.get((method, path))
+        if limit is not None:
+            wait = self.store.take(f"route:{method} {path}:{ip}", limit, now)
+            if wait:
+                rate_limited.inc("route")
+                return wait
+        return 0.0
+
+    def _check_login(self, username: str, ip: str) -> float:
+        now = time.time()
+        wait = self.store.blocked_for(self._login_key(username, ip), now)
+        if wait:
+            rate_limited.inc("login_backoff")
+            return wait
+        if self.username_limit is not None:
+            wait = self.store.take(f"user:{username.lower()}:{client_network(ip)}", self.username_limit, now)
+            if wait:
+                rate_limited.inc("username")
+                return wait
+        return 0.0
+
+    async def check_login(self, username: str, ip: str) -> None:
+        """429 с Retry-After, если попытки входа для пары (имя, сеть) или (имя, IP) исчерпаны"""
+        if not self.enabled:
+            return
+        wait = await self._call(self._check_login, username, ip)
+        if wait:
+            raise too_many_requests(wait, "Слишком много попыток входа, повторите позже")
+
+    async def login_failed(self, username: str, ip: str) -> float:
+        """Учесть неудачный вход; возвращает задержку до следующей попытки"""
+        if not self.enabled:
+            return 0.0
+        return await self._call(self.store.record_failure, self._login_key(username, ip), self.backoff, time.time())
+
+    async def login_succeeded(self, username: str, ip: str) -> None:
+        if self.enabled:
+            await self._call(self.store.reset, self._login_key(username, ip))
+
+    @staticmethod
+    def _login_key(username: str, ip: str) -> str:
+        # Задержка по паре (имя, IP): перебор с одного адреса не блокирует вход владельцу
+        return f"login:{username.lower()}:{ip}"
+
+
+rate_limiter = RateLimiter()
+
+registry.gauge("rate_limit_store", "Корзины хранилища ограничения частоты", lambda: [
+    ({"stat": key}, value) for key, value in rate_limiter.store.stats().items()
+])
+
+
+class RateLimitMiddleware:
+    """ASGI-middleware: 429 с Retry-After при исчерпании корзины IP или маршрута"""
+
+    def __init__(self, app, limiter: RateLimiter = rate_limiter):
+        self.app = app
+        self.limiter = limiter
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        wait = await self.limiter.check_scope(scope)
+        if wait:
+            response = JSONResponse(
+                {"detail": "Слишком много запросов"},
+                status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                headers=retry_after_header(wait),
+            )
+            await response(scope, receive, send)
+            return
+        await self.app(scope, receive, send)
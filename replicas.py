@@ -0,0 +1,172 @@
+import itertools
+import logging
+import os
+import threading
+import time
+from contextvars import ContextVar
+from typing import List, Optional
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+# Настройки маршрутизации чтения (переменные окружения)
+# Как часто проверяется доступность реплик (с)
+READ_HEALTH_CHECK_SECONDS = float(os.getenv("READ_HEALTH_CHECK_SECONDS", "5"))
+# Максимальное отставание реплики Postgres (с); 0 - не проверять
+READ_MAX_LAG_SECONDS = float(os.getenv("READ_MAX_LAG_SECONDS", "0"))
+# Сколько секунд после записи чтения клиента идут в основную БД (read-your-writes)
+READ_STICKY_SECONDS = float(os.getenv("READ_STICKY_SECONDS", "5"))
+READ_STICKY_COOKIE = "db_primary_until"
+
+# Проверка реплики: соединение и наличие схемы (пустой файл SQLite создается при подключении)
+HEALTH_CHECK_QUERY = text("SELECT 1 FROM cars LIMIT 1")
+POSTGRES_LAG_QUERY = text(
+    "SELECT COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)")
+
+logger = logging.getLogger("carshop.replicas")
+
+
+class ReadReplica:
+    """Движок реплики для чтения и его состояние"""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.name = engine.url.render_as_string(hide_password=True)
+        self.healthy = True
+        self.checked_at = 0.0
+        self.routed = 0
+
+    def check(self, max_lag: float = READ_MAX_LAG_SECONDS) -> bool:
+        try:
+            with self.engine.connect() as connection:
+                connection.execute(HEALTH_CHECK_QUERY)
+                if max_lag and self.engine.dialect.name == "postgresql":
+                    lag = connection.execute(POSTGRES_LAG_QUERY).scalar()
+                    if lag > max_lag:
+                        raise RuntimeError(f"replication lag {lag:.1f}s exceeds {max_lag:.1f}s")
+        except Exception as exc:
+            if self.healthy:
+                logger.warning("Read replica %s is unavailable: %s", self.name, exc)
+            self.healthy = False
+        else:
+            if not self.healthy:
+                logger.info("Read replica %s is available again", self.name)
+            self.healthy = True
+        self.checked_at = time.monotonic()
+        return self.healthy
+
+
+class ReplicaSet:
+    """Выбор движка для чтения среди реплик
+
+    Чтение идет на исправную реплику с наименьшим числом занятых соединений
+    (при равенстве - по кругу). Состояние реплик проверяется не чаще раза в
+    check_interval одним запросом; реплика, на которой запрос завершился
+    ошибкой соединения, исключается до следующей успешной проверки. Если
+    исправных реплик нет, чтение идет в основную БД.
+    """
+
+    def __init__(self, primary: Engine, replicas: List[Engine], check_interval: float = READ_HEALTH_CHECK_SECONDS):
+        self.primary = primary
+        self.replicas = [ReadReplica(replica) for replica in replicas]
+        self.check_interval = check_interval
+        self.primary_fallbacks = 0
+        self._rotation = itertools.count()
+        self._check_lock = threading.Lock()
+
+    def choose(self) -> Engine:
+        if not self.replicas:
+            return self.primary
+        self._check_due()
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy:
+            self.primary_fallbacks += 1
+            return self.primary
+        start = next(self._rotation) % len(healthy)
+        ordered = healthy[start:] + healthy[:start]
+        replica = min(ordered, key=lambda candidate: _checked_out(candidate.engine))
+        replica.routed += 1
+        return replica.engine
+
+    def mark_failed(self, engine: Engine) -> None:
+        for replica in self.replicas:
+            if replica.engine is engine and replica.healthy:
+                logger.warning("Read replica %s failed a query, excluded until next health check", replica.name)
+                replica.healthy = False
+                replica.checked_at = time.monotonic()
+
+    def _check_due(self) -> None:
+        now = time.monotonic()
+        due = [replica for replica in self.replicas if now - replica.checked_at >= self.check_interval]
+        # Проверяет один запрос, остальные не ждут его
+        if not due or not self._check_lock.acquire(blocking=False):
+            return
+        try:
+            for replica in due:
+                replica.check()
+        finally:
+            self._check_lock.release()
+
+    def stats(self):
+        for replica in self.replicas:
+            yield {"replica": replica.name, "stat": "healthy"}, int(replica.healthy)
+            yield {"replica": replica.name, "stat": "routed"}, replica.routed
+        yield {"replica": "primary", "stat": "fallbacks"}, self.primary_fallbacks
+
+
+def _checked_out(engine: Engine) -> int:
+    pool = engine.pool
+    return pool.checkedout() if hasattr(pool, "checkedout") else 0
+
+
+# Признак записи в текущем HTTP-запросе: изменяемый список, чтобы отметка из
+# потока пула (синхронные эндпоинты) была видна middleware
+_request_writes: ContextVar[Optional[list]] = ContextVar("request_writes", default=None)
+
+
+def mark_write() -> None:
+    """Отметить запись в основную БД в текущем запросе (вызывается после commit)"""
+    state = _request_writes.get()
+    if state is not None:
+        state[0] = True
+
+
+def prefers_primary(cookies: dict) -> bool:
+    """Клиент недавно писал: читать из основной БД, чтобы увидеть свои изменения"""
+    try:
+        return float(cookies.get(READ_STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReadYourWritesMiddleware:
+    """ASGI-middleware: после записи клиенту ставится cookie, направляющая его чтения в основную БД
+
+    Состояние хранится у клиента, поэтому окно действует на всех воркерах.
+    """
+
+    def __init__(self, app, sticky_seconds: float = READ_STICKY_SECONDS):
+        self.app = app
+        self.sticky_seconds = sticky_seconds
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or self.sticky_seconds <= 0:
+            await self.app(scope, receive, send)
+            return
+        state = [False]
+        token = _request_writes.set(state)
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start" and state[0]:
+                cookie = (
+                    f"{READ_STICKY_COOKIE}={time.time() + self.sticky_seconds:.3f}; "
+                    f"Max-Age={max(1, int(self.sticky_seconds))}; Path=/; HttpOnly; SameSite=Lax"
+                )
+                message["headers"] = list(message.get("headers", [])) + [(b"set-cookie", cookie.encode("latin-1"))]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _request_writes.reset(token)
+
@@ -1,58 +1,646 @@
+import base64
+import heapq
+import json
+import math
+from datetime import datetime
+from itertools import chain, groupby, islice
+from operator import itemgetter
+from sqlalchemy import Select, case, delete, exists, func, insert, literal, literal_column, or_, select, table, tuple_, update
 from sqlalchemy.orm import Session
-from models import Car
-from database import DBCar, DBUser
-from typing import List, Optional
+from starlette.concurrency import run_in_threadpool
+from models import Car, CarPhoto
+from database import DBCar, DBCarPhoto, DBCarStats, DBSummaryState, DBUser
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from sqlalchemy.orm import Session
 from typing import List, Optional
 from models import User, UserRole
-from auth import AuthService
+from auth import AuthService, revoke_user_tokens
+from response_cache import CARS_TABLE, table_versions
+from change_feed import car_changes
+from hashing import password_hasher
+from fast_json import rows_to_columns
+from catalog import car_catalog, page_cursor_values
+from sharding import DealerMoving, ShardRouter, car_shards
+from search import (
+    CARS_FTS_TABLE, PRICE_BANDS, SEARCH_FIELD_WEIGHTS, SEARCH_MAX_CANDIDATES, VOCABULARY_QUERY,
+    YEAR_BUCKET_SIZE, SearchTerm, build_match, car_search_vocabulary, collect_facets, facet_cache,
+    facet_cache_key, relevance, tokenize,
+)
+from stats import (
+    CAR_STATS_TABLE, car_price_snapshot, collect_car_stats, incremental_stats, rebuild_car_stats,
+)
+
+# Колонки быстрого пути чтения: порядок значений в строках-кортежах
+CAR_COLUMNS = [
+    DBCar.id, DBCar.brand, DBCar.model, DBCar.year,
+    DBCar.price, DBCar.color, DBCar.created_at, DBCar.updated_at, DBCar.version, DBCar.dealer_id,
+]
+CAR_COLUMN_NAMES = [column.key for column in CAR_COLUMNS]
+# Колонки пользователя в порядке полей модели User
+USER_COLUMNS = [
+    DBUser.id, DBUser.username, DBUser.email, DBUser.full_name, DBUser.role,
+    DBUser.is_active, DBUser.created_at, DBUser.updated_at, DBUser.version,
+]
+
+# Допустимые ключи сортировки списка автомобилей; id всегда добавляется вторым ключом
+CAR_SORT_COLUMNS = {
+    "id": DBCar.id,
+    "price": DBCar.price,
+    "year": DBCar.year,
+}
+
+
+def encode_cursor(values: list) -> str:
+    """Кодирование значений ключа последней строки в непрозрачный курсор"""
+    raw = json.dumps(values, separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    """Декодирование курсора; ValueError при некорректном значении"""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (ValueError, TypeError) as e:
+        raise ValueError("Invalid cursor") from e
+    if not isinstance(values, list) or not values:
+        raise ValueError("Invalid cursor")
+    return values
+
+
+def build_car_page_query(
+    filters: Optional[dict], sort: str, cursor: Optional[str], limit: int,
+    columns: Optional[list] = None,
+) -> Tuple[Select, list]:
+    """Запрос страницы автомобилей и колонки ключа сортировки
+
+    columns - выбираемые колонки; по умолчанию выбираются объекты DBCar.
+    """
+    descending = sort.startswith("-")
+    sort_name = sort.lstrip("-")
+    if sort_name not in CAR_SORT_COLUMNS:
+        raise ValueError(f"Unknown sort key: {sort}")
+    column = CAR_SORT_COLUMNS[sort_name]
+    key_columns = [DBCar.id] if sort_name == "id" else [column, DBCar.id]
+
+    stmt = CarRepository._apply_filters(select(*columns) if columns else select(DBCar), filters or {})
+
+    if cursor:
+        values = page_cursor_values(sort, decode_cursor(cursor))
+        key = key_columns[0] if len(key_columns) == 1 else tuple_(*key_columns)
+        bound = values[0] if len(values) == 1 else tuple(values)
+        stmt = stmt.where(key < bound if descending else key > bound)
+
+    order = [col.desc() if descending else col.asc() for col in key_columns]
+    # Берем на одну строку больше, чтобы узнать, есть ли следующая страница
+    return stmt.order_by(*order).limit(limit + 1), key_columns
+
+
+def _car_search_select(match: str, filters: Optional[dict], *columns) -> Select:
+    """Выборка из совпадений FTS5, соединенных с cars, с фильтрами списка автомобилей"""
+    fts = literal_column(CARS_FTS_TABLE)
+    stmt = (
+        select(*columns)
+        .select_from(table(CARS_FTS_TABLE))
+        .join(DBCar, DBCar.id == literal_column(f"{CARS_FTS_TABLE}.rowid"))
+        .where(fts.op("MATCH")(match))
+    )
+    return CarRepository._apply_filters(stmt, filters or {})
+
+
+# Колонки кандидатов поиска: id и поля, по которым считается релевантность
+SEARCH_CANDIDATE_COLUMNS = [DBCar.id] + [getattr(DBCar, name) for name in SEARCH_FIELD_WEIGHTS]
+
+
+def build_car_search_query(match: str, filters: Optional[dict]) -> Select:
+    """Кандидаты поиска: лучшие по bm25 строки из SEARCH_CANDIDATE_COLUMNS
+
+    Выбирается на одну строку больше SEARCH_MAX_CANDIDATES, чтобы узнать,
+    отброшены ли совпадения (trim_search_candidates).
+    """
+    rank = func.bm25(literal_column(CARS_FTS_TABLE), *SEARCH_FIELD_WEIGHTS.values())
+    stmt = _car_search_select(match, filters, *SEARCH_CANDIDATE_COLUMNS)
+    return stmt.order_by(rank, DBCar.id).limit(SEARCH_MAX_CANDIDATES + 1)
+
+
+def trim_search_candidates(candidates: list) -> Tuple[list, bool]:
+    """Кандидаты для ранжирования и признак того, что совпадений больше SEARCH_MAX_CANDIDATES"""
+    return candidates[:SEARCH_MAX_CANDIDATES], len(candidates) > SEARCH_MAX_CANDIDATES
+
+
+def page_search_candidates(
+    terms: List[SearchTerm], candidates: list, cursor: Optional[str], limit: int,
+) -> Tuple[List[int], Optional[str]]:
+    """id страницы кандидатов, отсортированных по релевантности (затем по id), после курсора"""
+    weights = list(SEARCH_FIELD_WEIGHTS.values())
+    # Сочетаний марки, модели и цвета намного меньше, чем кандидатов
+    scores = {}
+    ranked = []
+    for row in candidates:
+        fields = tuple(row[1:])
+        if fields not in scores:
+            scores[fields] = -relevance(terms, list(zip(weights, fields)))
+        ranked.append((scores[fields], row[0]))
+    ranked.sort()
+    if cursor:
+        values = decode_cursor(cursor)
+        # Курсор от клиента: ровно [оценка, id], иначе сравнение с ключами упадёт с TypeError
+        if len(values) != 2 or any(isinstance(value, bool) for value in values) \
+                or not isinstance(values[0], (int, float)) or not math.isfinite(values[0]) \
+                or not isinstance(values[1], int):
+            raise ValueError("Invalid cursor")
+        bound = (float(values[0]), values[1])
+        ranked = [key for key in ranked if key > bound]
+    next_cursor = encode_cursor(list(ranked[limit - 1])) if len(ranked) > limit else None
+    return [car_id for _, car_id in ranked[:limit]], next_cursor
+
+
+def order_rows_by_ids(rows: list, ids: List[int]) -> List[tuple]:
+    """Строки в порядке CAR_COLUMN_NAMES, упорядоченные как ids"""
+    by_id = {row[0]: tuple(row) for row in rows}
+    return [by_id[car_id] for car_id in ids if car_id in by_id]
+
+
+def build_car_facets_query(match: str, filters: Optional[dict]) -> Select:
+    """Один агрегирующий запрос по марке, десятилетию и ценовому диапазону
+
+    Счетчики отдельных фасетов собираются из его строк (search.collect_facets).
+    """
+    decade = (DBCar.year // YEAR_BUCKET_SIZE) * YEAR_BUCKET_SIZE
+    band = case(
+        *[(DBCar.price < bound, index) for index, bound in enumerate(PRICE_BANDS)],
+        else_=len(PRICE_BANDS),
+    )
+    stmt = _car_search_select(match, filters, DBCar.brand, decade, band, func.count())
+    return stmt.group_by(DBCar.brand, decade, band)
+
+
+# Число id в одном IN: старые версии SQLite ограничивают запрос 999 параметрами
+BATCH_ID_CHUNK = 900
+
+
+def car_batch_criteria(ids: Optional[List[int]], filters: Optional[dict]) -> Iterator[list]:
+    """Условия WHERE пакетной операции: по одному набору на порцию id (или один - для фильтра)"""
+    base = CarRepository._apply_filters(select(DBCar.id), filters or {}).whereclause
+    criteria = [base] if base is not None else []
+    if ids is None:
+        yield criteria
+        return
+    for start in range(0, len(ids), BATCH_ID_CHUNK):
+        yield criteria + [DBCar.id.in_(ids[start:start + BATCH_ID_CHUNK])]
+
+
+def build_car_batch_update(values: dict, price_factor: Optional[float] = None):
+    """UPDATE автомобилей с установкой updated_at и новой версией строки; price_factor умножает цену"""
+    values = dict(values, updated_at=datetime.utcnow(), version=DBCar.version + 1)
+    if price_factor is not None:
+        values["price"] = DBCar.price * price_factor
+    return update(DBCar).values(**values)
+
+
+class VersionConflict(Exception):
+    """Строка изменена другим запросом: ее версия не совпадает с If-Match"""
+
+
+def build_versioned_update(model, row_id: int, values: dict, expected_versions: Optional[List[int]] = None):
+    """UPDATE одной строки с увеличением версии; expected_versions - допустимые версии (If-Match)"""
+    stmt = update(model).where(model.id == row_id).values(**values, version=model.version + 1)
+    if expected_versions is not None:
+        stmt = stmt.where(model.version.in_(expected_versions))
+    return stmt
+
+
+def build_versioned_delete(model, row_id: int, expected_versions: Optional[List[int]] = None):
+    """DELETE одной строки; expected_versions - допустимые версии (If-Match)"""
+    stmt = delete(model).where(model.id == row_id)
+    if expected_versions is not None:
+        stmt = stmt.where(model.version.in_(expected_versions))
+    return stmt
+
+
+def execute_returning(db: Session, stmt, columns: list, model, row_id: int):
+    """Выполнить UPDATE одной строки и получить ее новые значения
+
+    С RETURNING - один оператор; без него - UPDATE и SELECT. None - строка не изменена.
+    """
+    if db.get_bind().dialect.update_returning:
+        return db.execute(stmt.returning(*columns)).first()
+    if db.execute(stmt).rowcount == 0:
+        return None
+    return db.execute(select(*columns).where(model.id == row_id)).first()
+
+
+def check_conflict(db: Session, model, row_id: int, expected_versions: Optional[List[int]]) -> None:
+    """Строка не изменена: при If-Match и существующей строке - VersionConflict"""
+    if expected_versions is not None and db.execute(select(model.id).where(model.id == row_id)).first():
+        raise VersionConflict(row_id)
+
+
+# Группировки сводки /cars/stats
+CAR_STATS_GROUPS = {
+    "brand": [DBCarStats.brand],
+    "year": [DBCarStats.year],
+    "brand_year": [DBCarStats.brand, DBCarStats.year],
+}
+# Цены колоночного снимка для перцентилей: один проход по индексу ix_cars_brand_year_price
+PRICE_SNAPSHOT_QUERY = (
+    select(DBCar.brand, DBCar.year, DBCar.price)
+    .where(DBCar.price.is_not(None))
+    .order_by(DBCar.brand, DBCar.year)
+)
+
+
+def group_snapshot_prices(rows: Iterable[tuple]) -> List[tuple]:
+    """Строки PRICE_SNAPSHOT_QUERY, сгруппированные в (марка, год, [цены]) для car_price_snapshot.load"""
+    return [
+        (brand, year, [row[2] for row in group])
+        for (brand, year), group in groupby(rows, key=itemgetter(0, 1))
+    ]
+
+
+def build_car_stats_query(group_by: str, filters: Optional[dict]) -> Select:
+    """Агрегирование сводки car_stats: число строк - O(марок x лет), а не O(автомобилей)"""
+    keys = CAR_STATS_GROUPS[group_by]
+    stmt = select(
+        *keys,
+        func.sum(DBCarStats.car_count),
+        func.sum(DBCarStats.price_sum),
+        func.min(DBCarStats.min_price),
+        func.max(DBCarStats.max_price),
+    )
+    filters = filters or {}
+    if filters.get("brand") is not None:
+        stmt = stmt.where(DBCarStats.brand == filters["brand"])
+    if filters.get("year_min") is not None:
+        stmt = stmt.where(DBCarStats.year >= filters["year_min"])
+    if filters.get("year_max") is not None:
+        stmt = stmt.where(DBCarStats.year <= filters["year_max"])
+    return stmt.group_by(*keys).order_by(*keys)
+
+
+def build_car_stats_freshness_query() -> Select:
+    """Время последнего изменения сводки и ее последней полной перестройки"""
+    rebuilt_at = select(DBSummaryState.rebuilt_at).where(DBSummaryState.name == CAR_STATS_TABLE).scalar_subquery()
+    return select(func.max(DBCarStats.updated_at), rebuilt_at)
+
+
+def car_stats_result(group_by: str, rows: list, freshness: tuple, dialect) -> dict:
+    """Ответ /cars/stats из строк сводки и отметок времени"""
+    result = collect_car_stats([column.key for column in CAR_STATS_GROUPS[group_by]], rows)
+    updated_at, rebuilt_at = freshness
+    result["freshness"] = {
+        "incremental": incremental_stats(dialect),
+        "updated_at": updated_at,
+        "rebuilt_at": rebuilt_at,
+    }
+    return result
+
+
+def add_price_percentiles(result: dict, percentiles: List[float], filters: Optional[dict]) -> dict:
+    """Перцентили цены по колоночному снимку и время его загрузки"""
+    filters = filters or {}
+    result["percentiles"] = car_price_snapshot.percentiles(
+        percentiles, filters.get("brand"), filters.get("year_min"), filters.get("year_max")
+    )
+    result["freshness"]["percentiles_loaded_at"] = car_price_snapshot.loaded_at
+    return result
+
+
+def split_car_page(db_cars: list, key_columns: list, limit: int, convert) -> Tuple[list, Optional[str]]:
+    """Отделение лишней строки и формирование курсора следующей страницы"""
+    next_cursor = None
+    if len(db_cars) > limit:
+        db_cars = db_cars[:limit]
+        last = db_cars[-1]
+        next_cursor = encode_cursor([getattr(last, col.key) for col in key_columns])
+    return [convert(car) for car in db_cars], next_cursor
+
+
+def catalog_page_rows(
+    filters: Optional[dict], sort: str, cursor: Optional[str], limit: int,
+) -> Tuple[List[tuple], Optional[str]]:
+    """Страница кортежей из каталога в памяти с тем же порядком и курсорами, что и build_car_page_query"""
+    sort_name = sort.lstrip("-")
+    if sort_name not in CAR_SORT_COLUMNS:
+        raise ValueError(f"Unknown sort key: {sort}")
+    key_indexes = [0] if sort_name == "id" else [CAR_COLUMN_NAMES.index(sort_name), 0]
+    values = page_cursor_values(sort, decode_cursor(cursor)) if cursor else None
+    rows = car_catalog.page(filters, sort, values, limit)
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][index] for index in key_indexes])
+    return rows, next_cursor
+
+
+def car_from_row(row: tuple) -> Car:
+    """Pydantic-модель из кортежа в порядке CAR_COLUMN_NAMES"""
+    return Car(**dict(zip(CAR_COLUMN_NAMES, row)))
+
+
+def car_photo_criteria(car_ids: List[int]) -> Iterator:
+    """Условия выбора фотографий удаляемых автомобилей, порциями по BATCH_ID_CHUNK id
+
+    Строки фотографий удаляются в транзакции удаления автомобилей, после ответа
+    удаляются только файлы. В шардах фотографии хранятся в основной БД: их
+    удаляет фоновая очистка (media.collect_orphaned_photos).
+    """
+    if car_shards.enabled:
+        return
+    for start in range(0, len(car_ids), BATCH_ID_CHUNK):
+        yield DBCarPhoto.car_id.in_(car_ids[start:start + BATCH_ID_CHUNK])
+
 
 class CarRepository:
     """Репозиторий для работы с автомобилями"""
     def __init__(self, db: Session):
         self.db = db
+        # Хеши файлов фотографий, удаленных вместе с автомобилями (файлы удаляет вызывающий)
+        self.deleted_photo_digests: List[str] = []
 
     def get_all(self) -> List[Car]:
         """Получить все автомобили"""
         db_cars = self.db.query(DBCar).all()
         return [self._convert_to_pydantic(car) for car in db_cars]
 
+    def get_page(
+        self,
+        filters: Optional[dict] = None,
+        sort: str = "id",
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[List[Car], Optional[str]]:
+        """Получить страницу автомобилей по курсору (keyset-пагинация)
+
+        sort - имя колонки из CAR_SORT_COLUMNS, префикс "-" означает убывание.
+        Возвращает автомобили страницы и курсор следующей страницы (или None).
+        """
+        if car_catalog.enabled:
+            rows, next_cursor = catalog_page_rows(filters, sort, cursor, limit)
+            return [car_from_row(row) for row in rows], next_cursor
+        stmt, key_columns = build_car_page_query(filters, sort, cursor, limit)
+        db_cars = self.db.execute(stmt).scalars().all()
+        return split_car_page(db_cars, key_columns, limit, self._convert_to_pydantic)
+
+    def get_page_rows(
+        self,
+        filters: Optional[dict] = None,
+        sort: str = "id",
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[List[tuple], Optional[str]]:
+        """Страница автомобилей кортежами в порядке CAR_COLUMN_NAMES (без ORM и Pydantic)"""
+        if car_catalog.enabled:
+            return catalog_page_rows(filters, sort, cursor, limit)
+        stmt, key_columns = build_car_page_query(filters, sort, cursor, limit, columns=CAR_COLUMNS)
+        rows = self.db.execute(stmt).all()
+        return split_car_page(rows, key_columns, limit, tuple)
+
+    def get_page_columns(
+        self,
+        filters: Optional[dict] = None,
+        sort: str = "id",
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[dict, Optional[str]]:
+        """Страница автомобилей в колоночном виде {колонка: [значения]}"""
+        rows, next_cursor = self.get_page_rows(filters, sort, cursor, limit)
+        return rows_to_columns(CAR_COLUMN_NAMES, rows), next_cursor
+
+    def search(
+        self,
+        query: str,
+        filters: Optional[dict] = None,
+        cursor: Optional[str] = None,
+        limit: int = 20,
+        facets: bool = True,
+    ) -> Tuple[List[tuple], Optional[str], Optional[dict], bool]:
+        """Полнотекстовый поиск по марке, модели и цвету (FTS5), по убыванию релевантности
+
+        Ранжируются SEARCH_MAX_CANDIDATES лучших по bm25 совпадений, фасеты считаются по всем.
+        Возвращает кортежи в порядке CAR_COLUMN_NAMES, курсор следующей страницы,
+        фасеты (None при facets=False) и признак того, что ранжированы не все
+        совпадения. ValueError - пустой запрос или неверный курсор.
+        """
+        tokens = tokenize(query)
+        if not tokens:
+            raise ValueError("Empty search query")
+        version = table_versions.get(CARS_TABLE)
+        if car_search_vocabulary.is_stale(version):
+            car_search_vocabulary.load(self.db.execute(VOCABULARY_QUERY).scalars(), version)
+        terms = car_search_vocabulary.expand(tokens)
+        match = build_match(terms)
+
+        candidates, truncated = trim_search_candidates(self.db.execute(build_car_search_query(match, filters)).all())
+        ids, next_cursor = page_search_candidates(terms, candidates, cursor, limit)
+        rows = order_rows_by_ids(self.db.execute(select(*CAR_COLUMNS).where(DBCar.id.in_(ids))).all(), ids)
+        facet_counts = None
+        if facets:
+            key = facet_cache_key(match, filters or {}, version)
+            facet_counts = facet_cache.get(key)
+            if facet_counts is None:
+                facet_counts = collect_facets(self.db.execute(build_car_facets_query(match, filters)))
+                facet_cache.set(key, facet_counts)
+        return rows, next_cursor, facet_counts, truncated
+
     def get_by_id(self, car_id: int) -> Optional[Car]:
         """Получить автомобиль по его id"""
+        if car_catalog.enabled:
+            row = car_catalog.get_row(car_id)
+            return car_from_row(row) if row else None
         db_car = self.db.query(DBCar).filter(DBCar.id == car_id).first()
         return self._convert_to_pydantic(db_car) if db_car else None
 
+    def get_row_by_id(self, car_id: int) -> Optional[tuple]:
+        """Автомобиль кортежем в порядке CAR_COLUMN_NAMES"""
+        if car_catalog.enabled:
+            return car_catalog.get_row(car_id)
+        row = self.db.execute(select(*CAR_COLUMNS).where(DBCar.id == car_id)).first()
+        return tuple(row) if row else None
+
     def create(self, car_data: dict) -> Car:
         """Создать автомобиль"""
         db_car = DBCar(**car_data)
         self.db.add(db_car)
         self.db.commit()
+        table_versions.bump(CARS_TABLE)
         self.db.refresh(db_car)
-        return self._convert_to_pydantic(db_car)
+        car = self._convert_to_pydantic(db_car)
+        car_changes.publish("upsert", cars=[car.model_dump(mode="json")])
+        return car
 
-    def update(self, car_id: int, car_data: dict) -> Optional[Car]:
-        """Обновить автомобиль"""
-        db_car = self.db.query(DBCar).filter(DBCar.id == car_id).first()
-        if not db_car:
+    def update(self, car_id: int, car_data: dict, expected_versions: Optional[List[int]] = None) -> Optional[Car]:
+        """Обновить автомобиль одним UPDATE ... RETURNING
+
+        expected_versions - версии из If-Match: автомобиль другой версии не
+        изменяется, а вызывается VersionConflict. None - автомобиль не найден.
+        """
+        stmt = build_versioned_update(DBCar, car_id, car_data, expected_versions)
+        row = execute_returning(self.db, stmt, CAR_COLUMNS, DBCar, car_id)
+        if row is None:
+            self.db.rollback()
+            check_conflict(self.db, DBCar, car_id, expected_versions)
             return None
-            
-        for key, value in car_data.items():
-            setattr(db_car, key, value)
-            
         self.db.commit()
-        self.db.refresh(db_car)
-        return self._convert_to_pydantic(db_car)
+        table_versions.bump(CARS_TABLE)
+        car = car_from_row(row)
+        car_changes.publish("upsert", cars=[car.model_dump(mode="json")])
+        return car
 
-    def delete(self, car_id: int) -> bool:
-        """Удалить автомобиль"""
-        db_car = self.db.query(DBCar).filter(DBCar.id == car_id).first()
-        if not db_car:
+    def delete(self, car_id: int, expected_versions: Optional[List[int]] = None) -> bool:
+        """Удалить автомобиль одним DELETE (expected_versions - см. update)"""
+        if self.db.execute(build_versioned_delete(DBCar, car_id, expected_versions)).rowcount == 0:
+            self.db.rollback()
+            check_conflict(self.db, DBCar, car_id, expected_versions)
             return False
-            
-        self.db.delete(db_car)
+        self._delete_photos([car_id])
         self.db.commit()
+        # Событие до новой версии: читатель с новой версией уже видит удаление (каталог в памяти)
+        car_changes.publish("delete", ids=[car_id])
+        table_versions.bump(CARS_TABLE)
         return True
 
+    def bulk_insert(self, rows: List[dict]) -> int:
+        """Вставить пакет автомобилей одной транзакцией (executemany)"""
+        if not rows:
+            return 0
+        try:
+            self.db.execute(insert(DBCar), rows)
+            self.db.commit()
+            table_versions.bump(CARS_TABLE)
+            # Пакетная вставка не возвращает id: клиенты перечитывают список
+            car_changes.publish("reload")
+        except Exception:
+            self.db.rollback()
+            raise
+        return len(rows)
+
+    def update_many(
+        self,
+        values: dict,
+        ids: Optional[List[int]] = None,
+        filters: Optional[dict] = None,
+        price_factor: Optional[float] = None,
+    ) -> List[int]:
+        """Обновить автомобили по списку id и/или фильтру одной транзакцией; возвращает id"""
+        stmt = build_car_batch_update(values, price_factor)
+        affected = self._run_batch(stmt, ids, filters, self.db.get_bind().dialect.update_returning)
+        if affected:
+            table_versions.bump(CARS_TABLE)
+            car_changes.publish("update", ids=affected)
+        return affected
+
+    def delete_many(self, ids: Optional[List[int]] = None, filters: Optional[dict] = None) -> List[int]:
+        """Удалить автомобили по списку id и/или фильтру одной транзакцией; возвращает id"""
+        affected = self._run_batch(delete(DBCar), ids, filters, self.db.get_bind().dialect.delete_returning)
+        if affected:
+            car_changes.publish("delete", ids=affected)
+            table_versions.bump(CARS_TABLE)
+        return affected
+
+    def _run_batch(self, stmt, ids: Optional[List[int]], filters: Optional[dict], returning: bool) -> List[int]:
+        """Выполнение UPDATE/DELETE порциями в одной транзакции
+
+        Без поддержки RETURNING затронутые id выбираются перед изменением.
+        Версию таблицы увеличивает вызывающий.
+        """
+        affected = []
+        try:
+            for criteria in car_batch_criteria(ids, filters):
+                if returning:
+                    result = self.db.execute(
+                        stmt.where(*criteria).returning(DBCar.id),
+                        execution_options={"synchronize_session": False},
+                    )
+                    affected += result.scalars().all()
+                else:
+                    affected += self.db.execute(select(DBCar.id).where(*criteria)).scalars().all()
+                    self.db.execute(stmt.where(*criteria), execution_options={"synchronize_session": False})
+            if stmt.is_delete:
+                self._delete_photos(affected)
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        return affected
+
+    def _delete_photos(self, car_ids: List[int]) -> None:
+        """Строки фотографий удаляемых автомобилей в текущей транзакции (см. car_photo_criteria)"""
+        for criteria in car_photo_criteria(car_ids):
+            self.deleted_photo_digests += self.db.execute(select(DBCarPhoto.digest).where(criteria)).scalars().all()
+            self.db.execute(delete(DBCarPhoto).where(criteria))
+
+    def stats(
+        self,
+        group_by: str = "brand",
+        filters: Optional[dict] = None,
+        percentiles: Optional[List[float]] = None,
+    ) -> dict:
+        """Статистика по сводке car_stats; перцентили цены - по колоночному снимку
+
+        filters - марка и диапазон лет (другие измерения в сводке не хранятся).
+        """
+        rows = self.db.execute(build_car_stats_query(group_by, filters)).all()
+        freshness = self.db.execute(build_car_stats_freshness_query()).one()
+        result = car_stats_result(group_by, rows, freshness, self.db.get_bind().dialect)
+        if not percentiles:
+            return result
+        version = table_versions.get(CARS_TABLE)
+        if car_price_snapshot.is_stale(version):
+            # Одна загрузка снимка на процесс, остальные потоки ждут ее
+            with car_price_snapshot.load_lock:
+                if car_price_snapshot.is_stale(version):
+                    car_price_snapshot.load(self.price_groups(), version)
+        return add_price_percentiles(result, percentiles, filters)
+
+    def price_groups(self, filters: Optional[dict] = None) -> List[tuple]:
+        """Цены по группам (марка, год, [цены]) для колоночного снимка"""
+        return group_snapshot_prices(self.db.execute(self._apply_filters(PRICE_SNAPSHOT_QUERY, filters or {})))
+
+    def rebuild_stats(self) -> None:
+        """Полная перестройка сводки car_stats"""
+        try:
+            rebuild_car_stats(self.db.connection())
+            self.db.commit()
+        except Exception:
+            self.db.rollback()
+            raise
+        table_versions.bump(CARS_TABLE)
+
+    def iter_rows(self, columns: List[str], batch_size: int) -> Iterator[List[tuple]]:
+        """Все автомобили порциями кортежей через серверный курсор (yield_per)"""
+        stmt = (
+            select(*[getattr(DBCar, name) for name in columns])
+            .order_by(DBCar.id)
+            .execution_options(yield_per=batch_size)
+        )
+        for partition in self.db.execute(stmt).partitions():
+            yield partition
+
+    @staticmethod
+    def _apply_filters(query, filters: dict):
+        """Применение фильтров списка автомобилей к запросу"""
+        if filters.get("brand") is not None:
+            query = query.filter(DBCar.brand == filters["brand"])
+        if filters.get("model") is not None:
+            query = query.filter(DBCar.model == filters["model"])
+        if filters.get("color") is not None:
+            query = query.filter(DBCar.color == filters["color"])
+        if filters.get("year_min") is not None:
+            query = query.filter(DBCar.year >= filters["year_min"])
+        if filters.get("year_max") is not None:
+            query = query.filter(DBCar.year <= filters["year_max"])
+        if filters.get("price_min") is not None:
+            query = query.filter(DBCar.price >= filters["price_min"])
+        if filters.get("price_max") is not None:
+            query = query.filter(DBCar.price <= filters["price_max"])
+        if filters.get("dealer_id") is not None:
+            query = query.filter(DBCar.dealer_id == filters["dealer_id"])
+        if filters.get("dealer_exclude"):
+            # Копии автомобилей дилеров, переносимых в этот шард (см. ShardedCarRepository)
+            query = query.filter(DBCar.dealer_id.not_in(filters["dealer_exclude"]))
+        return query
+
     def _convert_to_pydantic(self, db_car: DBCar) -> Car:
         """преобразование модели базы данных в Pydantic-модель"""
         return Car(
@@ -63,8 +651,394 @@ class CarRepository:
             price=db_car.price,
             color=db_car.color,
             created_at=db_car.created_at,
-            updated_at=db_car.updated_at
+            updated_at=db_car.updated_at,
+            version=db_car.version,
+            dealer_id=db_car.dealer_id,
         )
+
+
+def merge_car_pages(pages: List[List[tuple]], sort: str, limit: int, more: bool) -> Tuple[List[tuple], Optional[str]]:
+    """Слияние упорядоченных страниц шардов в страницу с тем же порядком и курсором, что у build_car_page_query
+
+    more - у какого-либо шарда есть следующая страница.
+    """
+    descending = sort.startswith("-")
+    sort_name = sort.lstrip("-")
+    if sort_name == "id":
+        key_indexes = [0]
+        key = itemgetter(0)
+    else:
+        index = CAR_COLUMN_NAMES.index(sort_name)
+        key_indexes = [index, 0]
+
+        def key(row):
+            # NULL - первым по возрастанию и последним по убыванию, как в SQLite
+            return row[index] is not None, row[index], row[0]
+    rows = list(islice(heapq.merge(*pages, key=key, reverse=descending), limit + 1))
+    next_cursor = None
+    if rows and (more or len(rows) > limit):
+        rows = rows[:limit]
+        next_cursor = encode_cursor([rows[-1][index] for index in key_indexes])
+    return rows, next_cursor
+
+
+def _merge_min(current, value):
+    return value if current is None else current if value is None else min(current, value)
+
+
+def _merge_max(current, value):
+    return value if current is None else current if value is None else max(current, value)
+
+
+class ShardedCarRepository:
+    """Автомобили в шардах по дилерам (sharding.py) с интерфейсом CarRepository
+
+    Запросы с фильтром dealer_id идут в шард дилера, остальные - во все шарды
+    параллельно: страницы сливаются по ключу сортировки, сводки суммируются.
+    Копии автомобилей переносимых дилеров исключаются фильтром dealer_exclude.
+    Каждый шард обслуживает CarRepository со своей сессией; пакетные операции
+    атомарны в пределах шарда.
+    """
+
+    # Фотографии удаленных автомобилей удаляет фоновая очистка (см. car_photo_criteria)
+    deleted_photo_digests: Tuple[str, ...] = ()
+
+    def __init__(self, router: ShardRouter = car_shards):
+        self.router = router
+
+    def _targets(self, filters: Optional[dict]) -> List[Tuple[int, dict]]:
+        """Шарды запроса и фильтры для каждого из них"""
+        filters = filters or {}
+        if filters.get("dealer_id") is not None:
+            return [(self.router.shard_for(filters["dealer_id"]), filters)]
+        targets = []
+        for shard in self.router.shards:
+            copies = self.router.copies(shard)
+            targets.append((shard, dict(filters, dealer_exclude=copies) if copies else filters))
+        return targets
+
+    def _everywhere(self) -> List[Tuple[int, dict]]:
+        return [(shard, {}) for shard in self.router.shards]
+
+    def _scatter(self, targets: List[Tuple[int, dict]], fn) -> list:
+        """fn(CarRepository шарда, фильтры шарда) параллельно; результаты в порядке targets"""
+        def call(target):
+            shard, filters = target
+            with self.router.session(shard) as db:
+                return fn(CarRepository(db), filters)
+        return self.router.map(call, targets)
+
+    def _locate(self, car_id: int) -> Optional[Tuple[int, tuple]]:
+        """Шард и строка автомобиля: поиск по первичному ключу во всех шардах"""
+        targets = self._everywhere()
+        rows = self._scatter(targets, lambda repo, filters: repo.get_row_by_id(car_id))
+        for (shard, _), row in zip(targets, rows):
+            if row is not None and self.router.owns(shard, row[-1]):
+                return shard, row
+        return None
+
+    def existing_ids(self, ids: List[int]) -> set:
+        """id из ids, которые есть в каком-либо шарде"""
+        def find(repo, filters):
+            return [
+                car_id
+                for start in range(0, len(ids), BATCH_ID_CHUNK)
+                for car_id in repo.db.execute(
+                    select(DBCar.id).where(DBCar.id.in_(ids[start:start + BATCH_ID_CHUNK]))).scalars()
+            ]
+        return set(chain.from_iterable(self._scatter(self._everywhere(), find))) if ids else set()
+
+    def get_all(self) -> List[Car]:
+        """Получить все автомобили"""
+        rows = self._scatter(self._targets(None), lambda repo, filters: repo.db.execute(
+            CarRepository._apply_filters(select(*CAR_COLUMNS), filters)).all())
+        return [car_from_row(row) for row in sorted(chain.from_iterable(rows), key=itemgetter(0))]
+
+    def get_page(
+        self,
+        filters: Optional[dict] = None,
+        sort: str = "id",
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[List[Car], Optional[str]]:
+        """Страница автомобилей по курсору (см. CarRepository.get_page)"""
+        rows, next_cursor = self.get_page_rows(filters, sort, cursor, limit)
+        return [car_from_row(row) for row in rows], next_cursor
+
+    def get_page_rows(
+        self,
+        filters: Optional[dict] = None,
+        sort: str = "id",
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[List[tuple], Optional[str]]:
+        """Страница кортежами: до limit строк из каждого шарда, слияние по ключу сортировки"""
+        pages = self._scatter(self._targets(filters), lambda repo, shard_filters: repo.get_page_rows(
+            shard_filters, sort, cursor, limit))
+        return merge_car_pages([rows for rows, _ in pages], sort, limit, any(more for _, more in pages))
+
+    def get_page_columns(
+        self,
+        filters: Optional[dict] = None,
+        sort: str = "id",
+        cursor: Optional[str] = None,
+        limit: int = 50,
+    ) -> Tuple[dict, Optional[str]]:
+        """Страница автомобилей в колоночном виде {колонка: [значения]}"""
+        rows, next_cursor = self.get_page_rows(filters, sort, cursor, limit)
+        return rows_to_columns(CAR_COLUMN_NAMES, rows), next_cursor
+
+    def search(
+        self,
+        query: str,
+        filters: Optional[dict] = None,
+        cursor: Optional[str] = None,
+        limit: int = 20,
+        facets: bool = True,
+    ) -> Tuple[List[tuple], Optional[str], Optional[dict], bool]:
+        """Полнотекстовый поиск (см. CarRepository.search): кандидаты всех шардов ранжируются вместе"""
+        tokens = tokenize(query)
+        if not tokens:
+            raise ValueError("Empty search query")
+        version = table_versions.get(CARS_TABLE)
+        if car_search_vocabulary.is_stale(version):
+            vocabularies = self._scatter(self._everywhere(), lambda repo, filters: repo.db.execute(
+                VOCABULARY_QUERY).scalars().all())
+            car_search_vocabulary.load(set(chain.from_iterable(vocabularies)), version)
+        terms = car_search_vocabulary.expand(tokens)
+        match = build_match(terms)
+
+        targets = self._targets(filters)
+        candidates = self._scatter(targets, lambda repo, shard_filters: repo.db.execute(
+            build_car_search_query(match, shard_filters)).all())
+        trimmed = [trim_search_candidates(rows) for rows in candidates]
+        candidates = [rows for rows, _ in trimmed]
+        truncated = any(shard_truncated for _, shard_truncated in trimmed)
+        ids, next_cursor = page_search_candidates(terms, list(chain.from_iterable(candidates)), cursor, limit)
+        page = set(ids)
+        holders = [target for target, rows in zip(targets, candidates) if any(row[0] in page for row in rows)]
+        rows = self._scatter(holders, lambda repo, shard_filters: repo.db.execute(CarRepository._apply_filters(
+            select(*CAR_COLUMNS).where(DBCar.id.in_(ids)), shard_filters)).all())
+        rows = order_rows_by_ids(list(chain.from_iterable(rows)), ids)
+        facet_counts = None
+        if facets:
+            key = facet_cache_key(match, filters or {}, version)
+            facet_counts = facet_cache.get(key)
+            if facet_counts is None:
+                facet_rows = self._scatter(targets, lambda repo, shard_filters: repo.db.execute(
+                    build_car_facets_query(match, shard_filters)).all())
+                facet_counts = collect_facets(chain.from_iterable(facet_rows))
+                facet_cache.set(key, facet_counts)
+        return rows, next_cursor, facet_counts, truncated
+
+    def get_by_id(self, car_id: int) -> Optional[Car]:
+        """Получить автомобиль по его id"""
+        row = self.get_row_by_id(car_id)
+        return car_from_row(row) if row else None
+
+    def get_row_by_id(self, car_id: int) -> Optional[tuple]:
+        """Автомобиль кортежем в порядке CAR_COLUMN_NAMES"""
+        located = self._locate(car_id)
+        return located[1] if located else None
+
+    def create(self, car_data: dict) -> Car:
+        """Создать автомобиль в шарде дилера (id - из общего счетчика шардов)"""
+        shard = self.router.assign(car_data.get("dealer_id", 0))
+        car_id = self.router.allocate_ids(1)[0]
+        with self.router.session(shard) as db:
+            return CarRepository(db).create(dict(car_data, id=car_id))
+
+    def update(self, car_id: int, car_data: dict, expected_versions: Optional[List[int]] = None) -> Optional[Car]:
+        """Обновить автомобиль в его шарде (см. CarRepository.update)"""
+        located = self._locate(car_id)
+        if located is None:
+            return None
+        shard, row = located
+        self.router.check_writable(row[-1])
+        with self.router.session(shard) as db:
+            return CarRepository(db).update(car_id, car_data, expected_versions)
+
+    def delete(self, car_id: int, expected_versions: Optional[List[int]] = None) -> bool:
+        """Удалить автомобиль в его шарде (см. CarRepository.delete)"""
+        located = self._locate(car_id)
+        if located is None:
+            return False
+        shard, row = located
+        self.router.check_writable(row[-1])
+        with self.router.session(shard) as db:
+            return CarRepository(db).delete(car_id, expected_versions)
+
+    def bulk_insert(self, rows: List[dict]) -> int:
+        """Вставить пакет автомобилей: по одной транзакции в каждом шарде, шарды - параллельно"""
+        if not rows:
+            return 0
+        shards: Dict[int, int] = {}
+        by_shard: Dict[int, List[dict]] = {}
+        for row in rows:
+            dealer_id = row.get("dealer_id", 0)
+            if dealer_id not in shards:
+                shards[dealer_id] = self.router.assign(dealer_id)
+            by_shard.setdefault(shards[dealer_id], []).append(row)
+        ids = iter(self.router.allocate_ids(len(rows)))
+        batches = [
+            (shard, [dict(row, id=next(ids)) for row in shard_rows]) for shard, shard_rows in by_shard.items()
+        ]
+
+        def insert_rows(batch):
+            shard, shard_rows = batch
+            with self.router.session(shard) as db:
+                db.execute(insert(DBCar), shard_rows)
+                db.commit()
+            return len(shard_rows)
+
+        try:
+            return sum(self.router.map(insert_rows, batches))
+        finally:
+            # Пакеты других шардов могли быть записаны и при ошибке
+            table_versions.bump(CARS_TABLE)
+            car_changes.publish("reload")
+
+    def update_many(
+        self,
+        values: dict,
+        ids: Optional[List[int]] = None,
+        filters: Optional[dict] = None,
+        price_factor: Optional[float] = None,
+    ) -> List[int]:
+        """Обновить автомобили по списку id и/или фильтру во всех шардах (или в шарде дилера)"""
+        stmt = build_car_batch_update(values, price_factor)
+        affected = self._run_batch(stmt, ids, filters, "update_returning")
+        if affected:
+            table_versions.bump(CARS_TABLE)
+            car_changes.publish("update", ids=affected)
+        return affected
+
+    def delete_many(self, ids: Optional[List[int]] = None, filters: Optional[dict] = None) -> List[int]:
+        """Удалить автомобили по списку id и/или фильтру во всех шардах (или в шарде дилера)"""
+        affected = self._run_batch(delete(DBCar), ids, filters, "delete_returning")
+        if affected:
+            car_changes.publish("delete", ids=affected)
+            table_versions.bump(CARS_TABLE)
+        return affected
+
+    def _run_batch(self, stmt, ids: Optional[List[int]], filters: Optional[dict], returning: str) -> List[int]:
+        frozen = self.router.frozen_dealer()
+        if frozen is not None:
+            raise DealerMoving(frozen)
+        results = self._scatter(self._targets(filters), lambda repo, shard_filters: repo._run_batch(
+            stmt, ids, shard_filters, getattr(repo.db.get_bind().dialect, returning)))
+        return list(chain.from_iterable(results))
+
+    def stats(
+        self,
+        group_by: str = "brand",
+        filters: Optional[dict] = None,
+        percentiles: Optional[List[float]] = None,
+    ) -> dict:
+        """Статистика по сводкам car_stats всех шардов (см. CarRepository.stats)
+
+        Группы шардов суммируются; во время переноса дилера сводка учитывает и
+        его копию (перцентили - без копий).
+        """
+        def shard_stats(repo, shard_filters):
+            rows = repo.db.execute(build_car_stats_query(group_by, filters)).all()
+            return rows, repo.db.execute(build_car_stats_freshness_query()).one()
+
+        results = self._scatter(self._everywhere(), shard_stats)
+        size = len(CAR_STATS_GROUPS[group_by])
+        groups: Dict[tuple, list] = {}
+        for rows, _ in results:
+            for row in rows:
+                key, (count, price_sum, min_price, max_price) = tuple(row[:size]), row[size:]
+                merged = groups.get(key)
+                if merged is None:
+                    groups[key] = [count, price_sum, min_price, max_price]
+                    continue
+                merged[0] += count
+                merged[1] = (merged[1] or 0) + (price_sum or 0)
+                merged[2] = _merge_min(merged[2], min_price)
+                merged[3] = _merge_max(merged[3], max_price)
+        # Порядок групп как у ORDER BY одного шарда: NULL первым
+        rows = [key + tuple(values) for key, values in sorted(
+            groups.items(), key=lambda item: [(value is not None, value) for value in item[0]])]
+        updated = [freshness[0] for _, freshness in results if freshness[0] is not None]
+        rebuilt = [freshness[1] for _, freshness in results if freshness[1] is not None]
+        freshness = (max(updated, default=None), min(rebuilt, default=None))
+        result = car_stats_result(group_by, rows, freshness, self.router.engines[0].dialect)
+        if not percentiles:
+            return result
+        version = table_versions.get(CARS_TABLE)
+        if car_price_snapshot.is_stale(version):
+            with car_price_snapshot.load_lock:
+                if car_price_snapshot.is_stale(version):
+                    prices: Dict[tuple, list] = {}
+                    for shard_groups in self._scatter(self._targets(None), lambda repo, shard_filters: repo.price_groups(
+                            shard_filters)):
+                        for brand, year, group_prices in shard_groups:
+                            prices.setdefault((brand, year), []).extend(group_prices)
+                    car_price_snapshot.load([key + (group_prices,) for key, group_prices in prices.items()], version)
+        return add_price_percentiles(result, percentiles, filters)
+
+    def rebuild_stats(self) -> None:
+        """Полная перестройка сводок car_stats всех шардов"""
+        self._scatter(self._everywhere(), lambda repo, filters: repo.rebuild_stats())
+
+    def iter_rows(self, columns: List[str], batch_size: int) -> Iterator[List[tuple]]:
+        """Все автомобили порциями кортежей: слияние потоков шардов по id"""
+        id_index = columns.index("id")
+
+        def shard_rows(shard: int, filters: dict) -> Iterator[tuple]:
+            stmt = (
+                CarRepository._apply_filters(select(*[getattr(DBCar, name) for name in columns]), filters)
+                .order_by(DBCar.id)
+                .execution_options(yield_per=batch_size)
+            )
+            with self.router.session(shard) as db:
+                for partition in db.execute(stmt).partitions():
+                    yield from partition
+
+        merged = heapq.merge(*(shard_rows(shard, filters) for shard, filters in self._targets(None)),
+                             key=itemgetter(id_index))
+        while True:
+            batch = list(islice(merged, batch_size))
+            if not batch:
+                return
+            yield batch
+
+
+sharded_cars = ShardedCarRepository()
+
+
+# Изменение этих полей отзывает выданные токены: в claims хранятся имя и роль
+TOKEN_REVOKING_USER_FIELDS = ("username", "role", "is_active", "hashed_password")
+
+
+def user_update_values(user_data: dict) -> dict:
+    """Значения UPDATE пользователя: известные колонки, is_active строкой, новая версия токенов при необходимости
+
+    Версия токенов увеличивается в том же UPDATE, только если значение поля из
+    TOKEN_REVOKING_USER_FIELDS отличается от сохраненного (форма редактирования
+    передает имя и роль и без их изменения).
+    """
+    values = {key: value for key, value in user_data.items() if hasattr(DBUser, key)}
+    if values.get("is_active") is not None:
+        values["is_active"] = "true" if values["is_active"] else "false"
+    changed = [
+        getattr(DBUser, field).is_distinct_from(values[field])
+        for field in TOKEN_REVOKING_USER_FIELDS if field in values
+    ]
+    if changed:
+        values["token_version"] = DBUser.token_version + case((or_(*changed), 1), else_=0)
+    return values
+
+
+def user_from_row(row) -> User:
+    """Pydantic-модель пользователя из строки USER_COLUMNS"""
+    values = dict(zip((column.key for column in USER_COLUMNS), row))
+    values["is_active"] = values["is_active"] == "true"
+    return User(**values)
+
+
 class UserRepository:
     """Репозиторий для работы с пользователями"""
     
@@ -103,65 +1077,98 @@ class UserRepository:
         self.db.refresh(db_user)
         return self._convert_to_pydantic(db_user)
 
-    def update(self, user_id: int, user_data: dict) -> Optional[User]:
-        """Обновить пользователя"""
-        db_user = self.db.query(DBUser).filter(DBUser.id == user_id).first()
-        if not db_user:
-            return None
-        
+    def update(self, user_id: int, user_data: dict, expected_versions: Optional[List[int]] = None) -> Optional[User]:
+        """Обновить пользователя одним UPDATE ... RETURNING (expected_versions - см. CarRepository.update)"""
+        user_data = dict(user_data)
         # Если обновляется пароль, хешируем его
         if 'password' in user_data:
-            hashed_password = AuthService.get_password_hash(user_data.pop('password'))
-            user_data['hashed_password'] = hashed_password
-        
-        # Обновляем поля
-        for key, value in user_data.items():
-            if hasattr(db_user, key):
-                setattr(db_user, key, value)
-        
+            user_data['hashed_password'] = AuthService.get_password_hash(user_data.pop('password'))
+
+        values = user_update_values(user_data)
+        stmt = build_versioned_update(DBUser, user_id, values, expected_versions)
+        row = execute_returning(self.db, stmt, USER_COLUMNS, DBUser, user_id)
+        if row is None:
+            self.db.rollback()
+            check_conflict(self.db, DBUser, user_id, expected_versions)
+            return None
         self.db.commit()
-        self.db.refresh(db_user)
-        return self._convert_to_pydantic(db_user)
+        if "token_version" in values:
+            revoke_user_tokens(user_id)
+        return user_from_row(row)
 
-    def delete(self, user_id: int) -> bool:
-        """Удалить пользователя"""
-        db_user = self.db.query(DBUser).filter(DBUser.id == user_id).first()
+    def delete(self, user_id: int, expected_versions: Optional[List[int]] = None) -> bool:
+        """Удалить пользователя одним DELETE (expected_versions - см. CarRepository.update)"""
+        if self.db.execute(build_versioned_delete(DBUser, user_id, expected_versions)).rowcount == 0:
+            self.db.rollback()
+            check_conflict(self.db, DBUser, user_id, expected_versions)
+            return False
+        self.db.commit()
+        revoke_user_tokens(user_id)
+        return True
+
+    def revoke_tokens(self, user_id: int) -> bool:
+        """Отозвать все токены пользователя"""
+        db_user = self._get_db_user(user_id)
         if not db_user:
             return False
-        
-        self.db.delete(db_user)
+        db_user.token_version = (db_user.token_version or 0) + 1
         self.db.commit()
+        revoke_user_tokens(user_id)
         return True
 
-    def authenticate_user(self, username: str, password: str) -> Optional[DBUser]:
-        """Аутентификация пользователя"""
-        user = self.get_by_username(username)
+    async def authenticate_user(self, username: str, password: str) -> Optional[DBUser]:
+        """Аутентификация пользователя (хеш проверяется в пуле процессов)"""
+        user = await run_in_threadpool(self.get_by_username, username)
         if not user:
             return None
-        if not AuthService.verify_password(password, user.hashed_password):
+        valid, new_hash = await password_hasher.verify(password, user.hashed_password)
+        if not valid:
             return None
+        if new_hash:
+            # Хеш с устаревшими параметрами прозрачно пересчитывается
+            await run_in_threadpool(self._store_password_hash, user, new_hash)
         return user
 
-    def change_password(self, user_id: int, current_password: str, new_password: str) -> bool:
+    async def change_password(self, user_id: int, current_password: str, new_password: str) -> bool:
         """Смена пароля пользователя"""
-        db_user = self.db.query(DBUser).filter(DBUser.id == user_id).first()
+        db_user = await run_in_threadpool(self._get_db_user, user_id)
         if not db_user:
             return False
         
         # Проверяем текущий пароль
-        if not AuthService.verify_password(current_password, db_user.hashed_password):
+        valid, _ = await password_hasher.verify(current_password, db_user.hashed_password)
+        if not valid:
             return False
         
         # Устанавливаем новый пароль
-        db_user.hashed_password = AuthService.get_password_hash(new_password)
-        self.db.commit()
+        new_hash = await password_hasher.hash(new_password)
+        await run_in_threadpool(self._store_password_hash, db_user, new_hash, True)
         return True
 
+    async def create_with_password(self, user_data: dict) -> User:
+        """Создать пользователя, хешируя пароль в пуле процессов"""
+        user_data = dict(user_data)
+        user_data['hashed_password'] = await password_hasher.hash(user_data.pop('password'))
+        return await run_in_threadpool(self.create, user_data)
+
     def get_users_by_role(self, role: UserRole) -> List[User]:
         """Получить пользователей по роли"""
         db_users = self.db.query(DBUser).filter(DBUser.role == role).all()
         return [self._convert_to_pydantic(user) for user in db_users]
 
+    def _get_db_user(self, user_id: int) -> Optional[DBUser]:
+        """Получить модель БД пользователя по ID"""
+        return self.db.query(DBUser).filter(DBUser.id == user_id).first()
+
+    def _store_password_hash(self, db_user: DBUser, hashed_password: str, revoke_tokens: bool = False) -> None:
+        """Сохранить новый хеш пароля; при смене пароля выданные токены отзываются"""
+        db_user.hashed_password = hashed_password
+        if revoke_tokens:
+            db_user.token_version = (db_user.token_version or 0) + 1
+        self.db.commit()
+        if revoke_tokens:
+            revoke_user_tokens(db_user.id)
+
     def _convert_to_pydantic(self, db_user: DBUser) -> User:
         """Конвертация модели БД в Pydantic модель"""
         return User(
@@ -172,5 +1179,97 @@ class UserRepository:
             role=db_user.role,
             is_active=db_user.is_active == "true",  # Конвертация строки в bool
             created_at=db_user.created_at,
-            updated_at=db_user.updated_at
-        )
\ No newline at end of file
+            updated_at=db_user.updated_at,
+            version=db_user.version,
+        )
+
+
+# Колонки фотографии в порядке полей модели CarPhoto
+PHOTO_COLUMNS = [
+    DBCarPhoto.id, DBCarPhoto.car_id, DBCarPhoto.content_type, DBCarPhoto.size,
+    DBCarPhoto.digest, DBCarPhoto.thumbnail, DBCarPhoto.created_at,
+]
+
+
+def photo_from_row(row) -> CarPhoto:
+    return CarPhoto(**dict(zip((column.key for column in PHOTO_COLUMNS), row)))
+
+
+class PhotoRepository:
+    """Репозиторий метаданных фотографий автомобилей (файлы - media.py)"""
+
+    def __init__(self, db: Session):
+        self.db = db
+
+    def car_exists(self, car_id: int) -> bool:
+        if car_shards.enabled:
+            return bool(sharded_cars.existing_ids([car_id]))
+        return self.db.execute(select(DBCar.id).where(DBCar.id == car_id)).first() is not None
+
+    def create(self, car_id: int, digest: str, content_type: str, size: int, thumbnail: str) -> Optional[CarPhoto]:
+        """Добавить фотографию одним INSERT ... SELECT; None - автомобиль не найден (или удален во время загрузки)"""
+        # Автомобили шардов не видны в основной БД: проверка отдельным запросом
+        sharded = car_shards.enabled
+        if sharded and not self.car_exists(car_id):
+            return None
+        values = {
+            "car_id": car_id, "digest": digest, "content_type": content_type,
+            "size": size, "thumbnail": thumbnail, "created_at": datetime.utcnow(),
+        }
+        source = select(*(literal(value, DBCarPhoto.__table__.c[key].type) for key, value in values.items()))
+        if not sharded:
+            source = source.where(exists().where(DBCar.id == car_id))
+        stmt = insert(DBCarPhoto).from_select(list(values), source)
+        if self.db.get_bind().dialect.insert_returning:
+            row = self.db.execute(stmt.returning(*PHOTO_COLUMNS)).first()
+        else:
+            result = self.db.execute(stmt)
+            row = result.rowcount and self.db.execute(
+                select(*PHOTO_COLUMNS).where(DBCarPhoto.id == result.lastrowid)).first()
+        if not row:
+            self.db.rollback()
+            return None
+        self.db.commit()
+        return photo_from_row(row)
+
+    def list(self, car_id: int) -> List[CarPhoto]:
+        rows = self.db.execute(select(*PHOTO_COLUMNS).where(DBCarPhoto.car_id == car_id).order_by(DBCarPhoto.id))
+        return [photo_from_row(row) for row in rows]
+
+    def get(self, car_id: int, photo_id: int) -> Optional[CarPhoto]:
+        row = self.db.execute(
+            select(*PHOTO_COLUMNS).where(DBCarPhoto.id == photo_id, DBCarPhoto.car_id == car_id)).first()
+        return photo_from_row(row) if row else None
+
+    def delete(self, car_id: int, photo_id: int) -> Optional[str]:
+        """Удалить фотографию; возвращает хеш ее файла (None - не найдена)"""
+        photo = self.get(car_id, photo_id)
+        if photo is None:
+            return None
+        self.db.execute(delete(DBCarPhoto).where(DBCarPhoto.id == photo_id))
+        self.db.commit()
+        return photo.digest
+
+    def delete_orphans(self) -> List[str]:
+        """Удалить фотографии удаленных автомобилей (шарды и строки, оставшиеся от прежних версий); возвращает хеши их файлов"""
+        if car_shards.enabled:
+            car_ids = self.db.execute(select(DBCarPhoto.car_id).distinct()).scalars().all()
+            existing = sharded_cars.existing_ids(car_ids)
+            orphaned = DBCarPhoto.car_id.in_([car_id for car_id in car_ids if car_id not in existing])
+        else:
+            orphaned = ~exists().where(DBCar.id == DBCarPhoto.car_id)
+        rows = self.db.execute(select(DBCarPhoto.id, DBCarPhoto.digest).where(orphaned)).all()
+        if rows:
+            self.db.execute(delete(DBCarPhoto).where(DBCarPhoto.id.in_([row.id for row in rows])))
+            self.db.commit()
+        return [row.digest for row in rows]
+
+    def unreferenced(self, digests: List[str]) -> List[str]:
+        """Хеши, на которые не ссылается ни одна фотография (файлы можно удалить)"""
+        used = set(self.db.execute(select(DBCarPhoto.digest).where(DBCarPhoto.digest.in_(digests))).scalars())
+        return [digest for digest in dict.fromkeys(digests) if digest not in used]
+
+    def set_thumbnail(self, digest: str, status: str) -> None:
+        """Состояние миниатюры всех фотографий с этим содержимым"""
+        self.db.execute(update(DBCarPhoto).where(DBCarPhoto.digest == digest).values(thumbnail=status))
+        self.db.commit()
@@ -0,0 +1,223 @@
+import os
+import threading
+import uuid
+import zlib
+from typing import Any, Awaitable, Callable, List, Optional
+from fastapi import Request, Response
+from sqlalchemy import insert, select, update
+from cache import TTLCache
+from content_encoding import EncodedBody, encoded_response, matched_etag, not_modified_response
+from database import DBTableVersion, engine
+from invalidation import invalidation_bus
+from singleflight import SingleFlight
+
+# Настройки кэша ответов (переменные окружения)
+RESPONSE_CACHE_ENABLED = os.getenv("RESPONSE_CACHE_ENABLED", "1") == "1"
+RESPONSE_CACHE_MAXSIZE = int(os.getenv("RESPONSE_CACHE_MAXSIZE", "2048"))
+RESPONSE_CACHE_TTL_SECONDS = float(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "300"))
+
+CARS_TABLE = "cars"
+
+
+class TableVersions:
+    """Версии таблиц, общие для всех воркеров; репозитории увеличивают их после каждой записи
+
+    Версия и эпоха таблицы хранятся в table_versions основной БД, поэтому
+    воркеры выдают одинаковые ETag для одних и тех же данных. Новую версию
+    другие процессы получают через invalidation_bus (с задержкой
+    INVALIDATION_POLL_SECONDS); версия таблицы, к которой процесс еще не
+    обращался, читается из БД.
+    """
+
+    def __init__(self, bind=engine):
+        self.bind = bind
+        # Таблица -> (эпоха, версия)
+        self._versions: dict = {}
+        self._lock = threading.Lock()
+
+    def get(self, table: str) -> int:
+        return self._state(table)[1]
+
+    def epoch(self, table: str) -> str:
+        return self._state(table)[0]
+
+    def bump(self, table: str) -> int:
+        """Увеличение версии в БД и рассылка ее другим процессам"""
+        with self.bind.begin() as connection:
+            row = DBTableVersion.name == table
+            if not connection.execute(update(DBTableVersion).where(row).values(
+                    version=DBTableVersion.version + 1)).rowcount:
+                connection.execute(insert(DBTableVersion).values(name=table, version=1, epoch=uuid.uuid4().hex[:8]))
+            epoch, version = connection.execute(select(DBTableVersion.epoch, DBTableVersion.version).where(row)).one()
+        self._apply(table, epoch, version)
+        invalidation_bus.publish(TABLE_VERSIONS_CHANNEL, f"{table}:{epoch}:{version}")
+        return version
+
+    def receive(self, payload: str) -> None:
+        """Версия, увеличенная другим процессом"""
+        table, epoch, version = payload.rsplit(":", 2)
+        self._apply(table, epoch, int(version))
+
+    def _state(self, table: str) -> tuple:
+        state = self._versions.get(table)
+        if state is None:
+            with self.bind.connect() as connection:
+                row = connection.execute(select(DBTableVersion.epoch, DBTableVersion.version)
+                                         .where(DBTableVersion.name == table)).first()
+            # Строки нет, пока в таблицу не было записей
+            state = self._apply(table, *(row or ("", 0)))
+        return state
+
+    def _apply(self, table: str, epoch: str, version: int) -> tuple:
+        """Новое состояние таблицы; события могут прийти не по порядку - версия не уменьшается"""
+        with self._lock:
+            state = self._versions.get(table)
+            if state is None or state[0] != epoch or state[1] < version:
+                state = self._versions[table] = (epoch, version)
+            return state
+
+
+TABLE_VERSIONS_CHANNEL = "table_versions"
+
+table_versions = TableVersions()
+invalidation_bus.subscribe(TABLE_VERSIONS_CHANNEL, table_versions.receive)
+
+
+def entity_etag(version: int) -> str:
+    """Сильный ETag записи по версии ее строки (cars.version, users.version)"""
+    return f'"{version}"'
+
+
+def if_match_versions(request: Request) -> Optional[List[int]]:
+    """Версии строки из If-Match; None - заголовка нет или "*" (изменение без условия)
+
+    Слабые и нераспознанные теги не совпадают ни с одной версией: ответ 412.
+    """
+    header = request.headers.get("if-match")
+    if header is None or header.strip() == "*":
+        return None
+    versions = []
+    for value in header.split(","):
+        value = value.strip()
+        if len(value) < 2 or not value.startswith('"') or not value.endswith('"'):
+            continue
+        # У сжатого варианта ответа к ETag добавлена кодировка (content_encoding.encoded_etag)
+        tag = value[1:-1].split("-", 1)[0]
+        if tag.isdigit():
+            versions.append(int(tag))
+    return versions
+
+
+class ResponseCache:
+    """Кэш сериализованных JSON-ответов с ETag по версии таблицы
+
+    Ключ записи включает версию таблицы, поэтому после записи в таблицу
+    старые записи становятся недостижимыми и вытесняются по LRU/TTL.
+    Вместе с телом хранятся его сжатые варианты: каждая кодировка
+    сжимается один раз на запись кэша.
+
+    Одновременные промахи с одним ключом объединяются (SingleFlight): запрос
+    к БД и сериализацию выполняет один из них, остальные получают то же тело.
+    Ключ включает версию таблицы, поэтому запрос, пришедший после записи, не
+    присоединяется к чтению, начатому до нее. key_func задает ключ ответа по
+    запросу (по умолчанию make_key).
+
+    Для одной записи (entity=True) produce() возвращает (значение, ETag
+    записи): ETag не зависит от версии таблицы и совпадает с If-Match
+    изменения, а 304 проверяется после чтения записи из кэша или БД.
+    """
+
+    def __init__(self, maxsize: int = RESPONSE_CACHE_MAXSIZE, ttl: float = RESPONSE_CACHE_TTL_SECONDS,
+                 enabled: bool = RESPONSE_CACHE_ENABLED, key_func: Optional[Callable[[Request], str]] = None,
+                 name: str = "response"):
+        self.enabled = enabled
+        self.not_modified = 0
+        self.key_func = key_func or self.make_key
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._flights = SingleFlight(name)
+
+    @staticmethod
+    def make_key(request: Request) -> str:
+        """Ключ ответа: путь и отсортированные параметры запроса"""
+        query = "&".join(f"{k}={v}" for k, v in sorted(request.query_params.multi_items()))
+        return f"{request.url.path}?{query}"
+
+    @staticmethod
+    def make_etag(table: str, version: int, key: str) -> str:
+        """Сильный ETag, зависящий от версии таблицы и ключа ответа"""
+        return f'"{table_versions.epoch(table)}-{table}-{version}-{zlib.crc32(key.encode()):08x}"'
+
+    def respond(self, request: Request, table: str, produce: Callable[[], Any], entity: bool = False) -> Response:
+        """Ответ из кэша, 304 по If-None-Match или результат produce()"""
+        version, key, etag = self._prepare(request, table)
+        if not entity:
+            matched = matched_etag(request, etag)
+            if matched is not None:
+                return self._not_modified(matched)
+        entry = self._cache.get((table, version, key)) if self.enabled else None
+        if entry is None:
+            entry = self._flights.do(
+                (table, version, key), lambda: self._store(table, version, key, produce(), entity))
+        return self._respond_entry(request, entry, etag)
+
+    async def respond_async(self, request: Request, table: str, produce: Callable[[], Awaitable[Any]],
+                            entity: bool = False) -> Response:
+        """Асинхронный вариант respond()"""
+        version, key, etag = self._prepare(request, table)
+        if not entity:
+            matched = matched_etag(request, etag)
+            if matched is not None:
+                return self._not_modified(matched)
+        entry = self._cache.get((table, version, key)) if self.enabled else None
+        if entry is None:
+            async def produce_entry():
+                return self._store(table, version, key, await produce(), entity)
+
+            entry = await self._flights.do_async((table, version, key), produce_entry)
+        return self._respond_entry(request, entry, etag)
+
+    def stats(self) -> dict:
+        """Метрики кэша: попадания, промахи, доля попаданий, ответы 304, объединенные промахи"""
+        stats = self._cache.stats()
+        stats["not_modified"] = self.not_modified
+        stats["coalesced"] = self._flights.coalesced
+        return stats
+
+    def clear(self) -> None:
+        self._cache.clear()
+
+    def _prepare(self, request: Request, table: str):
+        version = table_versions.get(table)
+        key = self.key_func(request)
+        return version, key, self.make_etag(table, version, key)
+
+    def _store(self, table: str, version: int, key: str, value: Any, entity: bool) -> tuple:
+        """Запись кэша: тело и ETag записи (None - ETag по версии таблицы)"""
+        value, etag = value if entity else (value, None)
+        entry = (EncodedBody(self._serialize(value)), etag)
+        if self.enabled:
+            self._cache.set((table, version, key), entry)
+        return entry
+
+    def _respond_entry(self, request: Request, entry: tuple, etag: str) -> Response:
+        body, entity_etag = entry
+        if entity_etag is not None:
+            etag = entity_etag
+            matched = matched_etag(request, etag)
+            if matched is not None:
+                return self._not_modified(matched)
+        return encoded_response(request, body, etag, "application/json")
+
+    def _not_modified(self, etag: str) -> Response:
+        self.not_modified += 1
+        return not_modified_response(etag)
+
+    @staticmethod
+    def _serialize(value: Any) -> bytes:
+        # produce() может вернуть уже готовые JSON-байты (быстрый путь чтения)
+        if isinstance(value, bytes):
+            return value
+        return value.model_dump_json().encode()
+
+
+car_response_cache = ResponseCache()
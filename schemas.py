@@ -1,5 +1,8 @@
-from typing import Optional
-from pydantic import BaseModel
+from typing import List, Optional
+from pydantic import BaseModel, Field, model_validator
+
+# Максимальное число id в одном пакетном запросе
+MAX_BATCH_IDS = 10000
 
 class CarCreate(BaseModel):
     brand: str
@@ -7,6 +10,7 @@ class CarCreate(BaseModel):
     year: int
     price: float
     color: Optional[str] = None
+    dealer_id: int = Field(0, ge=0)
 
 class CarUpdate(BaseModel):
     brand: Optional[str] = None
@@ -15,3 +19,41 @@ class CarUpdate(BaseModel):
     price: Optional[float] = None
     color: Optional[str] = None
 
+
+class CarFilter(BaseModel):
+    brand: Optional[str] = None
+    model: Optional[str] = None
+    color: Optional[str] = None
+    year_min: Optional[int] = None
+    year_max: Optional[int] = None
+    price_min: Optional[float] = None
+    price_max: Optional[float] = None
+    dealer_id: Optional[int] = None
+
+class CarBatchSelector(BaseModel):
+    """Выбор автомобилей для пакетной операции: список id и/или фильтр"""
+    ids: Optional[List[int]] = Field(None, min_length=1, max_length=MAX_BATCH_IDS)
+    filter: Optional[CarFilter] = None
+
+    @model_validator(mode="after")
+    def check_selector(self):
+        if self.ids is None and (self.filter is None or not self.filter.model_dump(exclude_none=True)):
+            raise ValueError("Нужно указать ids или непустой filter")
+        return self
+
+class CarBatchUpdate(CarBatchSelector):
+    set: CarUpdate = Field(default_factory=CarUpdate)
+    # Множитель цены (переоценка): price = price * price_factor
+    price_factor: Optional[float] = Field(None, gt=0)
+
+    @model_validator(mode="after")
+    def check_changes(self):
+        changes = self.set.model_dump(exclude_unset=True)
+        if not changes and self.price_factor is None:
+            raise ValueError("Нужно указать set или price_factor")
+        if "price" in changes and self.price_factor is not None:
+            raise ValueError("set.price и price_factor несовместимы")
+        return self
+
+class CarBatchDelete(CarBatchSelector):
+    pass
@@ -0,0 +1,237 @@
+import os
+import re
+import threading
+import time
+import unicodedata
+from bisect import bisect_left
+from difflib import get_close_matches
+from functools import lru_cache
+from typing import Dict, Iterable, List, NamedTuple, Sequence, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from cache import TTLCache
+
+# Полнотекстовый индекс SQLite FTS5 по марке, модели и цвету автомобиля
+CARS_FTS_TABLE = "cars_fts"
+CARS_FTS_VOCAB_TABLE = "cars_fts_vocab"
+# Релевантность: вес поля, в котором найдено слово, умноженный на качество
+# совпадения (точное, по префиксу, исправленная опечатка). bm25 с теми же весами
+# полей только отбирает в SQL кандидатов для ранжирования: IDF для коротких полей
+# почти бесполезен
+SEARCH_FIELD_WEIGHTS = {"brand": 10.0, "model": 5.0, "color": 1.0}
+PREFIX_MATCH_FACTOR = 0.8
+TYPO_MATCH_FACTOR = 0.5
+
+# Границы фасетов: год - по десятилетиям, цена - по диапазонам
+YEAR_BUCKET_SIZE = 10
+PRICE_BANDS = (10_000, 20_000, 30_000, 50_000, 100_000)
+
+# Словарь терминов для исправления опечаток обновляется не чаще, чем раз в столько секунд
+SEARCH_VOCAB_REFRESH_SECONDS = float(os.getenv("SEARCH_VOCAB_REFRESH_SECONDS", "60"))
+# Минимальное сходство (difflib) для замены слова с опечаткой
+SEARCH_TYPO_CUTOFF = 0.75
+SEARCH_MAX_TOKENS = 8
+# Сколько лучших по bm25 совпадений читается и ранжируется: частое слово
+# совпадает с десятками тысяч строк, фасеты при этом считаются по всем совпадениям
+SEARCH_MAX_CANDIDATES = int(os.getenv("SEARCH_MAX_CANDIDATES", "500"))
+
+# Внешний контент-индекс (content=cars) и триггеры синхронизации: индекс
+# обновляется при любых изменениях таблицы, включая пакетные вставки
+CARS_FTS_DDL = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {CARS_FTS_TABLE} USING fts5(
+        brand, model, color,
+        content='cars', content_rowid='id',
+        tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+    )""",
+    f"CREATE VIRTUAL TABLE IF NOT EXISTS {CARS_FTS_VOCAB_TABLE} USING fts5vocab({CARS_FTS_TABLE}, 'row')",
+    f"""CREATE TRIGGER IF NOT EXISTS cars_fts_ai AFTER INSERT ON cars BEGIN
+        INSERT INTO {CARS_FTS_TABLE}(rowid, brand, model, color)
+        VALUES (new.id, new.brand, new.model, new.color);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS cars_fts_ad AFTER DELETE ON cars BEGIN
+        INSERT INTO {CARS_FTS_TABLE}({CARS_FTS_TABLE}, rowid, brand, model, color)
+        VALUES ('delete', old.id, old.brand, old.model, old.color);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS cars_fts_au AFTER UPDATE OF brand, model, color ON cars BEGIN
+        INSERT INTO {CARS_FTS_TABLE}({CARS_FTS_TABLE}, rowid, brand, model, color)
+        VALUES ('delete', old.id, old.brand, old.model, old.color);
+        INSERT INTO {CARS_FTS_TABLE}(rowid, brand, model, color)
+        VALUES (new.id, new.brand, new.model, new.color);
+    END""",
+]
+
+VOCABULARY_QUERY = text(f"SELECT term FROM {CARS_FTS_VOCAB_TABLE}")
+
+_TOKEN_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def create_search_index(connection: Connection) -> None:
+    """Создание FTS5-индекса и триггеров (только SQLite); существующие строки индексируются"""
+    if connection.dialect.name != "sqlite":
+        return
+    exists = connection.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {"name": CARS_FTS_TABLE},
+    ).first()
+    for statement in CARS_FTS_DDL:
+        connection.execute(text(statement))
+    if not exists:
+        connection.execute(text(f"INSERT INTO {CARS_FTS_TABLE}({CARS_FTS_TABLE}) VALUES ('rebuild')"))
+
+
+def tokenize(query: str) -> List[str]:
+    """Слова поискового запроса в нижнем регистре"""
+    return _words(query)[:SEARCH_MAX_TOKENS]
+
+
+class SearchVocabulary:
+    """Термины FTS-индекса для префиксного поиска и исправления опечаток"""
+
+    def __init__(self, refresh_seconds: float = SEARCH_VOCAB_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self._terms: List[str] = []
+        self._version = None
+        self._loaded_at = 0.0
+        self._lock = threading.Lock()
+
+    def is_stale(self, version) -> bool:
+        """Нужно ли перечитать термины: изменилась таблица и прошло refresh_seconds"""
+        if self._version is None:
+            return True
+        return version != self._version and time.monotonic() - self._loaded_at >= self.refresh_seconds
+
+    def load(self, terms: Iterable[str], version) -> None:
+        terms = sorted(terms)
+        with self._lock:
+            self._terms = terms
+            self._version = version
+            self._loaded_at = time.monotonic()
+
+    def has_term(self, token: str) -> bool:
+        terms = self._terms
+        index = bisect_left(terms, token)
+        return index < len(terms) and terms[index] == token
+
+    def is_complete(self, token: str) -> bool:
+        """Слово - термин индекса, и других терминов с таким префиксом нет"""
+        terms = self._terms
+        index = bisect_left(terms, token)
+        return (
+            index < len(terms) and terms[index] == token
+            and (index + 1 == len(terms) or not terms[index + 1].startswith(token))
+        )
+
+    def has_prefix(self, token: str) -> bool:
+        terms = self._terms
+        index = bisect_left(terms, token)
+        return index < len(terms) and terms[index].startswith(token)
+
+    def correct(self, token: str) -> List[str]:
+        """Похожие термины для слова, которого нет в индексе"""
+        return get_close_matches(token, self._terms, n=3, cutoff=SEARCH_TYPO_CUTOFF)
+
+    def expand(self, tokens: List[str]) -> List["SearchTerm"]:
+        """Слова запроса с режимом поиска
+
+        Слово, совпадающее с термином индекса, ищется точно; последнее слово
+        (набирается пользователем) - по префиксу от двух символов, если его
+        могут продолжать другие термины; слово без совпадений по префиксу
+        дополняется похожими терминами (опечатки).
+        """
+        terms = []
+        for position, token in enumerate(tokens):
+            last = position == len(tokens) - 1
+            if self.is_complete(token) or (self.has_term(token) and not (last and len(token) >= 2)):
+                terms.append(SearchTerm(token, False, ()))
+            else:
+                variants = () if self.has_prefix(token) else tuple(self.correct(token))
+                terms.append(SearchTerm(token, True, variants))
+        return terms
+
+
+class SearchTerm(NamedTuple):
+    """Слово запроса: искать ли по префиксу и варианты исправления опечатки"""
+    token: str
+    prefix: bool
+    variants: Tuple[str, ...]
+
+
+def build_match(terms: List[SearchTerm]) -> str:
+    """Выражение MATCH: все слова обязательны, варианты слова - через OR"""
+    groups = []
+    for term in terms:
+        variants = [f'"{term.token}"*' if term.prefix else f'"{term.token}"']
+        variants += [f'"{variant}"' for variant in term.variants]
+        groups.append(variants[0] if len(variants) == 1 else "(" + " OR ".join(variants) + ")")
+    return " AND ".join(groups)
+
+
+def _words(value: str) -> List[str]:
+    # Как токенизатор unicode61 с remove_diacritics: "Škoda" -> "skoda"
+    folded = "".join(ch for ch in unicodedata.normalize("NFKD", value.lower()) if not unicodedata.combining(ch))
+    return _TOKEN_RE.findall(folded)
+
+
+@lru_cache(maxsize=65536)
+def _field_words(value: str) -> Tuple[str, ...]:
+    return tuple(_words(value))
+
+
+def relevance(terms: List[SearchTerm], fields: Sequence[Tuple[float, str]]) -> float:
+    """Релевантность строки: сумма лучших совпадений слов запроса по полям (вес, значение)"""
+    words = [(weight, _field_words(value)) for weight, value in fields if value]
+    total = 0.0
+    for term in terms:
+        best = 0.0
+        for weight, field_words in words:
+            for word in field_words:
+                if word == term.token:
+                    score = weight
+                elif term.prefix and word.startswith(term.token):
+                    score = weight * PREFIX_MATCH_FACTOR
+                elif word in term.variants:
+                    score = weight * TYPO_MATCH_FACTOR
+                else:
+                    continue
+                best = max(best, score)
+        total += best
+    return total
+
+
+def collect_facets(rows: Iterable[tuple]) -> Dict[str, Dict[str, int]]:
+    """Фасеты из строк (марка, начало десятилетия, номер ценового диапазона, количество)
+
+    Строки - результат одного агрегирующего запроса по всем трем измерениям;
+    счетчики отдельных фасетов получаются суммированием.
+    """
+    brands: Dict[str, int] = {}
+    decades: Dict[int, int] = {}
+    bands: Dict[int, int] = {}
+    for brand, decade, band, count in rows:
+        if brand is not None:
+            brands[brand] = brands.get(brand, 0) + count
+        if decade is not None:
+            decades[decade] = decades.get(decade, 0) + count
+        bands[band] = bands.get(band, 0) + count
+    return {
+        "brand": dict(sorted(brands.items(), key=lambda item: (-item[1], item[0]))),
+        "year": {f"{start}-{start + YEAR_BUCKET_SIZE - 1}": decades[start] for start in sorted(decades)},
+        "price": {_price_band_label(band): bands[band] for band in sorted(bands)},
+    }
+
+
+def _price_band_label(band: int) -> str:
+    low = PRICE_BANDS[band - 1] if band > 0 else 0
+    return f"{low}-{PRICE_BANDS[band]}" if band < len(PRICE_BANDS) else f"{low}+"
+
+
+def facet_cache_key(match: str, filters: dict, version) -> tuple:
+    """Ключ кэша фасетов; версия таблицы делает записи до изменения недостижимыми"""
+    return match, tuple(sorted((key, value) for key, value in filters.items() if value is not None)), version
+
+
+car_search_vocabulary = SearchVocabulary()
+# Точные фасеты частого слова требуют агрегирования всех совпадений,
+# поэтому они кэшируются между страницами и разными limit
+facet_cache = TTLCache(maxsize=1024, ttl=300)
@@ -0,0 +1,91 @@
+"""Запуск сервера в несколько процессов
+
+Перед запуском воркеров главный процесс применяет миграции схемы БД
+(migrations.py), импортирует приложение (ошибки импорта видны сразу) и
+однократно наполняет БД; воркеры при старте только сверяют версию схемы.
+Если установлен gunicorn, воркеры uvicorn запускаются под ним с preload_app:
+приложение загружается один раз и наследуется воркерами при fork. Иначе
+используется менеджер процессов uvicorn (--workers).
+
+Запуск: python serve.py  (WEB_WORKERS=8 WEB_PORT=8000 python serve.py)
+"""
+import os
+import sys
+
+# Настройки запуска (переменные окружения)
+WEB_HOST = os.getenv("WEB_HOST", "0.0.0.0")
+WEB_PORT = int(os.getenv("WEB_PORT", "8000"))
+# Число воркеров; по умолчанию - по числу ядер
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", "0")) or os.cpu_count() or 1
+# gunicorn, uvicorn или auto (gunicorn, если установлен)
+WEB_SERVER = os.getenv("WEB_SERVER", "auto")
+# Сколько секунд воркер завершает текущие запросы при остановке
+WEB_GRACEFUL_TIMEOUT = int(os.getenv("WEB_GRACEFUL_TIMEOUT", "30"))
+
+
+def _use_gunicorn() -> bool:
+    if WEB_SERVER != "auto":
+        return WEB_SERVER == "gunicorn"
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def run_gunicorn(workers: int) -> None:
+    from gunicorn.app.base import BaseApplication
+    from database import dispose_engines_after_fork
+
+    class Application(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{WEB_HOST}:{WEB_PORT}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("worker_class", "uvicorn.workers.UvicornWorker")
+            self.cfg.set("preload_app", True)
+            self.cfg.set("graceful_timeout", WEB_GRACEFUL_TIMEOUT)
+            self.cfg.set("post_fork", lambda server, worker: dispose_engines_after_fork())
+
+        def load(self):
+            from app import app
+            return app
+
+    Application().run()
+
+
+def run_uvicorn(workers: int) -> None:
+    import uvicorn
+
+    uvicorn.run(
+        "app:app",
+        host=WEB_HOST,
+        port=WEB_PORT,
+        workers=workers,
+        timeout_graceful_shutdown=WEB_GRACEFUL_TIMEOUT,
+    )
+
+
+def main() -> int:
+    # Пул хеширования паролей делит ядра между воркерами, а не создается на все ядра в каждом
+    os.environ.setdefault("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 1) // WEB_WORKERS)))
+
+    # Лимиты частоты запросов общие для воркеров, а не отдельные в каждом
+    if WEB_WORKERS > 1:
+        os.environ.setdefault("RATE_LIMIT_STORE", "sqlite")
+
+    from migrations import migrate
+
+    migrate()
+    import app  # noqa: F401
+    from bootstrap import seed_initial_data
+
+    seed_initial_data()
+    if _use_gunicorn():
+        run_gunicorn(WEB_WORKERS)
+    else:
+        run_uvicorn(WEB_WORKERS)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
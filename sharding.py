@@ -0,0 +1,391 @@
+"""Шардирование автомобилей по дилерам
+
+Автомобили одного дилера хранятся в одной БД (шарде), поэтому запись разных
+дилеров в разные файлы SQLite не ждет общей блокировки записи. Шард 0 -
+основная БД (DATABASE_URL: пользователи, фотографии, служебные таблицы),
+дополнительные шарды задаются CAR_SHARD_URLS; без них шардирование выключено.
+
+Размещение дилера закрепляется в таблице dealer_shards основной БД при первой
+записи (dealer_id % число шардов) и не меняется при добавлении шардов: дилера
+переносит python sharding.py move. id автомобилей выдаются блоками из
+id_sequences основной БД и уникальны во всех шардах.
+
+Перенос выполняется без остановки чтения: автомобили копируются в новый шард
+(копия не видна запросам), затем запись дилера приостанавливается (503 с
+Retry-After) на время догоняющего копирования, размещение переключается, и
+строки в старом шарде удаляются. Воркеры видят изменения размещения не позже
+чем через CAR_SHARD_DIRECTORY_TTL_SECONDS.
+
+Запуск: python sharding.py status
+        python sharding.py move --dealer 7 --to 2
+"""
+import argparse
+import logging
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Sequence
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, sessionmaker
+
+from database import DBCar, DBDealerShard, DBIdSequence, SessionLocal, create_db_engine, engine
+
+# Настройки шардов автомобилей (переменные окружения)
+CAR_SHARD_URLS = [url.strip() for url in os.getenv("CAR_SHARD_URLS", "").split(",") if url.strip()]
+# Как долго воркер использует прочитанные размещения дилеров
+CAR_SHARD_DIRECTORY_TTL_SECONDS = float(os.getenv("CAR_SHARD_DIRECTORY_TTL_SECONDS", "2"))
+# Потоки параллельных запросов ко всем шардам (0 - по два на шард)
+CAR_SHARD_WORKERS = int(os.getenv("CAR_SHARD_WORKERS", "0"))
+# id автомобилей, резервируемые процессом за одно обращение к основной БД
+CAR_ID_BLOCK_SIZE = int(os.getenv("CAR_ID_BLOCK_SIZE", "1000"))
+# Запас ожидания при переносе на завершение начатых записей и расхождение часов
+CAR_SHARD_SETTLE_SECONDS = float(os.getenv("CAR_SHARD_SETTLE_SECONDS", "1"))
+# Строк в одной транзакции копирования при переносе (не больше лимита параметров SQLite)
+CAR_SHARD_MOVE_BATCH = 900
+
+CAR_ID_SEQUENCE = "cars"
+
+logger = logging.getLogger("carshop.sharding")
+
+
+class DealerMoving(Exception):
+    """Запись автомобилей дилера приостановлена на время завершения переноса"""
+
+    def __init__(self, dealer_id: int):
+        super().__init__(f"Dealer {dealer_id} is being moved between shards")
+        self.dealer_id = dealer_id
+
+
+class Placement(NamedTuple):
+    """Размещение дилера: основной шард, шард с копией на время переноса, приостановка записи"""
+    shard: int
+    copy_shard: Optional[int] = None
+    frozen: bool = False
+
+
+class ShardRouter:
+    """Движки шардов, размещение дилеров и параллельные запросы ко всем шардам"""
+
+    def __init__(self, urls: Sequence[str] = CAR_SHARD_URLS):
+        self.enabled = bool(urls)
+        self.engines = [engine] + [create_db_engine(url) for url in urls]
+        # Шард 0 - сессии основной БД (с отметкой записи для реплик чтения)
+        self._sessions = [SessionLocal] + [
+            sessionmaker(autocommit=False, autoflush=False, bind=bind) for bind in self.engines[1:]
+        ]
+        self._placements: Dict[int, Placement] = {}
+        self._copies: Dict[int, List[int]] = {}
+        self._frozen: Optional[int] = None
+        self._loaded_at: Optional[float] = None
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._next_id = self._block_end = 0
+        self._ids_lock = threading.Lock()
+
+    @property
+    def shards(self) -> List[int]:
+        return list(range(len(self.engines)))
+
+    def session(self, shard: int) -> Session:
+        return self._sessions[shard]()
+
+    # ---------- размещение дилеров ----------
+
+    def reload(self) -> None:
+        """Перечитать dealer_shards из основной БД"""
+        with SessionLocal() as db:
+            rows = db.execute(select(
+                DBDealerShard.dealer_id, DBDealerShard.shard, DBDealerShard.copy_shard, DBDealerShard.frozen,
+            )).all()
+        placements = {row.dealer_id: Placement(row.shard, row.copy_shard, bool(row.frozen)) for row in rows}
+        copies: Dict[int, List[int]] = {}
+        for dealer_id, placement in placements.items():
+            if placement.copy_shard is not None:
+                copies.setdefault(placement.copy_shard, []).append(dealer_id)
+        with self._lock:
+            self._placements, self._copies = placements, copies
+            self._frozen = next((dealer_id for dealer_id, placement in placements.items() if placement.frozen), None)
+            self._loaded_at = time.monotonic()
+
+    def _fresh(self) -> None:
+        loaded_at = self._loaded_at
+        if loaded_at is None or time.monotonic() - loaded_at >= CAR_SHARD_DIRECTORY_TTL_SECONDS:
+            self.reload()
+
+    def placements(self) -> Dict[int, Placement]:
+        """Закрепленные размещения дилеров"""
+        self._fresh()
+        return self._placements
+
+    def placement(self, dealer_id: int) -> Placement:
+        self._fresh()
+        placement = self._placements.get(dealer_id)
+        return placement if placement is not None else Placement(dealer_id % len(self.engines))
+
+    def shard_for(self, dealer_id: int) -> int:
+        """Шард с автомобилями дилера (для чтения и записи)"""
+        return self.placement(dealer_id).shard
+
+    def owns(self, shard: int, dealer_id: int) -> bool:
+        """Строка дилера в шарде - основная, а не копия переносимого дилера"""
+        return self.shard_for(dealer_id) == shard
+
+    def copies(self, shard: int) -> List[int]:
+        """Дилеры с копией автомобилей в шарде: исключаются из запросов ко всем дилерам"""
+        self._fresh()
+        return self._copies.get(shard, [])
+
+    def frozen_dealer(self) -> Optional[int]:
+        """Дилер с приостановленной записью (None - переносов в этой фазе нет)"""
+        self._fresh()
+        return self._frozen
+
+    def assign(self, dealer_id: int) -> int:
+        """Шард для записи автомобилей дилера; размещение закрепляется при первой записи
+
+        DealerMoving - запись дилера приостановлена переносом.
+        """
+        self._fresh()
+        placement = self._placements.get(dealer_id)
+        if placement is None:
+            placement = Placement(dealer_id % len(self.engines))
+            db = SessionLocal()
+            try:
+                db.add(DBDealerShard(dealer_id=dealer_id, shard=placement.shard))
+                db.commit()
+            except IntegrityError:
+                # Размещение закрепил другой процесс
+                db.rollback()
+                self.reload()
+                placement = self.placement(dealer_id)
+            else:
+                with self._lock:
+                    self._placements = {**self._placements, dealer_id: placement}
+            finally:
+                db.close()
+        if placement.frozen:
+            raise DealerMoving(dealer_id)
+        return placement.shard
+
+    def check_writable(self, dealer_id: int) -> None:
+        if self.placement(dealer_id).frozen:
+            raise DealerMoving(dealer_id)
+
+    # ---------- запросы ко всем шардам ----------
+
+    def map(self, fn: Callable[[Any], Any], items: Optional[Sequence] = None) -> list:
+        """fn(элемент) параллельно для items (по умолчанию - номера шардов); результаты в том же порядке
+
+        fn не должна сама вызывать map: потоки пула общие для всех запросов.
+        """
+        items = self.shards if items is None else list(items)
+        if len(items) == 1:
+            return [fn(items[0])]
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    CAR_SHARD_WORKERS or 2 * len(self.engines), thread_name_prefix="car-shard")
+            executor = self._executor
+        futures = [executor.submit(fn, item) for item in items]
+        return [future.result() for future in futures]
+
+    # ---------- id автомобилей ----------
+
+    def allocate_ids(self, count: int) -> List[int]:
+        """count новых id автомобилей из зарезервированных процессом блоков"""
+        ids: List[int] = []
+        with self._ids_lock:
+            while len(ids) < count:
+                if self._next_id >= self._block_end:
+                    size = max(CAR_ID_BLOCK_SIZE, count - len(ids))
+                    self._next_id = self._reserve_block(size)
+                    self._block_end = self._next_id + size
+                take = min(count - len(ids), self._block_end - self._next_id)
+                ids.extend(range(self._next_id, self._next_id + take))
+                self._next_id += take
+        return ids
+
+    def _reserve_block(self, size: int) -> int:
+        """Первый id блока: UPDATE счетчика в основной БД (счетчик создается по максимальному id шардов)"""
+        db = SessionLocal()
+        try:
+            while True:
+                sequence = DBIdSequence.name == CAR_ID_SEQUENCE
+                if db.execute(update(DBIdSequence).where(sequence).values(
+                        next_value=DBIdSequence.next_value + size)).rowcount:
+                    end = db.execute(select(DBIdSequence.next_value).where(sequence)).scalar_one()
+                    db.commit()
+                    return end - size
+                db.rollback()
+                start = max(self.map(self._max_id)) + 1
+                try:
+                    db.add(DBIdSequence(name=CAR_ID_SEQUENCE, next_value=start))
+                    db.commit()
+                except IntegrityError:
+                    db.rollback()
+        finally:
+            db.close()
+
+    def _max_id(self, shard: int) -> int:
+        with self.session(shard) as db:
+            return db.execute(select(func.max(DBCar.id))).scalar() or 0
+
+    def stats(self) -> dict:
+        return {
+            "shards": len(self.engines),
+            "dealers": len(self._placements),
+            "moving": sum(len(dealers) for dealers in self._copies.values()),
+        }
+
+
+car_shards = ShardRouter()
+
+
+# ---------- перенос дилера между шардами ----------
+
+def _set_placement(dealer_id: int, **values) -> None:
+    with SessionLocal() as db:
+        if not db.execute(update(DBDealerShard).where(DBDealerShard.dealer_id == dealer_id).values(
+                **values, updated_at=datetime.utcnow())).rowcount:
+            db.add(DBDealerShard(dealer_id=dealer_id, **values))
+        db.commit()
+
+
+def _wait_directory() -> None:
+    """Ожидание, пока все воркеры перечитают размещения"""
+    time.sleep(CAR_SHARD_DIRECTORY_TTL_SECONDS + CAR_SHARD_SETTLE_SECONDS)
+
+
+def _dealer_ids(router: ShardRouter, shard: int, dealer_id: int) -> set:
+    with router.session(shard) as db:
+        return set(db.execute(select(DBCar.id).where(DBCar.dealer_id == dealer_id)).scalars())
+
+
+def _copy_rows(router: ShardRouter, dealer_id: int, source: int, target: int,
+               since: Optional[datetime] = None, batch_size: int = CAR_SHARD_MOVE_BATCH) -> int:
+    """Копирование автомобилей дилера порциями по id (строки в целевом шарде заменяются)"""
+    copied, last_id = 0, 0
+    with router.session(source) as src, router.session(target) as dst:
+        while True:
+            stmt = select(DBCar.__table__).where(DBCar.dealer_id == dealer_id, DBCar.id > last_id)
+            if since is not None:
+                stmt = stmt.where(DBCar.updated_at >= since)
+            rows = [dict(row._mapping) for row in src.execute(stmt.order_by(DBCar.id).limit(batch_size))]
+            src.rollback()
+            if not rows:
+                return copied
+            ids = [row["id"] for row in rows]
+            dst.execute(delete(DBCar).where(DBCar.id.in_(ids)))
+            dst.execute(insert(DBCar), rows)
+            dst.commit()
+            copied += len(rows)
+            last_id = ids[-1]
+
+
+def _delete_rows(router: ShardRouter, shard: int, ids: Sequence[int], batch_size: int = CAR_SHARD_MOVE_BATCH) -> int:
+    ids = sorted(ids)
+    with router.session(shard) as db:
+        for start in range(0, len(ids), batch_size):
+            db.execute(delete(DBCar).where(DBCar.id.in_(ids[start:start + batch_size])))
+            db.commit()
+    return len(ids)
+
+
+def move_dealer(dealer_id: int, target: int, router: ShardRouter = car_shards, log=logger.info) -> dict:
+    """Перенос автомобилей дилера в шард target без остановки чтения
+
+    1. Размещение получает copy_shard=target: копия исключается из запросов.
+    2. Строки копируются порциями; запись дилера продолжается в старом шарде.
+    3. Запись приостанавливается, изменения со времени начала копирования
+       (по updated_at) и удаления переносятся повторно.
+    4. Размещение переключается на target (старый шард становится копией),
+       запись возобновляется; после обновления размещений у всех воркеров
+       строки старого шарда удаляются.
+    Прерванный перенос в тот же шард можно запустить повторно.
+    """
+    if target not in router.shards:
+        raise ValueError(f"Unknown shard {target}")
+    router.reload()
+    placement = router.placement(dealer_id)
+    source = placement.shard
+    if source == target and placement.copy_shard is not None:
+        # Перенос прерван после переключения: остается удалить строки старого шарда
+        deleted = _finish_move(router, dealer_id, placement.copy_shard, log)
+        return {"dealer_id": dealer_id, "shard": target, "copied": 0, "deleted": deleted}
+    if placement.copy_shard not in (None, target):
+        raise RuntimeError(f"Dealer {dealer_id} has an unfinished move to shard {placement.copy_shard}")
+    if source == target:
+        return {"dealer_id": dealer_id, "shard": target, "copied": 0, "deleted": 0}
+
+    _set_placement(dealer_id, shard=source, copy_shard=target, frozen=False)
+    _wait_directory()
+    started = datetime.utcnow() - timedelta(seconds=CAR_SHARD_SETTLE_SECONDS)
+    copied = _copy_rows(router, dealer_id, source, target)
+    log(f"dealer {dealer_id}: copied {copied} cars from shard {source} to {target}")
+
+    _set_placement(dealer_id, frozen=True)
+    _wait_directory()
+    try:
+        copied += _copy_rows(router, dealer_id, source, target, since=started)
+        removed = _dealer_ids(router, target, dealer_id) - _dealer_ids(router, source, dealer_id)
+        _delete_rows(router, target, removed)
+        _set_placement(dealer_id, shard=target, copy_shard=source, frozen=False)
+    except BaseException:
+        _set_placement(dealer_id, frozen=False)
+        raise
+    log(f"dealer {dealer_id}: switched to shard {target}")
+    deleted = _finish_move(router, dealer_id, source, log)
+    return {"dealer_id": dealer_id, "shard": target, "copied": copied, "deleted": deleted}
+
+
+def _finish_move(router: ShardRouter, dealer_id: int, source: int, log) -> int:
+    """Удаление строк старого шарда, когда его копию уже не читает ни один воркер"""
+    _wait_directory()
+    deleted = _delete_rows(router, source, _dealer_ids(router, source, dealer_id))
+    _set_placement(dealer_id, copy_shard=None)
+    log(f"dealer {dealer_id}: deleted {deleted} cars from shard {source}")
+    return deleted
+
+
+def shard_status(router: ShardRouter = car_shards) -> List[dict]:
+    """Число автомобилей и дилеров в каждом шарде"""
+    def count(shard: int) -> dict:
+        with router.session(shard) as db:
+            cars = db.execute(select(func.count()).select_from(DBCar)).scalar()
+            dealers = db.execute(select(func.count(DBCar.dealer_id.distinct()))).scalar()
+        url = router.engines[shard].url.render_as_string(hide_password=True)
+        return {"shard": shard, "url": url, "cars": cars, "dealers": dealers}
+    return router.map(count)
+
+
+def main() -> int:
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="автомобили и дилеры по шардам, незавершенные переносы")
+    move = commands.add_parser("move", help="перенести автомобили дилера в другой шард")
+    move.add_argument("--dealer", type=int, required=True)
+    move.add_argument("--to", type=int, required=True, help="номер шарда (0 - основная БД)")
+    args = parser.parse_args()
+
+    if args.command == "move":
+        result = move_dealer(args.dealer, args.to)
+        print(f"Дилер {result['dealer_id']} в шарде {result['shard']}: "
+              f"скопировано {result['copied']}, удалено {result['deleted']}")
+        return 0
+    for shard in shard_status():
+        print(f"shard {shard['shard']}: {shard['cars']} cars, {shard['dealers']} dealers ({shard['url']})")
+    for dealer_id, placement in sorted(car_shards.placements().items()):
+        if placement.copy_shard is not None or placement.frozen:
+            print(f"dealer {dealer_id}: shard {placement.shard}, copy in {placement.copy_shard}, "
+                  f"frozen={placement.frozen} (незавершенный перенос)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,109 @@
+import asyncio
+import os
+import threading
+from concurrent.futures import Future
+from typing import Any, Awaitable, Callable, Dict, Hashable, Tuple
+
+from metrics import Counter, registry
+
+# Объединение одновременных одинаковых чтений (переменные окружения)
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT_ENABLED", "1") == "1"
+
+single_flight_calls = registry.register(Counter(
+    "single_flight_calls_total", "Вызовы с объединением: leader - выполнил, follower - получил чужой результат",
+    ("group", "role"),
+))
+
+
+class _Abandoned(Exception):
+    """Ведущий вызов прерван (отмена запроса): ожидающие выполняют вызов заново"""
+
+
+class SingleFlight:
+    """Один вызов на ключ для одновременных одинаковых запросов
+
+    Первый запрос с ключом (ведущий) выполняет функцию, остальные, пришедшие
+    до ее завершения, ждут и получают тот же результат или то же исключение.
+    Результат не сохраняется после завершения вызова, поэтому устаревание
+    ограничено длительностью одного вызова. Работает одновременно для потоков
+    пула (do) и корутин (do_async): ожидание - на общем concurrent.futures.Future.
+    """
+
+    def __init__(self, name: str, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.name = name
+        self.enabled = enabled
+        self.leaders = 0
+        self.coalesced = 0
+        self._calls: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+
+    def _join(self, key: Hashable) -> Tuple[Future, bool]:
+        with self._lock:
+            call = self._calls.get(key)
+            if call is not None:
+                self.coalesced += 1
+                single_flight_calls.inc(self.name, "follower")
+                return call, False
+            call = self._calls[key] = Future()
+            self.leaders += 1
+            single_flight_calls.inc(self.name, "leader")
+            return call, True
+
+    def _finish(self, key: Hashable, call: Future) -> None:
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Any:
+        """Результат fn() для ключа, общий для одновременных вызовов"""
+        if not self.enabled:
+            return fn()
+        while True:
+            call, leader = self._join(key)
+            if not leader:
+                try:
+                    return call.result()
+                except _Abandoned:
+                    continue
+            try:
+                result = fn()
+            except Exception as e:
+                call.set_exception(e)
+                raise
+            except BaseException:
+                call.set_exception(_Abandoned())
+                raise
+            else:
+                call.set_result(result)
+                return result
+            finally:
+                self._finish(key, call)
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Any:
+        """Асинхронный вариант do()"""
+        if not self.enabled:
+            return await fn()
+        while True:
+            call, leader = self._join(key)
+            if not leader:
+                try:
+                    # shield: отмена ожидающего запроса не отменяет общий вызов
+                    return await asyncio.shield(asyncio.wrap_future(call))
+                except _Abandoned:
+                    continue
+            try:
+                result = await fn()
+            except Exception as e:
+                call.set_exception(e)
+                raise
+            except BaseException:
+                call.set_exception(_Abandoned())
+                raise
+            else:
+                call.set_result(result)
+                return result
+            finally:
+                self._finish(key, call)
+
+    def stats(self) -> dict:
+        return {"leaders": self.leaders, "coalesced": self.coalesced, "in_flight": len(self._calls)}
@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+from datetime import datetime
+from functools import lru_cache
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+
+
+@lru_cache(maxsize=None)
+def _numpy():
+    """NumPy - необязательная зависимость (без нее перцентили считаются на Python)
+
+    Импортируется при первой загрузке снимка цен, а не при старте воркера.
+    """
+    try:
+        import numpy
+    except ImportError:  # pragma: no cover
+        return None
+    return numpy
+
+
+# Сводная таблица статистики автомобилей: одна строка на пару (марка, год)
+CAR_STATS_TABLE = "car_stats"
+# Время последней полной перестройки сводных таблиц
+SUMMARY_STATE_TABLE = "summary_state"
+
+# Снимок цен для перцентилей перечитывается после изменений не чаще, чем раз в столько секунд
+STATS_SNAPSHOT_REFRESH_SECONDS = float(os.getenv("STATS_SNAPSHOT_REFRESH_SECONDS", "30"))
+STATS_MAX_PERCENTILES = 20
+
+# Текущее время UTC в формате DateTime SQLAlchemy для SQLite
+_SQLITE_NOW = "strftime('%Y-%m-%d %H:%M:%f', 'now')"
+
+
+def _add_car(row: str) -> str:
+    # Строка группы создается пустой, затем к ней прибавляется автомобиль;
+    # IS вместо = сравнивает и NULL
+    return f"""
+        INSERT INTO {CAR_STATS_TABLE}(brand, year, car_count, price_sum)
+        SELECT {row}.brand, {row}.year, 0, 0
+        WHERE NOT EXISTS (SELECT 1 FROM {CAR_STATS_TABLE} WHERE brand IS {row}.brand AND year IS {row}.year);
+        UPDATE {CAR_STATS_TABLE} SET
+            car_count = car_count + 1,
+            price_sum = price_sum + COALESCE({row}.price, 0),
+            min_price = MIN(COALESCE(min_price, {row}.price), COALESCE({row}.price, min_price)),
+            max_price = MAX(COALESCE(max_price, {row}.price), COALESCE({row}.price, max_price)),
+            updated_at = {_SQLITE_NOW}
+        WHERE brand IS {row}.brand AND year IS {row}.year;"""
+
+
+def _remove_car(row: str) -> str:
+    # Минимум и максимум пересчитываются по индексу (brand, year, price),
+    # только если удаляемая цена была крайней в группе
+    return f"""
+        UPDATE {CAR_STATS_TABLE} SET
+            car_count = car_count - 1,
+            price_sum = price_sum - COALESCE({row}.price, 0),
+            updated_at = {_SQLITE_NOW}
+        WHERE brand IS {row}.brand AND year IS {row}.year;
+        DELETE FROM {CAR_STATS_TABLE} WHERE brand IS {row}.brand AND year IS {row}.year AND car_count <= 0;
+        UPDATE {CAR_STATS_TABLE} SET
+            min_price = (SELECT MIN(price) FROM cars WHERE brand IS {row}.brand AND year IS {row}.year),
+            max_price = (SELECT MAX(price) FROM cars WHERE brand IS {row}.brand AND year IS {row}.year)
+        WHERE brand IS {row}.brand AND year IS {row}.year
+            AND ({row}.price <= min_price OR {row}.price >= max_price);"""
+
+
+# Триггеры инкрементального обновления сводки (только SQLite): срабатывают
+# при любых изменениях таблицы, включая пакетные операции и импорт
+CAR_STATS_TRIGGERS_DDL = [
+    f"CREATE TRIGGER IF NOT EXISTS car_stats_ai AFTER INSERT ON cars BEGIN {_add_car('new')} END",
+    f"CREATE TRIGGER IF NOT EXISTS car_stats_ad AFTER DELETE ON cars BEGIN {_remove_car('old')} END",
+    f"""CREATE TRIGGER IF NOT EXISTS car_stats_au AFTER UPDATE OF brand, year, price ON cars BEGIN
+        {_remove_car('old')}
+        {_add_car('new')}
+    END""",
+]
+
+REBUILD_CAR_STATS_SQL = [
+    text(f"DELETE FROM {CAR_STATS_TABLE}"),
+    text(f"""INSERT INTO {CAR_STATS_TABLE}(brand, year, car_count, price_sum, min_price, max_price, updated_at)
+        SELECT brand, year, COUNT(*), COALESCE(SUM(price), 0), MIN(price), MAX(price), :now
+        FROM cars GROUP BY brand, year"""),
+    text(f"DELETE FROM {SUMMARY_STATE_TABLE} WHERE name = :name"),
+    text(f"INSERT INTO {SUMMARY_STATE_TABLE}(name, rebuilt_at) VALUES (:name, :now)"),
+]
+
+
+def incremental_stats(dialect) -> bool:
+    """Обновляется ли сводка триггерами при каждой записи (иначе - только перестройкой)"""
+    return dialect.name == "sqlite"
+
+
+def rebuild_car_stats(connection: Connection) -> None:
+    """Полная перестройка сводки одним агрегирующим запросом по таблице cars"""
+    params = {"name": CAR_STATS_TABLE, "now": datetime.utcnow()}
+    for statement in REBUILD_CAR_STATS_SQL:
+        connection.execute(statement, params)
+
+
+def create_car_stats(connection: Connection) -> None:
+    """Триггеры сводки; сводка строится, если она еще ни разу не перестраивалась"""
+    if incremental_stats(connection.dialect):
+        for statement in CAR_STATS_TRIGGERS_DDL:
+            connection.execute(text(statement))
+    rebuilt = connection.execute(
+        text(f"SELECT 1 FROM {SUMMARY_STATE_TABLE} WHERE name = :name"), {"name": CAR_STATS_TABLE}
+    ).first()
+    if not rebuilt:
+        rebuild_car_stats(connection)
+
+
+def collect_car_stats(keys: Sequence[str], rows: Iterable[Sequence]) -> dict:
+    """Группы и общий итог из строк (*ключи группы, количество, сумма цен, минимум, максимум)"""
+    rows = list(rows)
+    groups = []
+    for row in rows:
+        group = dict(zip(keys, row))
+        group.update(stats_entry(*row[len(keys):]))
+        groups.append(group)
+    return {"groups": groups, "total": summarize_groups(row[len(keys):] for row in rows)}
+
+
+def summarize_groups(rows: Iterable[Sequence]) -> dict:
+    """Итог по строкам (количество, сумма цен, минимум, максимум)"""
+    count, total, low, high = 0, 0.0, None, None
+    for car_count, price_sum, min_price, max_price in rows:
+        count += car_count
+        total += price_sum
+        if min_price is not None:
+            low = min_price if low is None else min(low, min_price)
+        if max_price is not None:
+            high = max_price if high is None else max(high, max_price)
+    return stats_entry(count, total, low, high)
+
+
+def stats_entry(count: int, price_sum: float, min_price: Optional[float], max_price: Optional[float]) -> dict:
+    return {
+        "count": count,
+        "avg_price": round(price_sum / count, 2) if count else None,
+        "min_price": min_price,
+        "max_price": max_price,
+        "inventory_value": round(price_sum, 2),
+    }
+
+
+def parse_percentiles(value: str) -> List[float]:
+    """Список перцентилей из строки "50,90,99"; ValueError при неверных значениях"""
+    percentiles = [float(item) for item in value.split(",") if item.strip()]
+    if not percentiles or len(percentiles) > STATS_MAX_PERCENTILES:
+        raise ValueError("Invalid number of percentiles")
+    if any(not 0 <= q <= 100 for q in percentiles):
+        raise ValueError("Percentile out of range")
+    return percentiles
+
+
+class PriceSnapshot:
+    """Колоночный снимок (марка, год, цена) всех автомобилей для перцентилей
+
+    Колонки хранятся массивами NumPy: фильтр - булева маска, перцентили -
+    один вызов numpy.percentile. Цены читаются по группам (марка, год) через
+    покрывающий индекс ix_cars_brand_year_price - без строк ORM на каждый автомобиль. Снимок перечитывается, когда таблица изменилась
+    и прошло refresh_seconds, поэтому ответ содержит его версию и время загрузки.
+    """
+
+    def __init__(self, refresh_seconds: float = STATS_SNAPSHOT_REFRESH_SECONDS):
+        self.refresh_seconds = refresh_seconds
+        self.version = None
+        self.loaded_at: Optional[datetime] = None
+        self._loaded_monotonic = 0.0
+        self._columns = None
+        self.load_lock = threading.Lock()
+
+    def is_stale(self, version) -> bool:
+        if self.version is None:
+            return True
+        return version != self.version and time.monotonic() - self._loaded_monotonic >= self.refresh_seconds
+
+    def load(self, groups: Iterable[Tuple[Optional[str], Optional[int], Sequence[float]]], version) -> None:
+        """Загрузка цен по группам (марка, год, [цены]): марка и год хранятся кодами групп"""
+        brand_codes: Dict[Optional[str], int] = {}
+        np = _numpy()
+        if np is not None:
+            codes, years, prices = [], [], []
+            for brand, year, group_prices in groups:
+                values = np.fromiter(group_prices, dtype=float, count=len(group_prices))
+                code = brand_codes.setdefault(brand, len(brand_codes))
+                codes.append(np.full(values.size, code, dtype=np.int32))
+                years.append(np.full(values.size, -1 if year is None else year, dtype=np.int32))
+                prices.append(values)
+            columns = (
+                brand_codes,
+                np.concatenate(codes) if codes else np.empty(0, dtype=np.int32),
+                np.concatenate(years) if years else np.empty(0, dtype=np.int32),
+                np.concatenate(prices) if prices else np.empty(0),
+            )
+        else:
+            columns = [
+                (brand, -1 if year is None else year, price)
+                for brand, year, group_prices in groups for price in group_prices
+            ]
+        self._columns = columns
+        self.version = version
+        self.loaded_at = datetime.utcnow()
+        self._loaded_monotonic = time.monotonic()
+
+    def percentiles(
+        self,
+        percentiles: List[float],
+        brand: Optional[str] = None,
+        year_min: Optional[int] = None,
+        year_max: Optional[int] = None,
+    ) -> Dict[str, Optional[float]]:
+        """Перцентили цены (линейная интерполяция) по автомобилям, прошедшим фильтр"""
+        np = _numpy()
+        if np is not None:
+            values = self._select_numpy(brand, year_min, year_max)
+            if values.size == 0:
+                return {_label(q): None for q in percentiles}
+            return {_label(q): float(value) for q, value in zip(percentiles, np.percentile(values, percentiles))}
+        values = sorted(
+            price for car_brand, year, price in self._columns
+            if (brand is None or car_brand == brand)
+            and (year_min is None or year >= year_min) and (year_max is None or year <= year_max)
+        )
+        return {_label(q): _interpolate(values, q) for q in percentiles}
+
+    def _select_numpy(self, brand: Optional[str], year_min: Optional[int], year_max: Optional[int]):
+        brand_codes, codes, years, prices = self._columns
+        mask = None
+        if brand is not None:
+            code = brand_codes.get(brand)
+            if code is None:
+                return prices[:0]
+            mask = codes == code
+        if year_min is not None:
+            mask = (years >= year_min) if mask is None else mask & (years >= year_min)
+        if year_max is not None:
+            mask = (years <= year_max) if mask is None else mask & (years <= year_max)
+        return prices if mask is None else prices[mask]
+
+
+def _label(q: float) -> str:
+    return f"p{q:g}"
+
+
+def _interpolate(values: List[float], q: float) -> Optional[float]:
+    # То же, что numpy.percentile с method="linear"
+    if not values:
+        return None
+    position = (len(values) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+car_price_snapshot = PriceSnapshot()
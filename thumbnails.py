@@ -0,0 +1,102 @@
+"""Миниатюры фотографий в пуле процессов
+
+Модуль импортируется процессами пула, поэтому зависит только от стандартной
+библиотеки; Pillow (необязательная зависимость) импортируется в процессе пула.
+"""
+import importlib.util
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Optional, Set
+
+# Настройки миниатюр (переменные окружения)
+THUMBNAIL_SIZE = int(os.getenv("MEDIA_THUMBNAIL_SIZE", "320"))
+THUMBNAIL_QUALITY = int(os.getenv("MEDIA_THUMBNAIL_QUALITY", "80"))
+THUMBNAIL_WORKERS = int(os.getenv("MEDIA_THUMBNAIL_WORKERS", "2"))
+
+# Проверка без импорта: Pillow загружается только процессами пула
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+logger = logging.getLogger("carshop.thumbnails")
+
+
+def render_thumbnail(source: str, target: str, size: int = THUMBNAIL_SIZE, quality: int = THUMBNAIL_QUALITY) -> None:
+    """JPEG не больше size x size с сохранением пропорций (выполняется в процессе пула)"""
+    from PIL import Image
+
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    temp = f"{target}.{os.getpid()}.tmp"
+    try:
+        with Image.open(source) as image:
+            # JPEG декодируется сразу в уменьшенном масштабе
+            image.draft("RGB", (size, size))
+            image.thumbnail((size, size))
+            image.convert("RGB").save(temp, "JPEG", quality=quality, optimize=True)
+        os.replace(temp, target)
+    finally:
+        if os.path.exists(temp):
+            os.remove(temp)
+
+
+class ThumbnailPool:
+    """Пул процессов для миниатюр: декодирование и масштабирование не занимают потоки и GIL воркера
+
+    Процессы запускаются при первой задаче (spawn: без копии состояния воркера),
+    одинаковые задачи, пока выполняется первая, не повторяются. done(key, ok)
+    вызывается в служебном потоке пула по завершении задачи.
+    """
+
+    def __init__(self, workers: int = THUMBNAIL_WORKERS):
+        self.workers = workers
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+
+    @property
+    def available(self) -> bool:
+        return PILLOW_AVAILABLE and self.workers > 0
+
+    def submit(self, key: str, source: str, target: str, done: Callable[[str, bool], None]) -> bool:
+        """Поставить миниатюру в очередь; False - задача с этим ключом уже выполняется"""
+        with self._lock:
+            if key in self._pending:
+                return False
+            if self._executor is None:
+                self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+            executor = self._executor
+            self._pending.add(key)
+        try:
+            future = executor.submit(render_thumbnail, source, target)
+        except BaseException:
+            self._reset(key, executor)
+            raise
+        future.add_done_callback(lambda f: self._finish(key, executor, f, done))
+        return True
+
+    def _reset(self, key: str, executor: ProcessPoolExecutor) -> None:
+        with self._lock:
+            self._pending.discard(key)
+            # Пул с аварийно завершенным процессом не принимает задачи: следующая создаст новый
+            if self._executor is executor and getattr(executor, "_broken", False):
+                self._executor = None
+
+    def _finish(self, key: str, executor: ProcessPoolExecutor, future: Future, done) -> None:
+        self._reset(key, executor)
+        error = None if future.cancelled() else future.exception()
+        if future.cancelled() or isinstance(error, BrokenProcessPool):
+            return
+        if error is not None:
+            logger.warning("Thumbnail %s failed: %s", key, error)
+        done(key, error is None)
+
+    def shutdown(self) -> None:
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> dict:
+        return {"pending": len(self._pending), "workers": self.workers if self._executor is not None else 0}